@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" Generates a synthetic library of epubs, for benchmarks. """
+
+import os
+import json
+import hashlib
+import random
+import argparse
+import zipfile
+
+FIRST_NAMES = ["Alice", "Bruno", "Chidi", "Dana", "Emeka", "Fatima", "Gustav",
+               "Hiroshi", "Ingrid", "Jorge", "Kamala", "Lars", "Mei", "Nadia",
+               "Olusegun", "Pierre", "Quentin", "Rosa", "Sven", "Tomasz",
+               "Ursula", "Valentina", "Wen", "Xavier", "Yusuf", "Zoé"]
+LAST_NAMES = ["Abara", "Bergström", "Castillo", "Dubois", "Eriksen",
+              "Fontaine", "García", "Hamilton", "Ivanova", "Jensen", "Kowalski",
+              "Lindqvist", "Morgan", "Nakamura", "Okafor", "Petrov", "Quiroga",
+              "Rossi", "Schmidt", "Tanaka", "Umarov", "Vasquez", "Walker",
+              "Xu", "Yamamoto", "Zhang"]
+WORDS = ["abyss", "amber", "ashes", "blade", "bridge", "circle", "crown",
+         "dawn", "desert", "dragon", "dream", "echo", "empire", "engine",
+         "exile", "fire", "forest", "frontier", "garden", "ghost", "glass",
+         "harbor", "heart", "hollow", "iron", "island", "kingdom", "light",
+         "machine", "memory", "mirror", "moon", "night", "ocean", "orbit",
+         "river", "salt", "shadow", "silence", "silver", "sky", "star",
+         "stone", "storm", "sun", "thorn", "tide", "tower", "winter", "wolf"]
+TAGS = ["sf", "sf/space opera", "sf/cyberpunk", "fantasy", "fantasy/epic",
+        "classics", "crime", "horror", "history", "non-fiction", "poetry",
+        "to read", "favourites"]
+
+CONTAINER = """<?xml version="1.0" encoding="UTF-8"?>
+<container version="1.0" \
+xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+  <rootfiles>
+    <rootfile full-path="%s" media-type="application/oebps-package+xml"/>
+  </rootfiles>
+</container>
+"""
+
+# epub 2, as written by calibre
+OPF_CALIBRE = """<?xml version="1.0" encoding="utf-8"?>
+<package xmlns="http://www.idpf.org/2007/opf" version="2.0" \
+unique-identifier="uuid_id">
+  <metadata xmlns:dc="http://purl.org/dc/elements/1.1/" \
+xmlns:opf="http://www.idpf.org/2007/opf" \
+xmlns:calibre="http://calibre.kovidgoyal.net/2009/metadata">
+    <dc:title>%(title)s</dc:title>
+%(creators)s
+    <dc:date>%(year)s-01-01T00:00:00+00:00</dc:date>
+    <dc:language>en</dc:language>
+    <dc:identifier id="uuid_id" opf:scheme="uuid">%(uuid)s</dc:identifier>
+    <dc:description>%(description)s</dc:description>
+%(subjects)s
+    <!-- generated for librarian benchmarks -->
+%(series)s
+    <meta name="calibre:timestamp" content="2015-06-01T10:00:00+00:00"/>
+    <meta name="cover" content="cover"/>
+  </metadata>
+  <manifest>
+%(items)s
+    <item id="cover" href="cover.jpg" media-type="image/jpeg"/>
+    <item id="ncx" href="toc.ncx" media-type="application/x-dtbncx+xml"/>
+  </manifest>
+  <spine toc="ncx">
+%(itemrefs)s
+  </spine>
+</package>
+"""
+
+# epub 3, without calibre metadata
+OPF_EPUB3 = """<?xml version="1.0" encoding="utf-8"?>
+<package xmlns="http://www.idpf.org/2007/opf" version="3.0" \
+unique-identifier="pub-id">
+  <metadata xmlns:dc="http://purl.org/dc/elements/1.1/">
+    <dc:identifier id="pub-id">urn:uuid:%(uuid)s</dc:identifier>
+    <dc:title>%(title)s</dc:title>
+%(creators)s
+    <dc:date>%(year)s</dc:date>
+    <dc:language>en</dc:language>
+    <dc:description>%(description)s</dc:description>
+%(subjects)s
+    <meta property="dcterms:modified">2016-01-01T00:00:00Z</meta>
+  </metadata>
+  <manifest>
+%(items)s
+    <item id="cover" href="cover.jpg" media-type="image/jpeg" \
+properties="cover-image"/>
+  </manifest>
+  <spine>
+%(itemrefs)s
+  </spine>
+</package>
+"""
+
+CHAPTER = """<?xml version="1.0" encoding="utf-8"?>
+<html xmlns="http://www.w3.org/1999/xhtml">
+<head><title>Chapter %s</title></head>
+<body>
+%s
+</body>
+</html>
+"""
+
+
+def random_author(rng):
+    return "%s %s" % (rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES))
+
+
+def random_title(rng):
+    words = rng.sample(WORDS, rng.randint(1, 4))
+    return " ".join(["The"] + words).title()
+
+
+def random_paragraphs(rng, size):
+    paragraphs = []
+    written = 0
+    while written < size:
+        paragraph = " ".join(rng.choices(WORDS, k=rng.randint(40, 200)))
+        paragraphs.append("<p>%s.</p>" % paragraph.capitalize())
+        written += len(paragraph)
+    return "\n".join(paragraphs)
+
+
+def write_epub(path, book, rng):
+    opf_path = book["opf_path"]
+    opf_dir = os.path.dirname(opf_path)
+    chapters = max(1, book["size"] // 50000)
+    items = "\n".join(['    <item id="c%s" href="c%s.xhtml" '
+                       'media-type="application/xhtml+xml"/>' % (i, i)
+                       for i in range(chapters)])
+    itemrefs = "\n".join(['    <itemref idref="c%s"/>' % i
+                          for i in range(chapters)])
+    if book["epub3"]:
+        template = OPF_EPUB3
+        creators = "\n".join(['    <dc:creator>%s</dc:creator>' % el
+                              for el in book["authors"]])
+        series = ""
+    else:
+        template = OPF_CALIBRE
+        creators = "\n".join(['    <dc:creator opf:role="aut" '
+                              'opf:file-as="%s">%s</dc:creator>' %
+                              (", ".join(reversed(el.split(" ", 1))), el)
+                              for el in book["authors"]])
+        series = ""
+        if book["series"] is not None:
+            series = ('    <meta name="calibre:series" content="%s"/>\n'
+                      '    <meta name="calibre:series_index" '
+                      'content="%s"/>' % (book["series"],
+                                          book["series_index"]))
+    opf = template % {
+        "title": book["title"],
+        "creators": creators,
+        "year": book["year"],
+        "uuid": book["uuid"],
+        "description": "A novel about %s." % " and ".join(
+            rng.sample(WORDS, 3)),
+        "subjects": "\n".join(['    <dc:subject>%s</dc:subject>' % el
+                               for el in book["subjects"]]),
+        "series": series,
+        "items": items,
+        "itemrefs": itemrefs,
+        }
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with zipfile.ZipFile(path, "w") as epub:
+        epub.writestr(zipfile.ZipInfo("mimetype"), "application/epub+zip",
+                      zipfile.ZIP_STORED)
+        epub.writestr("META-INF/container.xml", CONTAINER % opf_path,
+                      zipfile.ZIP_DEFLATED)
+        epub.writestr(opf_path, opf, zipfile.ZIP_DEFLATED)
+        for i in range(chapters):
+            epub.writestr(os.path.join(opf_dir, "c%s.xhtml" % i),
+                          CHAPTER % (i, random_paragraphs(
+                              rng, book["size"] // chapters)),
+                          zipfile.ZIP_DEFLATED)
+        # incompressible, like real images
+        epub.writestr(os.path.join(opf_dir, "cover.jpg"),
+                      rng.randbytes(book["cover_size"]), zipfile.ZIP_STORED)
+
+
+def random_book(rng, authors, series):
+    book = {
+        "authors": [rng.choice(authors)],
+        "title": random_title(rng),
+        "year": rng.randint(1850, 2020),
+        "uuid": "%032x" % rng.getrandbits(128),
+        "subjects": rng.sample(["Fiction", "Science Fiction", "Fantasy",
+                                "Adventure", "Mystery"], rng.randint(0, 3)),
+        # a few large ebooks, many small ones
+        "size": int(min(3000000, rng.lognormvariate(11.5, 0.8))),
+        "cover_size": rng.randint(10000, 300000),
+        "epub3": rng.random() < 0.3,
+        "opf_path": rng.choice(["OEBPS/content.opf", "OPS/package.opf",
+                                "content.opf"]),
+        "series": None,
+        "series_index": None,
+        "tags": rng.sample(TAGS, rng.choice([0, 0, 1, 1, 2, 3])),
+        }
+    if rng.random() < 0.1:
+        book["authors"].append(rng.choice(authors))
+    if rng.random() < 0.4:
+        book["series"], book["series_index"] = rng.choice(series)
+        series.remove((book["series"], book["series_index"]))
+        series.append((book["series"], book["series_index"] + 1))
+    return book
+
+
+def generate(library_dir, count, seed=0):
+    """ Writes count random epubs directly in library_dir, as if they had
+    just been copied there. Returns the list of generated books. """
+    rng = random.Random(seed)
+    authors = [random_author(rng) for i in range(max(1, count // 8))]
+    series = [("%s Cycle" % random_title(rng), 1)
+              for i in range(max(1, count // 20))]
+    books = []
+    for i in range(count):
+        book = random_book(rng, authors, series)
+        book["path"] = os.path.join(library_dir, "book_%06d.epub" % i)
+        write_epub(book["path"], book, rng)
+        books.append(book)
+    return books
+
+
+
+def database_entry(book, path, rng):
+    # as saved by librarian, for an ebook that was opened once
+    metadata = {
+        "title": [book["title"]],
+        "creator": list(book["authors"]),
+        "date": [str(book["year"])],
+        "language": ["en"],
+        "identifier": [book["uuid"]],
+        "description": ["A novel about %s." % " and ".join(
+            rng.sample(WORDS, 3))],
+        "subject": list(book["subjects"]),
+        }
+    if book["series"] is not None:
+        metadata["series"] = [book["series"]]
+        metadata["series_index"] = [str(book["series_index"])]
+    metadata["author"] = list(metadata["creator"])
+    metadata["year"] = list(metadata["date"])
+    return {
+        "path": path,
+        "tags": ",".join(sorted(book["tags"])),
+        "last_synced_hash": "%040x" % rng.getrandbits(160),
+        "converted_to_mobi_hash": "%040x" % rng.getrandbits(160),
+        "converted_to_mobi_from_hash": "%040x" % rng.getrandbits(160),
+        "metadata": metadata,
+        "read": rng.choice([0, 0, 1, 2, 2]),
+        "generation": 1,
+        "added_generation": 1,
+        # not drawn from rng, so that libraries stay the same
+        "fingerprint": hashlib.sha1(path.encode("utf8")).hexdigest(),
+        "last_synced_fingerprint": hashlib.sha1(
+            path.encode("utf8") + b"synced").hexdigest(),
+        "converted_to_mobi_from_fingerprint": hashlib.sha1(
+            path.encode("utf8") + b"converted").hexdigest(),
+        }
+
+
+def generate_database(db, library_dir, count, seed=0):
+    """ Writes a database of count random ebooks, with empty files in
+    library_dir instead of epubs: much faster than generate, for what only
+    depends on the database. """
+    rng = random.Random(seed)
+    authors = [random_author(rng) for i in range(max(1, count // 8))]
+    series = [("%s Cycle" % random_title(rng), 1)
+              for i in range(max(1, count // 20))]
+    everything = {}
+    for i in range(count):
+        book = random_book(rng, authors, series)
+        path = os.path.join(library_dir, "%s" % book["authors"][0],
+                            "book_%06d.epub" % i)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        open(path, "w").close()
+        everything["book_%06d.epub" % i] = database_entry(book, path, rng)
+    with open(db, "w") as data_file:
+        data_file.write(json.dumps(everything, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Generate a synthetic \
+                                     library of epubs.')
+    parser.add_argument('library_dir',
+                        help='where the epubs are written')
+    parser.add_argument('-n',
+                        '--count',
+                        dest='count',
+                        type=int,
+                        default=1000,
+                        help='number of epubs')
+    parser.add_argument('--seed',
+                        dest='seed',
+                        type=int,
+                        default=0,
+                        help='random seed, for repeatable libraries')
+    args = parser.parse_args()
+    generate(args.library_dir, args.count, args.seed)
+    print("Generated %s epubs in %s." % (args.count, args.library_dir))
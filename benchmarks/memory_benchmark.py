@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" Measures the memory used by an opened library, per ebook, with and
+without compact_metadata. """
+
+import os
+import gc
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+from contextlib import redirect_stdout
+
+benchmarks_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.dirname(benchmarks_dir))
+
+from generate_library import generate_database
+from run_benchmarks import make_config, git_commit
+from librarianlib.library import Library
+from librarianlib.ebook_search import Search, EvaluateMatch
+
+
+def measure(config, db, compact):
+    config = dict(config, compact_metadata=compact)
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    library = Library(config, db)
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        library.open_db()
+    duration = time.perf_counter() - start
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+
+    # searching still works the same way
+    s = Search(library.ebooks)
+    s.filters(["tag:sf", "progress:read"])
+    found = sorted([eb.path for eb in s.run_search(EvaluateMatch.AND)])
+    return {
+        "bytes": used,
+        "bytes_per_ebook": used / max(1, len(library.ebooks)),
+        "open_db": duration,
+        "ebooks": len(library.ebooks),
+        }, found
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Measure the memory used \
+                                     by librarian for a large library.')
+    parser.add_argument('-n',
+                        '--size',
+                        dest='size',
+                        type=int,
+                        default=20000,
+                        help='number of ebooks in the database')
+    parser.add_argument('--seed',
+                        dest='seed',
+                        type=int,
+                        default=0,
+                        help='random seed of the library')
+    parser.add_argument('-o',
+                        '--output',
+                        dest='output',
+                        metavar="JSON_FILE",
+                        help='write results to this file')
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix="librarian_memory_")
+    try:
+        config = make_config(root)
+        db = os.path.join(root, "library.json")
+        print("Generating a database of %s ebooks..." % args.size)
+        generate_database(db, config["library_dir"], args.size, args.seed)
+        results = {"commit": git_commit(), "size": args.size,
+                   "seed": args.seed}
+        found = {}
+        for (name, compact) in [("default", False), ("compact", True)]:
+            results[name], found[name] = measure(config, db, compact)
+            print(" -> %-8s %8.0f bytes per ebook, %6.1fMB in total,"
+                  " opened in %.2fs" %
+                  (name, results[name]["bytes_per_ebook"],
+                   results[name]["bytes"] / 1024 / 1024,
+                   results[name]["open_db"]))
+        if found["default"] != found["compact"]:
+            print("Search results differ!")
+            sys.exit(-1)
+    finally:
+        shutil.rmtree(root)
+
+    if args.output is not None:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+        print("Results written to %s." % args.output)
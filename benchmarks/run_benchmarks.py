@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" Benchmarks the main library operations on a synthetic library, and
+writes the results as json, to compare them across commits. """
+
+import os
+import sys
+import json
+import time
+import shutil
+import random
+import platform
+import argparse
+import statistics
+import subprocess
+import tempfile
+from contextlib import redirect_stdout
+
+benchmarks_dir = os.path.dirname(os.path.realpath(__file__))
+librarian_dir = os.path.dirname(benchmarks_dir)
+sys.path.insert(0, librarian_dir)
+# ebook-convert stand-in
+os.environ["PATH"] = os.path.join(benchmarks_dir, "bin") + os.pathsep + \
+    os.environ["PATH"]
+
+from generate_library import generate
+from librarianlib.library import Library
+from librarianlib.ebook_search import Search, EvaluateMatch
+
+# marks the directories generated with --keep
+KEEP_MARKER = ".librarian_benchmarks"
+
+QUERIES = [
+    ("author", ["author:morgan"], EvaluateMatch.AND),
+    ("tag", ["tag:sf"], EvaluateMatch.AND),
+    ("everywhere", ["dragon"], EvaluateMatch.AND),
+    ("or", ["series:cycle", "progress:reading"], EvaluateMatch.OR),
+    ]
+
+
+def make_config(root):
+    # what open_config computes from librarian.yaml
+    config = {
+        "library_root": os.path.join(root, "library_root"),
+        "kindle_root": os.path.join(root, "kindle"),
+        "kindle_documents_subdir": "library",
+        "author_aliases": {},
+        "backup_imported_ebooks": False,
+        "interactive": False,
+        "ebook_filename_template": "$a/$a ($y) $t",
+        }
+    for folder in ["import", "library", "mobi", "imported"]:
+        config["%s_dir" % folder] = os.path.join(config["library_root"],
+                                                 folder)
+        os.makedirs(config["%s_dir" % folder], exist_ok=True)
+    config["collections"] = os.path.join(config["library_root"],
+                                         "collections.json")
+    config["fulltext_index"] = os.path.join(config["library_root"],
+                                            "fulltext.sqlite")
+    config["covers_dir"] = os.path.join(config["library_root"],
+                                        "covers")
+    config["blobs_dir"] = os.path.join(config["library_root"],
+                                       "blobs")
+    config["fsck_state"] = os.path.join(config["library_root"],
+                                        "fsck.sqlite")
+    config["similarity_cache"] = os.path.join(config["library_root"],
+                                              "similarity.pickle")
+    config["kindle_documents"] = os.path.join(config["kindle_root"],
+                                              "documents", "librarian")
+    config["kindle_extensions"] = os.path.join(config["kindle_root"],
+                                               "extensions")
+    os.makedirs(config["kindle_extensions"], exist_ok=True)
+    return config
+
+
+class Benchmarks(object):
+
+    def __init__(self, repeat, only=None):
+        self.repeat = repeat
+        self.only = only
+        self.results = {}
+
+    def measure(self, name, function, repeat=None, required=False):
+        # required steps are run anyway, since other benchmarks need them
+        if self.only is not None and \
+                not any([name.startswith(el) for el in self.only]):
+            if required:
+                with open(os.devnull, "w") as devnull, \
+                        redirect_stdout(devnull):
+                    return function()
+            return None
+        if repeat is None:
+            repeat = self.repeat
+        runs = []
+        result = None
+        for i in range(repeat):
+            with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+                start = time.perf_counter()
+                result = function()
+                runs.append(time.perf_counter() - start)
+        self.results[name] = {
+            "runs": runs,
+            "min": min(runs),
+            "median": statistics.median(runs),
+            "mean": statistics.mean(runs),
+            }
+        print(" -> %-28s median %8.3fs  min %8.3fs  (%s runs)" %
+              (name, statistics.median(runs), min(runs), repeat))
+        return result
+
+
+def open_library(config, db):
+    library = Library(config, db)
+    library.open_db()
+    return library
+
+
+def run(root, size, seed, repeat, only=None):
+    config = make_config(root)
+    db = os.path.join(root, "library.json")
+    with open(db, "w") as data_file:
+        data_file.write("{}")
+
+    print("Generating %s epubs..." % size)
+    start = time.perf_counter()
+    generate(config["library_dir"], size, seed)
+    print("Generated in %.2fs." % (time.perf_counter() - start))
+
+    bench = Benchmarks(repeat, only)
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        library = open_library(config, db)
+    # first refresh: every ebook is new and renamed
+    bench.measure("refresh_db (new library)", library.refresh_db, 1, True)
+    # random tags and progress, as in a real library
+    rng = random.Random(seed)
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        for ebook in library.ebooks:
+            for tag in rng.sample(["sf", "sf/space opera", "fantasy",
+                                   "crime", "classics", "to read"],
+                                  rng.choice([0, 0, 1, 2])):
+                ebook.add_to_collection(tag)
+            ebook.set_progress(rng.choice(["read", "read", "reading",
+                                           "unread"]))
+        library.save_db()
+
+    bench.measure("refresh_db", library.refresh_db)
+    bench.measure("save_db", library.save_db)
+    bench.measure("open_db", lambda: open_library(config, db))
+
+    for (name, conditions, and_or) in QUERIES:
+        def search():
+            s = Search(library.ebooks)
+            s.filters(conditions)
+            return s.run_search(and_or)
+        bench.measure("search/%s" % name, search, repeat * 10)
+    for (name, query) in [("range", "year:1990..2000"),
+                          ("grouped", "(tag:sf OR tag:fantasy) -dragon"),
+                          ("regex", "title:/^the (iron|light)/")]:
+        def search():
+            s = Search(library.ebooks, numeric_index=library.numeric_index)
+            s.query(query)
+            return s.run_search(EvaluateMatch.AND)
+        bench.measure("search/query %s" % name, search, repeat * 10)
+
+    bench.measure("index text (first)", library.update_text_index, 1)
+    bench.measure("index text", library.update_text_index)
+    for (name, query) in [("word", "dragon"), ("words", "iron tower"),
+                          ("phrase", '"iron tower"')]:
+        bench.measure("search/text %s" % name,
+                      lambda: library.search_text(query))
+
+    bench.measure("similar (first)",
+                  lambda: library.similar_ebooks(library.ebooks[:1]), 1)
+    bench.measure("similar",
+                  lambda: library.similar_ebooks(library.ebooks[:1]))
+    bench.measure("similar/set",
+                  lambda: library.similar_ebooks(library.ebooks[:50]))
+
+    bench.measure("fsck (first)", library.check_integrity, 1)
+    bench.measure("fsck", library.check_integrity)
+
+    export_dir = os.path.join(root, "export")
+    bench.measure("sync epub (first)",
+                  lambda: library.sync_with_kindle(
+                      kindle_sync=False, destination_dir=export_dir), 1,
+                  True)
+    bench.measure("sync epub",
+                  lambda: library.sync_with_kindle(
+                      kindle_sync=False, destination_dir=export_dir))
+    bench.measure("sync kindle (first)", library.sync_with_kindle, 1, True)
+    bench.measure("sync kindle", library.sync_with_kindle)
+    return bench.results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"],
+                                       cwd=librarian_dir,
+                                       stderr=subprocess.DEVNULL
+                                       ).decode("utf8").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(previous, current):
+    print("Compared to %s:" % (previous.get("commit", None) or "previous"))
+    for name in current["results"].keys():
+        if name not in previous["results"].keys():
+            continue
+        old = previous["results"][name]["median"]
+        new = current["results"][name]["median"]
+        print(" -> %-28s %8.3fs -> %8.3fs  (x%.2f)" %
+              (name, old, new, new / old if old > 0 else 0))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark librarian on a \
+                                     synthetic library.')
+    parser.add_argument('-n',
+                        '--size',
+                        dest='size',
+                        type=int,
+                        default=1000,
+                        help='number of ebooks in the library')
+    parser.add_argument('-r',
+                        '--repeat',
+                        dest='repeat',
+                        type=int,
+                        default=3,
+                        help='runs of each benchmark')
+    parser.add_argument('--seed',
+                        dest='seed',
+                        type=int,
+                        default=0,
+                        help='random seed of the library')
+    parser.add_argument('--only',
+                        dest='only',
+                        nargs='+',
+                        metavar="BENCHMARK",
+                        help='only run benchmarks starting with these names')
+    parser.add_argument('-o',
+                        '--output',
+                        dest='output',
+                        metavar="JSON_FILE",
+                        help='write results to this file')
+    parser.add_argument('--compare',
+                        dest='compare',
+                        metavar="JSON_FILE",
+                        help='compare with previous results')
+    parser.add_argument('--keep',
+                        dest='keep',
+                        metavar="DIR",
+                        help='generate the library in DIR, and keep it')
+    args = parser.parse_args()
+
+    if args.keep is not None:
+        root = args.keep
+        # only replacing what a previous run generated
+        if os.path.isdir(root) and os.listdir(root) != []:
+            if not os.path.exists(os.path.join(root, KEEP_MARKER)):
+                print("%s is not empty, and was not generated by a previous "
+                      "run: choose another directory." % root)
+                sys.exit(-1)
+            shutil.rmtree(root)
+        elif os.path.exists(root) and not os.path.isdir(root):
+            print("%s is not a directory." % root)
+            sys.exit(-1)
+        os.makedirs(root, exist_ok=True)
+        open(os.path.join(root, KEEP_MARKER), "w").close()
+    else:
+        root = tempfile.mkdtemp(prefix="librarian_benchmarks_")
+    try:
+        results = {
+            "commit": git_commit(),
+            "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "size": args.size,
+            "seed": args.seed,
+            "repeat": args.repeat,
+            "results": run(root, args.size, args.seed, args.repeat,
+                           args.only),
+            }
+    finally:
+        if args.keep is None:
+            shutil.rmtree(root)
+
+    if args.output is not None:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+        print("Results written to %s." % args.output)
+    if args.compare is not None:
+        with open(args.compare, "r") as previous:
+            compare(json.load(previous), results)
@@ -0,0 +1,124 @@
+import os
+import shutil
+import hashlib
+
+from .tracing import tracer
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def file_hash(path):
+    sha1 = hashlib.sha1()
+    with tracer.span("blobs.hash"), open(path, "rb") as blob:
+        for chunk in iter(lambda: blob.read(CHUNK_SIZE), b""):
+            sha1.update(chunk)
+            tracer.count("bytes_hashed", len(chunk))
+    return sha1.hexdigest()
+
+
+def temp_path(path, suffix):
+    # next to path, removing what an interrupted run may have left: it
+    # could even be a link to a blob, that must not be written through
+    temp = path + suffix
+    if os.path.lexists(temp):
+        os.remove(temp)
+    return temp
+
+
+class BlobStore(object):
+    """ Content-addressed storage: one file per distinct content, named
+    after its hash, and hardlinked from the library, the imported backups,
+    the mobi folder and the exports, so that identical ebooks only use
+    disk space once.
+    Files are never modified in place by librarian (they are replaced
+    atomically), so a change to one of the links never alters the
+    others. A blob is not used anymore when it is its only link left. """
+
+    def __init__(self, blobs_dir):
+        self.blobs_dir = blobs_dir
+
+    def blob_path(self, content_hash):
+        return os.path.join(self.blobs_dir, content_hash[:2], content_hash)
+
+    @staticmethod
+    def _replace_with_link(source, path):
+        temp = temp_path(path, ".librarian_link")
+        os.link(source, temp)
+        os.replace(temp, path)
+
+    def store(self, path, content_hash=None):
+        """ Makes path a link to the blob with the same contents, adding
+        it to the store if necessary. Returns the number of bytes saved,
+        or None if path cannot be linked (another filesystem...). """
+        if content_hash is None:
+            content_hash = file_hash(path)
+        blob = self.blob_path(content_hash)
+        try:
+            stat = os.stat(path)
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            try:
+                os.link(path, blob)
+                return 0
+            except FileExistsError:
+                pass
+            if os.path.samefile(path, blob):
+                return 0
+            self._replace_with_link(blob, path)
+        except OSError:
+            return None
+        tracer.count("blob_links")
+        # the old copy is gone, unless linked from somewhere else
+        if stat.st_nlink == 1:
+            return stat.st_size
+        return 0
+
+    def copy(self, source, content_hash, destination):
+        """ Same as shutil.copy, but links destination to the blob when
+        possible. Returns True if it was linked. """
+        if self.store(source, content_hash) is not None:
+            try:
+                self._replace_with_link(self.blob_path(content_hash),
+                                        destination)
+                tracer.count("blob_links")
+                return True
+            except OSError:
+                pass
+        # destination may be a link to a blob: replacing it rather than
+        # overwriting it
+        temp = temp_path(destination, ".librarian_copy")
+        shutil.copy(source, temp)
+        os.replace(temp, destination)
+        tracer.count("bytes_copied", os.path.getsize(destination))
+        return False
+
+    def blobs(self):
+        for root, dirs, files in os.walk(self.blobs_dir):
+            for name in files:
+                yield os.path.join(root, name)
+
+    def usage(self):
+        """ Returns (stored bytes, bytes saved by sharing blobs). """
+        stored = 0
+        saved = 0
+        for blob in self.blobs():
+            stat = os.stat(blob)
+            stored += stat.st_size
+            # every other link would be a full copy without the store
+            saved += stat.st_size * max(0, stat.st_nlink - 2)
+        return stored, saved
+
+    def gc(self):
+        """ Removes the blobs nobody links to anymore. Returns the number
+        of removed blobs and of reclaimed bytes. """
+        removed = 0
+        reclaimed = 0
+        for blob in list(self.blobs()):
+            stat = os.stat(blob)
+            if stat.st_nlink == 1:
+                os.remove(blob)
+                removed += 1
+                reclaimed += stat.st_size
+        for root, dirs, files in os.walk(self.blobs_dir, topdown=False):
+            if root != self.blobs_dir and os.listdir(root) == []:
+                os.rmdir(root)
+        return removed, reclaimed
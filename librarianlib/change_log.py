@@ -0,0 +1,90 @@
+import os
+import threading
+
+# key of the library state in the json database, which cannot collide with
+# an ebook filename
+STATE_KEY = "__librarian__"
+
+
+class ChangeLog(object):
+    """ Monotonically increasing change generation for the library.
+    Ebooks record the generation of their last change, and removed ebooks
+    are remembered so that clients can sync incrementally. """
+    MAX_REMOVED = 5000
+
+    def __init__(self, state=None):
+        if state is None:
+            state = {}
+        self.generation = state.get("generation", 0)
+        self.removed = state.get("removed", [])
+        # removals older than this have been forgotten
+        self.oldest_generation = state.get("oldest_generation", 0)
+        self.lock = threading.Lock()
+
+    def bump(self):
+        with self.lock:
+            self.generation += 1
+            return self.generation
+
+    def record_removal(self, relative_path):
+        generation = self.bump()
+        with self.lock:
+            self.removed.append({
+                "generation": generation,
+                "filename": relative_path,
+                "exported_filename":
+                    os.path.splitext(relative_path)[0] + ".mobi",
+                })
+            if len(self.removed) > self.MAX_REMOVED:
+                forgotten = self.removed[:-self.MAX_REMOVED]
+                self.oldest_generation = forgotten[-1]["generation"]
+                self.removed = self.removed[-self.MAX_REMOVED:]
+
+    def to_database_json(self):
+        return {
+            "generation": self.generation,
+            "removed": self.removed,
+            "oldest_generation": self.oldest_generation,
+            }
+
+
+class ChangeFeed(object):
+    """ Changes to the served ebooks since a given generation. """
+
+    def __init__(self, change_log, ebooks, served_path, removed_field,
+                 collections_entry):
+        self.change_log = change_log
+        self.ebooks = ebooks
+        # returns the path (relative to the server root) of an ebook
+        self.served_path = served_path
+        # "filename" or "exported_filename", depending on what is served
+        self.removed_field = removed_field
+        # returns the collections.json entry of an ebook
+        self.collections_entry = collections_entry
+
+    def changes_since(self, since):
+        changes = {
+            "generation": self.change_log.generation,
+            "since": since,
+            # some removals were forgotten, the client must start over
+            "full_resync": since < self.change_log.oldest_generation,
+            "added": [],
+            "modified": [],
+            "removed": [],
+            "collections": {},
+            }
+        for eb in sorted(self.ebooks, key=lambda x: x.filename):
+            if eb.generation <= since:
+                continue
+            path = self.served_path(eb)
+            if eb.added_generation > since:
+                changes["added"].append(path)
+            else:
+                changes["modified"].append(path)
+            changes["collections"][path] = self.collections_entry(eb)
+        served = set(changes["added"] + changes["modified"])
+        for removed in self.change_log.removed:
+            if removed["generation"] > since and \
+                    removed[self.removed_field] not in served:
+                changes["removed"].append(removed[self.removed_field])
+        return changes
@@ -0,0 +1,166 @@
+import io
+import os
+import json
+import hashlib
+import zipfile
+import threading
+import mimetypes
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from multiprocessing import cpu_count
+
+from .epub_metadata import ns, read_package, manifest_path
+from .tracing import tracer
+
+# optional, covers are kept as they are without it
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+THUMBNAIL_SIZE = (240, 360)
+THUMBNAIL_QUALITY = 80
+
+
+def find_cover(archive):
+    """ Returns the name of the cover image of an open epub archive, and
+    its media type, or (None, None). """
+    opf_name, opf = read_package(archive)
+    images = [el for el in opf.xpath("/pkg:package/pkg:manifest/pkg:item",
+                                     namespaces=ns)
+              if el.get("media-type", "").startswith("image/")]
+    cover = None
+    # epub3
+    for item in images:
+        if "cover-image" in item.get("properties", "").split():
+            cover = item
+            break
+    # epub2: <meta name="cover" content="manifest id"/>
+    if cover is None:
+        ids = opf.xpath("/pkg:package/pkg:metadata//pkg:meta[@name='cover']"
+                        "/@content", namespaces=ns)
+        cover = next((el for el in images if el.get("id") in ids), None)
+    # last resort
+    if cover is None:
+        cover = next((el for el in images
+                      if "cover" in el.get("id", "").lower() or
+                      "cover" in el.get("href", "").lower()), None)
+    if cover is None:
+        return None, None
+    name = manifest_path(opf_name, cover.get("href"))
+    if name not in archive.namelist():
+        return None, None
+    return name, cover.get("media-type")
+
+
+def make_thumbnail(data):
+    # downscaled jpeg, decoding large jpegs at a reduced size directly
+    with Image.open(io.BytesIO(data)) as image:
+        image.draft("RGB", THUMBNAIL_SIZE)
+        image = image.convert("RGB")
+        image.thumbnail(THUMBNAIL_SIZE)
+        thumbnail = io.BytesIO()
+        image.save(thumbnail, "JPEG", quality=THUMBNAIL_QUALITY,
+                   optimize=True)
+    return thumbnail.getvalue()
+
+
+class CoverCache(object):
+    """ Thumbnails of the covers of the library, named after the hash of
+    the original cover, so that they never change once created and ebooks
+    with the same cover share them. The index maps each ebook to its
+    thumbnail, with the size and mtime of the ebook when it was read. """
+
+    def __init__(self, covers_dir):
+        self.covers_dir = covers_dir
+        self.index_path = os.path.join(covers_dir, "index.json")
+        os.makedirs(covers_dir, exist_ok=True)
+        self.entries = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "r") as index:
+                self.entries = json.load(index)
+        self.names = set([el[2] for el in self.entries.values()
+                          if el[2] is not None])
+
+    def cover(self, path):
+        """ Thumbnail filename for an ebook, or None. """
+        entry = self.entries.get(path, None)
+        if entry is None:
+            return None
+        return entry[2]
+
+    def path(self, name):
+        return os.path.join(self.covers_dir, name)
+
+    def _extract(self, path):
+        with tracer.span("covers.extract"), zipfile.ZipFile(path) as archive:
+            tracer.count("zip_opens")
+            name, media_type = find_cover(archive)
+            if name is None:
+                return None
+            data = archive.read(name)
+        if Image is not None:
+            extension = ".jpg"
+        else:
+            extension = mimetypes.guess_extension(media_type) or \
+                os.path.splitext(name)[1].lower()
+        thumbnail_name = hashlib.sha1(data).hexdigest() + extension
+        target = self.path(thumbnail_name)
+        if os.path.exists(target):
+            return thumbnail_name
+        if Image is not None:
+            with tracer.span("covers.thumbnail"):
+                data = make_thumbnail(data)
+        # another thread, or process, may write the same cover
+        temp = "%s.%s.%s.tmp" % (target, os.getpid(), threading.get_ident())
+        with open(temp, "wb") as thumbnail:
+            thumbnail.write(data)
+        os.replace(temp, target)
+        tracer.count("bytes_written", len(data))
+        return thumbnail_name
+
+    def update(self, ebooks):
+        """ Extracts the covers of new and modified ebooks, and removes
+        the thumbnails nobody uses anymore. Returns the number of ebooks
+        that were read. """
+        changed = []
+        for ebook in ebooks:
+            try:
+                stat = os.stat(ebook.path)
+            except OSError:
+                continue
+            entry = self.entries.get(ebook.path, None)
+            if entry is None or entry[0] != stat.st_size or \
+                    entry[1] != stat.st_mtime:
+                changed.append((ebook.path, stat))
+        current = set([eb.path for eb in ebooks])
+        removed = [el for el in self.entries.keys() if el not in current]
+        if changed == [] and removed == []:
+            return 0
+
+        if changed != []:
+            print("Extracting covers of %s ebooks..." % len(changed))
+        with ThreadPoolExecutor(max_workers=cpu_count()) as executor:
+            future_covers = {executor.submit(self._extract, path): (path, st)
+                             for (path, st) in changed}
+            for future in as_completed(future_covers):
+                path, stat = future_covers[future]
+                try:
+                    name = future.result()
+                except Exception as err:
+                    print(" -> Cannot extract the cover of %s: %s" %
+                          (path, err))
+                    name = None
+                self.entries[path] = [stat.st_size, stat.st_mtime, name]
+        for path in removed:
+            del self.entries[path]
+
+        self.names = set([el[2] for el in self.entries.values()
+                          if el[2] is not None])
+        for name in os.listdir(self.covers_dir):
+            if name != "index.json" and name not in self.names:
+                os.remove(self.path(name))
+        temp = self.index_path + ".tmp"
+        with open(temp, "w") as index:
+            json.dump(self.entries, index)
+        os.replace(temp, self.index_path)
+        return len(changed)
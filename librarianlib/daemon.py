@@ -0,0 +1,141 @@
+import os
+import io
+import json
+import socket
+import signal
+import threading
+import socketserver
+from contextlib import redirect_stdout, redirect_stderr
+
+
+def send_command(socket_path, argv):
+    """ Runs a command line in the daemon, returns (output, exit status),
+    or None if no daemon is listening on socket_path. """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+    except OSError:
+        client.close()
+        return None
+    with client, client.makefile("rwb") as stream:
+        request = {"argv": argv, "cwd": os.getcwd()}
+        stream.write(json.dumps(request).encode("utf8") + b"\n")
+        stream.flush()
+        response = json.loads(stream.readline().decode("utf8"))
+    return response["output"], response["status"]
+
+
+class DaemonHandler(socketserver.StreamRequestHandler):
+    """ One json request per line: {"argv": [...], "cwd": "..."}, answered
+    with {"output": "...", "status": 0}. """
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line.decode("utf8"))
+                argv = request["argv"]
+                assert isinstance(argv, list)
+            except (ValueError, KeyError, AssertionError):
+                response = {"output": "Invalid request.\n", "status": -1}
+            else:
+                output, status = self.server.daemon.run(
+                    argv, request.get("cwd", None))
+                response = {"output": output, "status": status}
+            self.wfile.write(json.dumps(response,
+                                        ensure_ascii=False).encode("utf8") +
+                             b"\n")
+            self.wfile.flush()
+
+
+class DaemonServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, daemon):
+        self.daemon = daemon
+        super().__init__(socket_path, DaemonHandler)
+
+
+class LibrarianDaemon(object):
+    """ Keeps the library in memory, and runs command lines sent over a unix
+    socket. Commands run one at a time, since they print to stdout and may
+    modify the library, and changes are saved every save_interval seconds
+    and when stopping. """
+
+    def __init__(self, library, socket_path, run_command, save_interval=60,
+                 readable=False):
+        self.library = library
+        self.socket_path = socket_path
+        # run_command(library, argv) runs a command line and returns True if
+        # the library must be saved
+        self.run_command = run_command
+        self.save_interval = save_interval
+        self.readable = readable
+        self.lock = threading.Lock()
+        self.needs_saving = False
+        self.stopping = threading.Event()
+
+    def run(self, argv, cwd=None):
+        output = io.StringIO()
+        status = 0
+        with self.lock:
+            with redirect_stdout(output), redirect_stderr(output):
+                try:
+                    # relative paths are relative to the client
+                    if cwd is not None:
+                        os.chdir(cwd)
+                    if self.run_command(self.library, argv):
+                        self.needs_saving = True
+                except SystemExit as err:
+                    if isinstance(err.code, int):
+                        status = err.code
+                    elif err.code is not None:
+                        print(err.code)
+                        status = -1
+                except Exception as err:
+                    print("Error: ", err)
+                    status = -1
+        return output.getvalue(), status
+
+    def save(self):
+        with self.lock:
+            if self.needs_saving:
+                self.library.save_db(self.readable)
+                self.needs_saving = False
+
+    def _save_periodically(self):
+        while not self.stopping.wait(self.save_interval):
+            try:
+                self.save()
+            except Exception as err:
+                print("Error saving database: ", err)
+
+    def _remove_stale_socket(self):
+        if os.path.exists(self.socket_path):
+            if send_command(self.socket_path, ["--help"]) is not None:
+                raise Exception("A daemon is already listening on %s." %
+                                self.socket_path)
+            os.remove(self.socket_path)
+
+    def serve_forever(self):
+        self._remove_stale_socket()
+        server = DaemonServer(self.socket_path, self)
+        os.chmod(self.socket_path, 0o600)
+        saver = threading.Thread(target=self._save_periodically, daemon=True)
+        saver.start()
+
+        def stop(signum, frame):
+            # shutdown() waits for serve_forever, so not from this thread
+            threading.Thread(target=server.shutdown).start()
+        signal.signal(signal.SIGTERM, stop)
+
+        print("Librarian daemon listening on %s." % self.socket_path)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stopping.set()
+            server.server_close()
+            os.remove(self.socket_path)
+            self.save()
+            print("Librarian daemon stopped.")
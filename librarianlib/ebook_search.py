@@ -1,5 +1,17 @@
 from collections import defaultdict
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import cpu_count
 import re
+import time
+
+from librarianlib.query_parser import parse_query, describe, to_number, \
+    Term, Text, Range, Regex, Paths, Not, And, Or
+from librarianlib.tracing import tracer
+
+# regular expressions are searched with one process per CPU above this
+# number of ebooks
+REGEX_PROCESS_THRESHOLD = 20000
 
 
 def list_tags(ebooks):
@@ -19,44 +31,225 @@ def list_authors(ebooks):
         all_authors[author] += 1
     return all_authors
 
+
+class NumericIndex(object):
+    """ Sorted numeric values of a field (year, series_index) of the
+    ebooks, for range queries. """
+
+    def __init__(self, ebooks, field):
+        pairs = []
+        for ebook in ebooks:
+            for value in ebook.librarian_metadata.get_values(field):
+                number = to_number(value or "")
+                if number is not None:
+                    pairs.append((number, ebook.path))
+        pairs.sort()
+        self.values = [el[0] for el in pairs]
+        self.paths = [el[1] for el in pairs]
+
+    def between(self, low=None, high=None, low_inclusive=True,
+                high_inclusive=True):
+        """ Paths of the ebooks with a value in the range. """
+        start = 0
+        if low is not None:
+            if low_inclusive:
+                start = bisect_left(self.values, low)
+            else:
+                start = bisect_right(self.values, low)
+        end = len(self.values)
+        if high is not None:
+            if high_inclusive:
+                end = bisect_right(self.values, high)
+            else:
+                end = bisect_left(self.values, high)
+        return set(self.paths[start:end])
+
+
+def searchable_values(ebook, field=None):
+    # the values match_this looks at
+    if field == "progress":
+        return [ebook.read.name]
+    if field == "tag":
+        return list(ebook.tags)
+    if field is not None:
+        return [el for el in ebook.librarian_metadata.get_values(field)
+                if el is not None]
+    values = []
+    for key in ebook.librarian_metadata.keys:
+        values.extend([el for el in ebook.librarian_metadata.get_values(key)
+                       if el is not None])
+    return values + list(ebook.tags) + [ebook.read.name]
+
+
+def regex_shard(regex, values):
+    # values: [(path, [strings])]
+    return [path for (path, strings) in values
+            if any([regex.search(el) for el in strings])]
+
+
+def regex_matches(regex, ebooks, field=None):
+    """ Paths of the ebooks with a value of field matching the compiled
+    regular expression, split across processes for large libraries. """
+    with tracer.span("search.regex"):
+        values = [(eb.path, searchable_values(eb, field)) for eb in ebooks]
+        workers = cpu_count()
+        if len(values) < REGEX_PROCESS_THRESHOLD or workers == 1:
+            return set(regex_shard(regex, values))
+        size = len(values) // workers + 1
+        shards = [values[i:i + size] for i in range(0, len(values), size)]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = executor.map(regex_shard, [regex] * len(shards),
+                                   shards)
+            return set([path for paths in results for path in paths])
+
+
 class Search(object):
     """ This class builds a EvaluateMatch object from input conditions,
-    then loops on all ebooks to pick out the ones who match. """
-    def __init__(self, everything, is_exact=False):
+    then loops on all ebooks to pick out the ones who match.
+    text: conditions are run against the full-text index, with text_search,
+    which returns {path: score}. Range queries use numeric_index, which
+    returns a NumericIndex for a field.
+    With explain, the evaluation of every condition is profiled, and
+    slow_query_log is called with the search once it has run. """
+    def __init__(self, everything, is_exact=False, text_search=None,
+                 numeric_index=None, explain=False, slow_query_log=None):
         self.everything = everything
         self.is_exact = is_exact
-        self.evaluate_match = EvaluateMatch()
+        self.evaluate_match = EvaluateMatch(explain)
         self.field_search = re.compile("^([^:]*):(.*)$")
+        self.text_search = text_search
+        self.numeric_index = numeric_index
+        self.numeric_indexes = {}
+        self.slow_query_log = slow_query_log
+        # BM25 scores of the ebooks matching text: conditions
+        self.text_scores = {}
+        # descriptions of the conditions, for --explain and the log
+        self.conditions = []
+        self.exclusions = []
+        # time spent using indexes before the evaluation
+        self.prepare_time = 0.0
+        self.mode = None
+        self.duration = None
+        self.results = None
+
+    def _text_matches(self, value):
+        if self.text_search is None:
+            print("Full-text search is not available.")
+            return set()
+        scores = self.text_search(value)
+        for (path, score) in scores.items():
+            self.text_scores[path] = self.text_scores.get(path, 0) + score
+        return set(scores.keys())
+
+    def _term(self, term):
+        fields = self.field_search.findall(term)
+        if fields == []:
+            return Term(None, term)
+        elif fields[0][0] == "text":
+            return Text(fields[0][1])
+        return Term(*fields[0])
 
     def excludes(self, exclude_list):
         for exclude_term in exclude_list:
-            fields = self.field_search.findall(exclude_term)
-            if fields == []:
-                self.evaluate_match.add_exclude_condition(exclude_term, None,
-                                                          self.is_exact)
-            else:
-                field, value = fields[0]
-                self.evaluate_match.add_exclude_condition(value, field,
-                                                          self.is_exact)
+            node = self._term(exclude_term)
+            self.exclusions.append(describe(node))
+            self.evaluate_match.add_exclude_expression(
+                Not(self._resolve(node)), self.is_exact)
 
     def filters(self, filter_list):
         for filter_term in filter_list:
-            fields = self.field_search.findall(filter_term)
-            if fields == []:
-                self.evaluate_match.add_condition(filter_term, None,
-                                                  self.is_exact)
+            node = self._term(filter_term)
+            self.conditions.append(describe(node))
+            self.evaluate_match.add_expression(self._resolve(node),
+                                               self.is_exact)
+
+    def _range_matches(self, node):
+        if self.numeric_index is not None:
+            index = self.numeric_index(node.field)
+        else:
+            if node.field not in self.numeric_indexes.keys():
+                self.numeric_indexes[node.field] = NumericIndex(
+                    self.everything, node.field)
+            index = self.numeric_indexes[node.field]
+        return index.between(node.low, node.high, node.low_inclusive,
+                             node.high_inclusive)
+
+    def _resolve(self, node):
+        # replaces the conditions that are not evaluated ebook by ebook
+        if isinstance(node, (Text, Range, Regex)):
+            start = time.perf_counter()
+            if isinstance(node, Text):
+                paths = self._text_matches(node.value)
+                method = "full-text index"
+            elif isinstance(node, Range):
+                paths = self._range_matches(node)
+                method = "numeric index"
             else:
-                field, value = fields[0]
-                self.evaluate_match.add_condition(value, field, self.is_exact)
+                paths = regex_matches(node.regex, self.everything,
+                                      node.field)
+                method = "regex scan"
+            seconds = time.perf_counter() - start
+            self.prepare_time += seconds
+            return Paths(paths, node, method, seconds)
+        if isinstance(node, Not):
+            return Not(self._resolve(node.child))
+        if isinstance(node, (And, Or)):
+            return node.__class__([self._resolve(el)
+                                   for el in node.children])
+        return node
+
+    def query(self, query):
+        """ Adds a condition from a query such as
+        (tag:sf OR tag:fantasy) year:1990..2000 NOT author:/^a/
+        Raises QueryError if it cannot be parsed. """
+        with tracer.span("search.parse"):
+            tree = parse_query(query)
+            self.conditions.append(describe(tree))
+            tree = self._resolve(tree)
+        self.evaluate_match.add_expression(tree, self.is_exact)
+
+    @property
+    def description(self):
+        operator = " OR " if self.mode == EvaluateMatch.OR else " AND "
+        return operator.join(self.conditions) + \
+            "".join([" NOT %s" % el for el in self.exclusions])
 
     # EvaluateMatch.OR / EvaluateMatch.AND
     def run_search(self, and_or):
         filtered = []
-        for ebook in self.everything:
-            if self.evaluate_match.is_a_match(ebook, and_or):
-                filtered.append(ebook)
+        start = time.perf_counter()
+        with tracer.span("search.run"):
+            for ebook in self.everything:
+                if self.evaluate_match.is_a_match(ebook, and_or):
+                    filtered.append(ebook)
+            tracer.count("ebooks_searched", len(self.everything))
+        self.mode = and_or
+        self.duration = time.perf_counter() - start
+        self.results = len(filtered)
+        if self.slow_query_log is not None:
+            self.slow_query_log(self)
         return filtered
 
+    def explain(self):
+        """ What run_search did, condition by condition. """
+        lines = ["Query: %s" % self.description,
+                 "Evaluated on %s ebooks in %.1fms (and %.1fms using "
+                 "indexes): %s results." % (len(self.everything),
+                                            1000 * self.duration,
+                                            1000 * self.prepare_time,
+                                            self.results),
+                 "  %-36s %-16s %9s %9s %10s %8s" % (
+                     "condition", "method", "index", "eval", "candidates",
+                     "matched")]
+        for profile in self.evaluate_match.profiles:
+            description = "  " * profile.depth + profile.description
+            if len(description) > 36:
+                description = description[:33] + "..."
+            lines.append("  %-36s %-16s %7.1fms %7.1fms %10s %8s" % (
+                description, profile.method, 1000 * profile.prepare_time,
+                1000 * profile.time, profile.candidates, profile.matched))
+        return "\n".join(lines)
+
     @property
     def number_of_results(self):
         return len(self.filtered)
@@ -118,37 +311,113 @@ def match_this(ebook, value, field=None, exact=False):
                                       for val in field_value]))
 
 
+class ConditionProfile(object):
+    """ How a condition was evaluated, for --explain. Times include the
+    conditions it contains. """
+
+    def __init__(self, node, depth):
+        self.description = describe(node)
+        self.depth = depth
+        self.prepare_time = 0.0
+        if isinstance(node, Paths):
+            self.method = node.method
+            self.prepare_time = node.seconds
+        elif isinstance(node, Term) and node.field is None:
+            self.method = "scan all fields"
+        elif isinstance(node, Term):
+            self.method = "scan"
+        else:
+            self.method = "combine"
+        self.time = 0
+        self.candidates = 0
+        self.matched = 0
+
+    def wrap(self, condition):
+        def profiled(ebook):
+            start = time.perf_counter()
+            result = condition(ebook)
+            self.time += time.perf_counter() - start
+            self.candidates += 1
+            if result:
+                self.matched += 1
+            return result
+        return profiled
+
+
 class EvaluateMatch(object):
     """ This class builds a list of conditions, that are evaluated when
-    is_a_match is passed with an actual Epub object. """
+    is_a_match is passed with an actual Epub object. Conditions are
+    evaluated in order, until one decides. """
     OR = 1
     AND = 2
 
-    def __init__(self):
+    def __init__(self, explain=False):
         self.full_expression = []
         self.exclude_expression = []
+        # ConditionProfile of every condition, when explaining
+        self.explain = explain
+        self.full_profiles = []
+        self.exclude_profiles = []
 
     def add_condition(self, value, field=None, is_exact=False):
-        self.full_expression.append(lambda x:
-                                    match_this(x, value, field, is_exact))
+        self.add_expression(Term(field, value), is_exact)
 
     def add_exclude_condition(self, value, field=None, is_exact=False):
-        self.exclude_expression.append(lambda x:
-                                       not match_this(x, value, field,
-                                                      is_exact))
+        self.add_exclude_expression(Not(Term(field, value)), is_exact)
+
+    def add_path_condition(self, paths):
+        self.add_expression(Paths(paths))
+
+    def add_exclude_path_condition(self, paths):
+        self.add_exclude_expression(Not(Paths(paths)))
+
+    @property
+    def profiles(self):
+        # in the order they are evaluated
+        return self.full_profiles + self.exclude_profiles
+
+    def _compile(self, node, is_exact, profiles, depth=0):
+        profile = None
+        if self.explain:
+            profile = ConditionProfile(node, depth)
+            profiles.append(profile)
+        if isinstance(node, Term):
+            condition = lambda x: match_this(x, node.value, node.field,
+                                             is_exact)
+        elif isinstance(node, Paths):
+            condition = lambda x: x.path in node.paths
+        elif isinstance(node, Not):
+            child = self._compile(node.child, is_exact, profiles,
+                                  depth + 1)
+            condition = lambda x: not child(x)
+        else:
+            children = [self._compile(el, is_exact, profiles, depth + 1)
+                        for el in node.children]
+            if isinstance(node, And):
+                condition = lambda x: all(f(x) for f in children)
+            else:
+                condition = lambda x: any(f(x) for f in children)
+        if profile is not None:
+            return profile.wrap(condition)
+        return condition
+
+    def add_expression(self, tree, is_exact=False):
+        """ Adds a parsed query, whose text, range and regex conditions
+        were already replaced by the paths they match. """
+        self.full_expression.append(self._compile(tree, is_exact,
+                                                  self.full_profiles))
 
-    def _evaluate(self, epub):
-        evaluated = [f(epub) for f in self.full_expression]
-        exclude_evaluated = [f(epub) for f in self.exclude_expression]
-        return evaluated, exclude_evaluated
+    def add_exclude_expression(self, tree, is_exact=False):
+        self.exclude_expression.append(self._compile(
+            tree, is_exact, self.exclude_profiles))
 
     def apply_and_condition_to_epub(self, epub):
-        evaluated, exclude_evaluated = self._evaluate(epub)
-        return all(evaluated) and all(exclude_evaluated)
+        return all(f(epub) for f in self.full_expression) and \
+            all(f(epub) for f in self.exclude_expression)
 
     def apply_or_condition_to_epub(self, epub):
-        evaluated, exclude_evaluated = self._evaluate(epub)
-        return any(evaluated) and all(exclude_evaluated)
+        return any(f(epub) for f in self.full_expression) and \
+            all(f(epub) for f in self.exclude_expression)
 
     def is_a_match(self, epub, and_or):
         if and_or == self.AND:
@@ -3,10 +3,16 @@ import shutil
 import os
 import subprocess
 import hashlib
+import sys
 import zipfile
-from lxml import etree
 from enum import Enum
-from .epub_metadata import OpfFile, FakeOpfFile, ns
+from functools import lru_cache
+from .epub_metadata import OpfFile, FakeOpfFile, ns, METADATA_ALIASES
+from .epub_metadata import load_lxml
+from .metadata_store import StoredMetadata
+from .zip_rewrite import rewrite_zip, fingerprint as zip_fingerprint
+from .filename_template import compile_template
+from .tracing import tracer, traced
 
 try:
     from colorama import init
@@ -33,6 +39,16 @@ except:
 
 
 def has_changed(f, *args):
+    def new_f(*args):
+        res = f(*args)
+        if res:
+            args[0].mark_as_changed()
+        return res
+    return new_f
+
+
+def needs_saving(f, *args):
+    # for bookkeeping changes that do not affect the ebook itself
     def new_f(*args):
         res = f(*args)
         if res:
@@ -47,14 +63,22 @@ def strip_lower(f, *args):
         f(args[0], tag)
     return new_f
 
-AUTHORIZED_TEMPLATE_PARTS = {
-    "$a": "author",
-    "$y": "year",
-    "$t": "title",
-    "$s": "series",
-    "$i": "series_index",
-    "$p": "progress",
-}
+
+@lru_cache(maxsize=1)
+def calibre_is_available():
+    # only checked before the first conversion, calibre is slow to start
+    try:
+        return subprocess.call(["ebook-convert", "--version"],
+                               stdout=subprocess.DEVNULL) == 0
+    except OSError:
+        return False
+
+
+def check_calibre():
+    if not calibre_is_available():
+        raise Exception("Calibre must be installed for epub <-> mobi "
+                        "conversions!")
+
 
 class ReadStatus(Enum):
     unread = 0
@@ -63,6 +87,15 @@ class ReadStatus(Enum):
 
 
 class Epub(object):
+    __slots__ = ("path", "library_dir", "author_aliases",
+                 "librarian_metadata", "ebook_metadata", "is_opf_open",
+                 "metadata_filename", "temp_dir", "temp_opf", "tags",
+                 "has_changed", "template", "was_converted_to_mobi",
+                 "converted_to_mobi_from_hash", "converted_to_mobi_hash",
+                 "last_synced_hash", "read", "change_log", "generation",
+                 "added_generation", "filename_cache", "fingerprint",
+                 "converted_to_mobi_from_fingerprint",
+                 "last_synced_fingerprint")
 
     def __init__(self, path, library_dir, author_aliases,
                  ebook_filename_template):
@@ -77,13 +110,20 @@ class Epub(object):
 
         self.tags = []
         self.has_changed = False
-        self.loaded_metadata = None
         self.template = ebook_filename_template
         self.was_converted_to_mobi = False
         self.converted_to_mobi_from_hash = ""
         self.converted_to_mobi_hash = ""
         self.last_synced_hash = ""
+        # cheap fingerprints of the zip archive, along with the hashes
+        self.fingerprint = ""
+        self.converted_to_mobi_from_fingerprint = ""
+        self.last_synced_fingerprint = ""
         self.read = ReadStatus(0)
+        self.change_log = None
+        self.generation = 0
+        self.added_generation = 0
+        self.filename_cache = (None, None)
 
     def __enter__(self):
         return self
@@ -127,6 +167,15 @@ class Epub(object):
         else:
             return read(str)
 
+    def mark_as_changed(self):
+        self.has_changed = True
+        if self.change_log is not None:
+            self.generation = self.change_log.bump()
+
+    def mark_as_new(self):
+        self.mark_as_changed()
+        self.added_generation = self.generation
+
     @property
     def extension(self):
         # extension without the .
@@ -134,39 +183,59 @@ class Epub(object):
 
     @property
     def current_hash(self):
-        return hashlib.sha1(open(self.path, 'rb').read()).hexdigest()
+        with tracer.span("epub.hash"):
+            data = open(self.path, 'rb').read()
+            tracer.count("bytes_hashed", len(data))
+            return hashlib.sha1(data).hexdigest()
+
+    @property
+    def current_fingerprint(self):
+        return zip_fingerprint(self.path)
+
+    def has_contents(self, content_hash, fingerprint):
+        """ True if the ebook still has the contents it had when it had
+        this hash and fingerprint, only hashing it if the fingerprint
+        cannot tell. """
+        current = self.current_fingerprint
+        if current is None or fingerprint == "":
+            return self.current_hash == content_hash
+        return current == fingerprint
 
     def set_filename_template(self, template):
         self.template = template
 
     @property
     def filename(self):
-        template = self.template
-        for key in AUTHORIZED_TEMPLATE_PARTS.keys():
-            relevant_parts = self.librarian_metadata.get_values(
-                AUTHORIZED_TEMPLATE_PARTS[key])
-            if len(relevant_parts) >= 1:
-                template = template.replace(key, relevant_parts[0])
-            elif AUTHORIZED_TEMPLATE_PARTS[key] == "progress":
-                template = template.replace(key, self.read.name)
-        template = template.replace(":", "").replace("?", "")
-        return "%s.%s" % (template, self.extension)
+        # only rendered again if metadata or progress have changed
+        metadata = self.librarian_metadata
+        key = (id(metadata), metadata.revision, self.read, self.template,
+               self.path)
+        if self.filename_cache[0] != key:
+            filename = compile_template(self.template).render(metadata,
+                                                              self.read.name)
+            self.filename_cache = (key, "%s.%s" % (filename, self.extension))
+        return self.filename_cache[1]
 
     @property
     def exported_filename(self):
         return os.path.splitext(self.filename)[0] + ".mobi"
 
-    def load_from_database_json(self, filename_dict, filename):
+    def load_from_database_json(self, filename_dict, filename,
+                                metadata_store=None):
         if not os.path.exists(filename_dict["path"]):
             print("File %s in DB cannot be found, ignoring." %
                   filename_dict["path"])
             return False
         try:
-            self.loaded_metadata = filename_dict
             # for similar interface to OpfFile
-            self.librarian_metadata = FakeOpfFile(filename_dict['metadata'],
-                                        self.author_aliases)
-            self.tags = [el.lower().strip()
+            if metadata_store is None:
+                self.librarian_metadata = FakeOpfFile(
+                    filename_dict['metadata'], self.author_aliases)
+            else:
+                self.librarian_metadata = StoredMetadata(
+                    metadata_store, filename_dict['metadata'],
+                    self.author_aliases)
+            self.tags = [sys.intern(el.lower().strip())
                          for el in filename_dict['tags'].split(",")
                          if el.strip() != ""]
             self.converted_to_mobi_hash = \
@@ -174,27 +243,48 @@ class Epub(object):
             self.converted_to_mobi_from_hash = \
                 filename_dict['converted_to_mobi_from_hash']
             self.last_synced_hash = filename_dict['last_synced_hash']
+            self.fingerprint = filename_dict.get('fingerprint', "")
+            self.converted_to_mobi_from_fingerprint = filename_dict.get(
+                'converted_to_mobi_from_fingerprint', "")
+            self.last_synced_fingerprint = filename_dict.get(
+                'last_synced_fingerprint', "")
             self.read = ReadStatus(int(filename_dict['read']))
+            self.generation = filename_dict.get('generation', 0)
+            self.added_generation = filename_dict.get('added_generation', 0)
         except Exception as err:
             print("Incorrect db!", err)
+            self.release_metadata()
             return False
         return True
 
+    def release_metadata(self):
+        """ Frees the row of a MetadataStore the metadata are kept in, once
+        the ebook has left the library. A copy is kept for as long as the
+        ebook is still referenced. """
+        if isinstance(self.librarian_metadata, StoredMetadata):
+            values = self.librarian_metadata.metadata_dict
+            self.librarian_metadata.release()
+            self.librarian_metadata = FakeOpfFile(values, self.author_aliases)
+
     def to_database_json(self):
-        if self.has_changed:
-            return {
-                "path": self.path,
-                "tags": ",".join(sorted([el for el in self.tags
-                                        if el.strip() != ""])),
-                "last_synced_hash": self.last_synced_hash,
-                "converted_to_mobi_hash": self.converted_to_mobi_hash,
-                "converted_to_mobi_from_hash":
-                    self.converted_to_mobi_from_hash,
-                "metadata": self.librarian_metadata.metadata_dict,
-                "read": self.read.value
-                }
-        else:
-            return self.loaded_metadata
+        # the entry loaded from the database is not kept, to save memory
+        return {
+            "path": self.path,
+            "tags": ",".join(sorted([el for el in self.tags
+                                    if el.strip() != ""])),
+            "last_synced_hash": self.last_synced_hash,
+            "converted_to_mobi_hash": self.converted_to_mobi_hash,
+            "converted_to_mobi_from_hash":
+                self.converted_to_mobi_from_hash,
+            "fingerprint": self.fingerprint,
+            "last_synced_fingerprint": self.last_synced_fingerprint,
+            "converted_to_mobi_from_fingerprint":
+                self.converted_to_mobi_from_fingerprint,
+            "metadata": self.librarian_metadata.metadata_dict,
+            "read": self.read.value,
+            "generation": self.generation,
+            "added_generation": self.added_generation,
+            }
 
     def open_ebook_metadata(self):
         if not self.is_opf_open:
@@ -202,11 +292,13 @@ class Epub(object):
             self.extract_opf_file()
             self.is_opf_open = True
 
+    @traced("epub.read_opf")
     def extract_opf_file(self):
         zip = zipfile.ZipFile(self.path)
+        tracer.count("zip_opens")
         # find the contents metafile
         txt = zip.read('META-INF/container.xml')
-        tree = etree.fromstring(txt)
+        tree = load_lxml().fromstring(txt)
 
         self.metadata_filename = tree.xpath(
             'n:rootfiles/n:rootfile/@full-path',
@@ -223,26 +315,13 @@ class Epub(object):
         if self.librarian_metadata is None:
             self.librarian_metadata = self.ebook_metadata
 
-    def remove_from_zip(self, zipfname, *filenames):
-        tempdir = tempfile.mkdtemp()
-        try:
-            tempname = os.path.join(tempdir, 'new.zip')
-            with zipfile.ZipFile(zipfname, 'r') as zipread:
-                with zipfile.ZipFile(tempname, 'w') as zipwrite:
-                    for item in zipread.infolist():
-                        if item.filename not in filenames:
-                            data = zipread.read(item.filename)
-                            zipwrite.writestr(item, data)
-            shutil.move(tempname, zipfname)
-        finally:
-            shutil.rmtree(tempdir)
-
     def save_metadata(self):
         if self.is_opf_open and self.ebook_metadata.has_changed:
             print("Saving epub...")
-            self.remove_from_zip(self.path, self.metadata_filename)
-            with zipfile.ZipFile(self.path, 'a') as z:
-                z.write(self.temp_opf, arcname=self.metadata_filename)
+            with tracer.span("epub.write_opf"), \
+                    open(self.temp_opf, "rb") as opf:
+                rewrite_zip(self.path, {self.metadata_filename: opf.read()})
+            self.fingerprint = self.current_fingerprint or ""
 
     def close_metadata(self):
         if self.is_opf_open:
@@ -251,27 +330,32 @@ class Epub(object):
             self.__exit__(None, None, None)
 
     def sync_ebook_metadata(self):
-        print("Writing metadata to ebook file is disabled for now.")
-        return False
-
         self.open_ebook_metadata()
-        # TODO: clear ebook_metadata ??
+        if self.librarian_metadata is self.ebook_metadata:
+            # nothing to sync
+            self.close_metadata()
+            return []
 
-        # copy to ebook_metadata
+        # copy to ebook_metadata, serializing the opf only once
+        self.ebook_metadata.begin()
         for key in self.librarian_metadata.keys:
-            values = self.librarian_metadata.get_values(key)
-            for value in values:
-                self.ebook_metadata.set_value(key, value, replace=True)
-        self.ebook_metadata.has_changed = True
-        #TODO: go through ebook_metadata and set all values to opf
-        self.save_metadata()
+            # aliases and epub3 meta elements are not metadata fields
+            if key in METADATA_ALIASES.keys() or key == "meta":
+                continue
+            values = [el for el in self.librarian_metadata.get_values(key)
+                      if el is not None]
+            self.ebook_metadata.set_values(key, values)
+        changes = self.ebook_metadata.commit()
+        if changes != []:
+            self.save_metadata()
         self.close_metadata()
+        return changes
 
     @strip_lower
     @has_changed
     def add_to_collection(self, tag):
         if tag != "" and tag not in self.tags:
-            self.tags.append(tag)
+            self.tags.append(sys.intern(tag))
             return True
         return False
 
@@ -287,52 +371,58 @@ class Epub(object):
         return path.split(self.library_dir)[1][1:]
 
     @has_changed
-    def rename_from_metadata(self, force=False):
-        # open ebook metadata if necessary or forced
-        self.open_ebook_metadata()
-        if self.librarian_metadata.is_complete and self.library_dir in self.path:
-            new_name = os.path.join(self.library_dir, self.filename)
-            if new_name != self.path:
-                if not os.path.exists(os.path.dirname(new_name)):
-                    print("Creating directory",
-                          self.get_relative_path(os.path.dirname(new_name)))
-                    os.makedirs(os.path.dirname(new_name))
-                print("Renaming to ", self.get_relative_path(new_name))
-                shutil.move(self.path, new_name)
-                # refresh name
-                self.path = new_name
-                return True
-        return False
+    def moved_to(self, new_path):
+        if self.change_log is not None:
+            self.change_log.record_removal(self.get_relative_path(self.path))
+        # refresh name
+        self.path = new_path
+        return True
 
     @has_changed
     def export_to_mobi(self, mobi_dir):
         output_filename = os.path.join(mobi_dir, self.exported_filename)
         if os.path.exists(output_filename):
             # check if ebook has changed since the mobi was created
-            if self.current_hash == self.converted_to_mobi_from_hash:
+            if self.has_contents(self.converted_to_mobi_from_hash,
+                                 self.converted_to_mobi_from_fingerprint):
+                if self.converted_to_mobi_from_fingerprint == "":
+                    self.converted_to_mobi_from_fingerprint = \
+                        self.current_fingerprint or ""
                 self.was_converted_to_mobi = True
                 return False
 
         if not os.path.exists(os.path.dirname(output_filename)):
             print("Creating directory", os.path.dirname(output_filename))
-            os.makedirs(os.path.dirname(output_filename))
+            # other conversions may be creating it at the same time
+            os.makedirs(os.path.dirname(output_filename), exist_ok=True)
 
         # conversion
+        check_calibre()
+        if os.path.exists(output_filename):
+            # it may be linked to a deduplicated file
+            os.remove(output_filename)
         print("   + Converting to .mobi: ", self.filename)
-        subprocess.check_call(['ebook-convert',
-                               self.path,
-                               output_filename,
-                               "--output-profile",
-                               "kindle_pw"], stdout=subprocess.DEVNULL)
-
-        self.converted_to_mobi_hash = \
-            hashlib.sha1(open(output_filename, 'rb').read()).hexdigest()
+        tracer.count("conversions")
+        with tracer.span("epub.convert_to_mobi"):
+            subprocess.check_call(['ebook-convert',
+                                   self.path,
+                                   output_filename,
+                                   "--output-profile",
+                                   "kindle_pw"], stdout=subprocess.DEVNULL)
+
+        with tracer.span("epub.hash"):
+            data = open(output_filename, 'rb').read()
+            tracer.count("bytes_hashed", len(data))
+            self.converted_to_mobi_hash = hashlib.sha1(data).hexdigest()
         self.converted_to_mobi_from_hash = self.current_hash
+        self.converted_to_mobi_from_fingerprint = \
+            self.current_fingerprint or ""
         self.was_converted_to_mobi = True
         return True
 
-    @has_changed
-    def sync_with_kindle(self, destination_dir, mobi_dir=None):
+    @needs_saving
+    def sync_with_kindle(self, destination_dir, mobi_dir=None,
+                         blob_store=None):
         if mobi_dir is not None and not self.was_converted_to_mobi:
             self.export_to_mobi(mobi_dir)
 
@@ -350,74 +440,51 @@ class Epub(object):
 
         # check if exists and with latest hash
         already_synced_epub = (mobi_dir is None and
-                               self.last_synced_hash == self.current_hash)
+                               self.has_contents(
+                                   self.last_synced_hash,
+                                   self.last_synced_fingerprint))
         already_synced_mobi = (mobi_dir is not None and
                                self.last_synced_hash ==
                                self.converted_to_mobi_hash)
         if (os.path.exists(output_filename) and
            (already_synced_mobi or already_synced_epub)):
+                if already_synced_epub and \
+                        self.last_synced_fingerprint == "":
+                    # hashed this time, the fingerprint will do next time
+                    self.last_synced_fingerprint = \
+                        self.current_fingerprint or ""
+                    self.has_changed = True
                 print("   - Skipping already synced ebook: ", self.filename,
                       flush=True)
                 return False
 
         print("   + Syncing: ", self.filename, flush=True)
 
-        if mobi_dir is None:
-            shutil.copy(os.path.join(self.library_dir, self.filename),
-                        output_filename)
-            self.last_synced_hash = self.current_hash
-        else:
-            shutil.copy(os.path.join(mobi_dir, self.exported_filename),
-                        output_filename)
-            self.last_synced_hash = self.converted_to_mobi_hash
+        with tracer.span("epub.copy"):
+            if mobi_dir is None:
+                source = os.path.join(self.library_dir, self.filename)
+                content_hash = self.current_hash
+                self.last_synced_fingerprint = \
+                    self.current_fingerprint or ""
+            else:
+                source = os.path.join(mobi_dir, self.exported_filename)
+                content_hash = self.converted_to_mobi_hash
+            if blob_store is not None:
+                blob_store.copy(source, content_hash, output_filename)
+            else:
+                # never writing through a link to a deduplicated file
+                if os.path.exists(output_filename):
+                    os.remove(output_filename)
+                shutil.copy(source, output_filename)
+                tracer.count("bytes_copied",
+                             os.path.getsize(output_filename))
+            self.last_synced_hash = content_hash
         return True
 
     def info(self, field_list=None):
         return str(self) + "\n" + "-"*len(str(self)) + "\n" + \
             self.librarian_metadata.show_fields(field_list)
 
-    def write_metadata(self, key, value):
-        if key not in self.librarian_metadata.keys:
-            print("Adding new metadata field", key)
-        self.librarian_metadata.set_value(key, value)
-
-    @has_changed
-    def update_metadata(self, update_list):
-        # force metadata refresh
-        if not self.is_opf_open:
-            self.open_ebook_metadata()
-
-        changes = ""
-        for part in update_list:
-            try:
-                key, value = part.split(":")
-                # TODO: get all values for field
-                old_values = self.librarian_metadata.get_values(key)
-                if value.title() not in old_values:
-                    # TODO: list of unique fields
-                    changes += "%s  -> %s\n" % (old_values, value.title())
-                    self.write_metadata(key, value.title())
-
-            except Exception as err:
-                print("Error writing metadata", part, ":", err)
-                continue  # ignore this part only
-
-        if changes == "":
-            print("No change detected.")
-            return  # nothing to do
-
-        print("Updating epub metadata:")
-        print(changes)
-
-        answer = input("Confirm update? y/n ").lower()
-        if answer == 'y':
-            print("Saving changes.")
-            print(self.info())
-            return True
-        else:
-            print("Discarding changes, nothing will be saved.")
-            return False
-
     @has_changed
     def set_progress(self, read_value):
         if read_value not in ReadStatus.__members__.keys():
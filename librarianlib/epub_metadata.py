@@ -1,5 +1,10 @@
-from lxml import etree
-from collections import defaultdict
+from collections import defaultdict, namedtuple
+import copy
+import sys
+import posixpath
+from urllib.parse import unquote
+
+from .tracing import tracer
 
 ns = {
     'n': 'urn:oasis:names:tc:opendocument:xmlns:container',
@@ -12,6 +17,43 @@ METADATA_ALIASES = {
     "author": "creator",
     }
 
+# fields that are stored as <meta name="calibre:..."> in the opf
+CALIBRE_FIELDS = ["series", "series_index"]
+
+# values repeated across ebooks, kept in memory only once
+SHARED_FIELDS = frozenset(["creator", "author", "date", "year", "subject",
+                           "series", "series_index", "language", "publisher",
+                           "contributor", "type", "format", "rights"])
+
+MetadataChange = namedtuple("MetadataChange", ["field", "old", "new"])
+
+# lxml is slow to import, and only needed once an epub is opened
+etree = None
+
+
+def load_lxml():
+    global etree
+    if etree is None:
+        from lxml import etree as lxml_etree
+        etree = lxml_etree
+    return etree
+
+
+def read_package(archive):
+    """ Returns the name of the opf file of an open epub archive, and its
+    parsed contents. """
+    load_lxml()
+    container = etree.fromstring(archive.read("META-INF/container.xml"))
+    opf_name = container.xpath("n:rootfiles/n:rootfile/@full-path",
+                               namespaces=ns)[0]
+    return opf_name, etree.fromstring(archive.read(opf_name))
+
+
+def manifest_path(opf_name, href):
+    # hrefs are relative to the opf file, and url-encoded
+    return posixpath.normpath(posixpath.join(posixpath.dirname(opf_name),
+                                             unquote(href)))
+
 
 def sanitize(name, result, author_aliases):
     if name in METADATA_ALIASES.keys():
@@ -39,11 +81,30 @@ def sanitize(name, result, author_aliases):
     return result
 
 
+def intern_values(name, values):
+    if name not in SHARED_FIELDS:
+        return values
+    try:
+        return list(map(sys.intern, values))
+    except TypeError:
+        # None values
+        return [sys.intern(el) if isinstance(el, str) else el
+                for el in values]
+
+
 class EbookMetadata(object):
+    __slots__ = ("author_aliases", "has_changed", "revision", "changes",
+                 "in_transaction", "snapshot")
+
     def __init__(self, author_aliases):
         self.author_aliases = author_aliases
-        self.metadata_dict = defaultdict(list)
         self.has_changed = False
+        # incremented with every change
+        self.revision = 0
+        # changes since the beginning of the current transaction
+        self.changes = []
+        self.in_transaction = False
+        self.snapshot = None
 
     @property
     def is_empty(self):
@@ -71,31 +132,101 @@ class EbookMetadata(object):
     def __str__(self):
         return self.show_fields()
 
+    def begin(self):
+        # changes are only written when the transaction is committed
+        self.in_transaction = True
+        self.changes = []
+        self.snapshot = self._save_state()
+
+    def commit(self):
+        changes = self.changes
+        self.in_transaction = False
+        self.snapshot = None
+        self.changes = []
+        if changes != []:
+            self.write()
+        return changes
+
+    def rollback(self):
+        if self.snapshot is not None:
+            self._restore_state(self.snapshot)
+            self.revision += 1
+        self.in_transaction = False
+        self.snapshot = None
+        self.changes = []
+
+    def _record_change(self, name, old_values):
+        new_values = list(self.get_values(name))
+        if new_values == old_values:
+            return False
+        self.changes.append(MetadataChange(name, old_values, new_values))
+        self.has_changed = True
+        self.revision += 1
+        if not self.in_transaction:
+            self.changes = []
+            self.write()
+        return True
+
+    def write(self):
+        pass
+
 
 class FakeOpfFile(EbookMetadata):
+    __slots__ = ("metadata_dict",)
 
     def __init__(self, entries, author_aliases):
         super().__init__(author_aliases)
-        self.metadata_dict.update(entries)
+        self.metadata_dict = defaultdict(list, entries)
+        for key in SHARED_FIELDS.intersection(entries.keys()):
+            self.metadata_dict[key] = intern_values(key, entries[key])
 
     def get_values(self, name):
         name = METADATA_ALIASES.get(name, name)
         return self.metadata_dict.get(name, [])
 
+    def _save_state(self):
+        return {key: list(values)
+                for (key, values) in self.metadata_dict.items()}
+
+    def _restore_state(self, state):
+        self.metadata_dict.clear()
+        self.metadata_dict.update(state)
+
+    def _update_aliases(self, name):
+        # aliases are saved in the database as separate copies
+        for alias in METADATA_ALIASES.keys():
+            if METADATA_ALIASES[alias] == name and \
+                    alias in self.metadata_dict.keys():
+                self.metadata_dict[alias] = list(self.metadata_dict[name])
+
     def set_value(self, name, value, replace=False):
         name = METADATA_ALIASES.get(name, name)
+        old_values = list(self.get_values(name))
         if replace:
-            self.metadata_dict[name] = [value]
+            self.metadata_dict[name] = intern_values(name, [value])
         elif value not in self.metadata_dict[name]:
-            self.metadata_dict[name].append(value)
-        self.has_changed = True
+            self.metadata_dict[name].extend(intern_values(name, [value]))
+        self._update_aliases(name)
+        return self._record_change(name, old_values)
+
+    def set_values(self, name, values):
+        name = METADATA_ALIASES.get(name, name)
+        old_values = list(self.get_values(name))
+        self.metadata_dict[name] = intern_values(name, list(values))
+        self._update_aliases(name)
+        return self._record_change(name, old_values)
 
 
 class OpfFile(EbookMetadata):
+    __slots__ = ("metadata_dict", "opf", "tree", "metadata_element",
+                 "epub_version")
 
     def __init__(self, opf, author_aliases):
         super().__init__(author_aliases)
+        self.metadata_dict = defaultdict(list)
         self.opf = opf
+        load_lxml()
+        tracer.count("opf_parses")
         self.tree = etree.parse(self.opf)
         self.metadata_element = self.tree.xpath('/pkg:package/pkg:metadata',
                                                 namespaces=ns)[0]
@@ -115,7 +246,7 @@ class OpfFile(EbookMetadata):
             tag = etree.QName(node.tag)
             short_tag = tag.localname
             if short_tag == "meta" and self.epub_version == "2.0":
-                if "calibre" in node.get("name"):
+                if "calibre" in node.get("name", ""):
                     calibre_tag = node.get("name").split("calibre:")[1]
                     self.metadata_dict[calibre_tag].append(
                         sanitize(calibre_tag,
@@ -129,6 +260,19 @@ class OpfFile(EbookMetadata):
             self.metadata_dict[alias] = self.metadata_dict[
                 METADATA_ALIASES[alias]]
 
+    def _save_state(self):
+        return copy.deepcopy(self.tree)
+
+    def _restore_state(self, state):
+        self.tree = state
+        self.metadata_element = self.tree.xpath('/pkg:package/pkg:metadata',
+                                                namespaces=ns)[0]
+        self.metadata_dict.clear()
+        self.parse()
+
+    def write(self):
+        self.save()
+
     def save(self):
         with open(self.opf, 'w') as file_handle:
             file_handle.write(etree.tostring(self.tree,
@@ -145,48 +289,70 @@ class OpfFile(EbookMetadata):
 
         return self.get_elements(name)
 
-    def set_value(self, name, value, replace=False):
-        name = METADATA_ALIASES.get(name, name)
-
-        nodes = self.get_elements(name)
-        print(nodes, name)
-
-        # TODO:
-        # if replace, must be unambiguous
-        #if replace:
-            #assert len(nodes) == 1
-
-        # modify or insert new metadata
-        found = False
-        for node in nodes:
-            if not node or not replace:
+    def get_nodes(self, name):
+        nodes = []
+        for node in self.metadata_element:
+            if node.tag == etree.Comment:
                 continue
-            else:
-                if node.text is None:  # meta
-                    if node.get("name") == name and replace:
-                        node.set("content", value)
-                        found = True
-                else:
-                    if replace:
-                        node.text = value
-                        found = True
-
-        if not found:
-            print(" -- Creating new metadata", name, '=', value)
-            if name in ["series", "series_index"]:
-                self.insert_new_node(name, value, is_meta=True)
-            else:
-                self.insert_new_node(name, value, is_meta=False)
+            short_tag = etree.QName(node.tag).localname
+            if short_tag == "meta":
+                if node.get("name", "") == "calibre:" + name:
+                    nodes.append(node)
+            elif short_tag == name:
+                nodes.append(node)
+        return nodes
+
+    def _set_node_value(self, node, value):
+        if etree.QName(node.tag).localname == "meta":
+            node.set("content", value)
+        else:
+            node.text = value
 
-        self.has_changed = True
-        self.save()
+    def _update_values(self, name):
+        # keeping the same list, which may be shared with an alias
+        values = self.metadata_dict[name]
+        values[:] = [sanitize(name, el.get("content")
+                              if etree.QName(el.tag).localname == "meta"
+                              else el.text, self.author_aliases)
+                     for el in self.get_nodes(name)]
+
+    def set_value(self, name, value, replace=False):
+        name = METADATA_ALIASES.get(name, name)
+        old_values = list(self.get_values(name))
+        nodes = self.get_nodes(name)
+        if replace and nodes != []:
+            self._set_node_value(nodes[0], value)
+            for node in nodes[1:]:
+                self.metadata_element.remove(node)
+        elif value not in old_values:
+            self.insert_new_node(name, value,
+                                 is_meta=(name in CALIBRE_FIELDS))
+        self._update_values(name)
+        return self._record_change(name, old_values)
+
+    def set_values(self, name, values):
+        name = METADATA_ALIASES.get(name, name)
+        old_values = list(self.get_values(name))
+        if old_values == list(values):
+            return False
+        nodes = self.get_nodes(name)
+        # reusing existing nodes keeps their attributes
+        for (node, value) in zip(nodes, values):
+            self._set_node_value(node, value)
+        for node in nodes[len(values):]:
+            self.metadata_element.remove(node)
+        for value in values[len(nodes):]:
+            self.insert_new_node(name, value,
+                                 is_meta=(name in CALIBRE_FIELDS))
+        self._update_values(name)
+        return self._record_change(name, old_values)
 
     def remove_value(self, name, value):
         pass  # TODO!
 
     def insert_new_node(self, name, value, is_meta=False):
         if is_meta:
-            new_node = etree.Element("meta")
+            new_node = etree.Element(etree.QName(ns["pkg"], "meta"))
             new_node.set("name", "calibre:" + name)
             new_node.set("content", value)
             self.metadata_element.append(new_node)
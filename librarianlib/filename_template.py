@@ -0,0 +1,91 @@
+import re
+from functools import lru_cache
+
+AUTHORIZED_TEMPLATE_PARTS = {
+    "$a": "author",
+    "$y": "year",
+    "$t": "title",
+    "$s": "series",
+    "$i": "series_index",
+    "$p": "progress",
+}
+
+FIELD = re.compile("|".join([re.escape(el)
+                             for el in AUTHORIZED_TEMPLATE_PARTS.keys()]))
+OPTIONAL = re.compile(r"\[([^\[\]]*)\]")
+
+
+def _split_fields(text):
+    # alternating literals and template keys
+    parts = []
+    position = 0
+    for field in FIELD.finditer(text):
+        if field.start() > position:
+            parts.append((False, text[position:field.start()]))
+        parts.append((True, field.group(0)))
+        position = field.end()
+    if position < len(text):
+        parts.append((False, text[position:]))
+    return parts
+
+
+class FilenameTemplate(object):
+    """ Filename template, parsed once.
+    Parts between brackets are optional: they are left out if any of their
+    fields has no value, for example "$a/$a ($y) $t[ - $s][ #$i]". """
+
+    def __init__(self, template):
+        self.template = template
+        self.has_optional_parts = False
+        # list of (is_optional, [(is_field, text), ...])
+        self.sections = []
+        position = 0
+        for optional in OPTIONAL.finditer(template):
+            if optional.start() > position:
+                self.sections.append(
+                    (False, _split_fields(template[position:
+                                                   optional.start()])))
+            self.sections.append((True, _split_fields(optional.group(1))))
+            self.has_optional_parts = True
+            position = optional.end()
+        if position < len(template):
+            self.sections.append((False, _split_fields(template[position:])))
+
+    def _value(self, key, metadata, read_status):
+        field = AUTHORIZED_TEMPLATE_PARTS[key]
+        values = metadata.get_values(field)
+        if len(values) >= 1:
+            return values[0]
+        elif field == "progress":
+            return read_status
+        return None
+
+    def render(self, metadata, read_status):
+        rendered = []
+        for (is_optional, parts) in self.sections:
+            section = []
+            for (is_field, text) in parts:
+                if not is_field:
+                    section.append(text)
+                    continue
+                value = self._value(text, metadata, read_status)
+                if value is None:
+                    if is_optional:
+                        section = None
+                        break
+                    # unknown values are left as is
+                    value = text
+                section.append(value)
+            if section is not None:
+                rendered.append("".join(section))
+        filename = "".join(rendered).replace(":", "").replace("?", "")
+        if self.has_optional_parts:
+            # left out parts may leave extra spaces behind
+            filename = "/".join([" ".join(el.split())
+                                 for el in filename.split("/")])
+        return filename
+
+
+@lru_cache(maxsize=32)
+def compile_template(template):
+    return FilenameTemplate(template)
@@ -0,0 +1,202 @@
+import os
+import time
+import zlib
+import sqlite3
+import hashlib
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import cpu_count
+
+CHUNK_SIZE = 1024 * 1024
+# seconds between checkpoints
+CHECKPOINT_INTERVAL = 10
+
+
+class Throttle(object):
+    """ Sleeps as needed to keep reading at most rate bytes per second. """
+
+    def __init__(self, rate=None):
+        self.rate = rate
+        self.start = time.monotonic()
+        self.done = 0
+
+    def wait(self, size):
+        if self.rate is None:
+            return
+        self.done += size
+        ahead = self.done / self.rate - (time.monotonic() - self.start)
+        if ahead > 0:
+            time.sleep(ahead)
+
+
+# one per worker process
+throttle = Throttle()
+
+
+def init_worker(rate):
+    global throttle
+    throttle = Throttle(rate)
+
+
+def check_file(path):
+    """ Returns (size, mtime, sha1, error) for an epub, error being None
+    if the CRCs of all the files of the archive are correct. """
+    stat = os.stat(path)
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as ebook:
+        for chunk in iter(lambda: ebook.read(CHUNK_SIZE), b""):
+            sha1.update(chunk)
+            throttle.wait(len(chunk))
+    error = None
+    try:
+        with zipfile.ZipFile(path) as archive:
+            for info in archive.infolist():
+                # the CRC is checked once a member is entirely read
+                with archive.open(info) as member:
+                    while member.read(CHUNK_SIZE) != b"":
+                        pass
+                throttle.wait(info.compress_size)
+    except (zipfile.BadZipFile, zlib.error, EOFError, ValueError,
+            NotImplementedError) as err:
+        error = str(err) or err.__class__.__name__
+    return stat.st_size, stat.st_mtime, sha1.hexdigest(), error
+
+
+class IntegrityCheck(object):
+    """ Checks the zip CRCs and the hash of every ebook, with one process
+    per CPU, against what was recorded the last time they were checked.
+    Results are saved as they come, so that an interrupted check resumes
+    where it stopped. """
+
+    def __init__(self, state_path, rate=None):
+        self.rate = rate
+        self.db = sqlite3.connect(state_path)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY, size INTEGER, mtime REAL,
+                hash TEXT, generation INTEGER, checked REAL,
+                problem TEXT, details TEXT);
+            CREATE TABLE IF NOT EXISTS runs (
+                id INTEGER PRIMARY KEY, started REAL, finished REAL);
+            """)
+
+    def close(self):
+        self.db.close()
+
+    def _start_run(self):
+        unfinished = self.db.execute(
+            "SELECT id, started FROM runs WHERE finished IS NULL "
+            "ORDER BY id DESC LIMIT 1").fetchone()
+        if unfinished is not None:
+            return unfinished
+        started = time.time()
+        cursor = self.db.execute("INSERT INTO runs (started) VALUES (?)",
+                                 (started,))
+        self.db.commit()
+        return cursor.lastrowid, started
+
+    def _verdict(self, ebook, record, size, mtime, content_hash):
+        # record: (size, mtime, hash, generation, checked)
+        if record is None or record[2] == content_hash:
+            return None, None
+        if record[0] == size and record[1] == mtime:
+            # the file was not written, yet its contents are different
+            return "corrupt", "contents changed since %s" % time.strftime(
+                "%Y-%m-%d", time.localtime(record[4]))
+        if record[3] == ebook.generation:
+            return "modified", "modified outside of librarian"
+        # written by librarian after an update
+        return None, None
+
+    def _record(self, ebook, record, result):
+        size, mtime, content_hash, problem, details = result
+        if problem == "corrupt" and record is not None:
+            # keeping the last good version
+            size, mtime, content_hash = record[:3]
+        self.db.execute("INSERT OR REPLACE INTO files VALUES "
+                        "(?, ?, ?, ?, ?, ?, ?, ?)",
+                        (ebook.path, size, mtime, content_hash,
+                         ebook.generation, time.time(), problem, details))
+
+    def _check_all(self, to_check, records, problems):
+        checked_bytes = 0
+        last_checkpoint = time.monotonic()
+        workers = cpu_count()
+        rate = None
+        if self.rate is not None:
+            rate = self.rate / workers
+        executor = ProcessPoolExecutor(max_workers=workers,
+                                       initializer=init_worker,
+                                       initargs=(rate,))
+        try:
+            future_checks = {executor.submit(check_file, eb.path): eb
+                             for eb in to_check}
+            for (i, future) in enumerate(as_completed(future_checks)):
+                ebook = future_checks[future]
+                print(" %.2f%%" % (100 * (i + 1) / len(to_check)),
+                      end="\r", flush=True)
+                record = records.get(ebook.path, None)
+                try:
+                    size, mtime, content_hash, error = future.result()
+                except FileNotFoundError:
+                    problems[ebook.path] = ("missing", "")
+                    continue
+                except OSError as err:
+                    problems[ebook.path] = ("corrupt", str(err))
+                    continue
+                checked_bytes += size
+                if error is not None:
+                    problem, details = "corrupt", error
+                else:
+                    problem, details = self._verdict(ebook, record, size,
+                                                     mtime, content_hash)
+                if problem is not None:
+                    problems[ebook.path] = (problem, details)
+                self._record(ebook, record, (size, mtime, content_hash,
+                                             problem, details))
+                if time.monotonic() - last_checkpoint > CHECKPOINT_INTERVAL:
+                    self.db.commit()
+                    last_checkpoint = time.monotonic()
+        except KeyboardInterrupt:
+            print("Interrupted, run it again to resume the check.")
+            raise
+        finally:
+            self.db.commit()
+            executor.shutdown(cancel_futures=True)
+        return checked_bytes
+
+    def run(self, ebooks, missing=[]):
+        """ Returns {path: (problem, details)}, problem being missing,
+        corrupt or modified. """
+        start = time.perf_counter()
+        run_id, started = self._start_run()
+        records = {row[0]: row[1:] for row in self.db.execute(
+            "SELECT path, size, mtime, hash, generation, checked "
+            "FROM files")}
+        to_check = [eb for eb in sorted(ebooks, key=lambda x: x.path)
+                    if eb.path not in records or
+                    records[eb.path][4] < started]
+        problems = {path: ("missing", "") for path in missing}
+        if len(to_check) < len(ebooks):
+            print("Resuming the check started on %s." % time.strftime(
+                "%Y-%m-%d %H:%M", time.localtime(started)))
+            for (path, problem, details) in self.db.execute(
+                    "SELECT path, problem, details FROM files "
+                    "WHERE checked >= ? AND problem IS NOT NULL",
+                    (started,)):
+                problems[path] = (problem, details)
+        print("Checking %s ebooks..." % len(to_check))
+        checked_bytes = self._check_all(to_check, records, problems)
+
+        # forgetting ebooks that were removed or renamed since
+        current = set([eb.path for eb in ebooks] + list(missing))
+        self.db.executemany("DELETE FROM files WHERE path = ?",
+                            [(el,) for el in records.keys()
+                             if el not in current])
+        self.db.execute("UPDATE runs SET finished = ? WHERE id = ?",
+                        (time.time(), run_id))
+        self.db.commit()
+        print("Checked %s ebooks (%.1fMB) in %.2fs." %
+              (len(to_check), checked_bytes / 1024 / 1024,
+               time.perf_counter() - start))
+        return problems
@@ -0,0 +1,360 @@
+import io
+import os
+import re
+import math
+import time
+import sqlite3
+import hashlib
+import zipfile
+import unicodedata
+from collections import defaultdict
+from html.parser import HTMLParser
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from multiprocessing import cpu_count
+
+from .epub_metadata import ns, read_package, manifest_path
+from .tracing import tracer
+
+WORD = re.compile(r"\w+")
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+CHUNK_SIZE = 64 * 1024
+
+
+def normalize(text):
+    # lowercase, without accents
+    if text.isascii():
+        return text.lower()
+    text = unicodedata.normalize("NFKD", text.casefold())
+    return "".join([c for c in text if not unicodedata.combining(c)])
+
+
+def tokenize(text):
+    return WORD.findall(normalize(text))
+
+
+def encode_positions(positions):
+    # deltas between sorted positions, as varints
+    encoded = bytearray()
+    previous = 0
+    for position in positions:
+        delta = position - previous
+        previous = position
+        while delta >= 0x80:
+            encoded.append((delta & 0x7f) | 0x80)
+            delta >>= 7
+        encoded.append(delta)
+    return bytes(encoded)
+
+
+def decode_positions(encoded):
+    positions = []
+    position = 0
+    delta = 0
+    shift = 0
+    for byte in encoded:
+        delta |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            position += delta
+            positions.append(position)
+            delta = 0
+            shift = 0
+    return positions
+
+
+def file_hash(path):
+    sha1 = hashlib.sha1()
+    with tracer.span("fulltext.hash"), open(path, "rb") as ebook:
+        for chunk in iter(lambda: ebook.read(CHUNK_SIZE), b""):
+            sha1.update(chunk)
+            tracer.count("bytes_hashed", len(chunk))
+    return sha1.hexdigest()
+
+
+class TextExtractor(HTMLParser):
+    """ Records the position of every word of the xhtml documents it is
+    fed, chunk by chunk, skipping scripts and styles. """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.positions = defaultdict(list)
+        self.length = 0
+        self.skipping = 0
+        # end of a word that may continue in the next chunk
+        self.pending = ""
+
+    def _add_words(self, text):
+        words = tokenize(text)
+        positions = self.positions
+        for (position, word) in enumerate(words, self.length):
+            positions[word].append(position)
+        self.length += len(words)
+
+    def flush(self):
+        if self.pending != "":
+            self._add_words(self.pending)
+            self.pending = ""
+
+    def end_document(self):
+        self.close()
+        self.reset()
+        self.flush()
+        self.skipping = 0
+
+    def handle_starttag(self, tag, attrs):
+        self.flush()
+        if tag in ["script", "style"]:
+            self.skipping += 1
+
+    def handle_endtag(self, tag):
+        self.flush()
+        if tag in ["script", "style"] and self.skipping > 0:
+            self.skipping -= 1
+
+    def handle_data(self, data):
+        if self.skipping > 0:
+            return
+        text = self.pending + data
+        cut = len(text)
+        while cut > 0 and (text[cut - 1].isalnum() or text[cut - 1] == "_"):
+            cut -= 1
+        self.pending = text[cut:]
+        self._add_words(text[:cut])
+
+
+def spine_documents(archive):
+    """ Names of the documents of an epub, in reading order. """
+    opf_name, opf = read_package(archive)
+    manifest = {}
+    for item in opf.xpath("/pkg:package/pkg:manifest/pkg:item",
+                          namespaces=ns):
+        manifest[item.get("id")] = item
+    names = set(archive.namelist())
+    documents = []
+    for itemref in opf.xpath("/pkg:package/pkg:spine/pkg:itemref",
+                             namespaces=ns):
+        item = manifest.get(itemref.get("idref"), None)
+        if item is None or "html" not in item.get("media-type", ""):
+            continue
+        name = manifest_path(opf_name, item.get("href"))
+        if name in names:
+            documents.append(name)
+    return documents
+
+
+def extract_words(path):
+    """ Returns (length, {word: positions}) for an epub, reading its
+    documents straight from the zip archive. """
+    extractor = TextExtractor()
+    with tracer.span("fulltext.extract"), zipfile.ZipFile(path) as archive:
+        tracer.count("zip_opens")
+        for name in spine_documents(archive):
+            with archive.open(name) as member:
+                text = io.TextIOWrapper(member, encoding="utf8",
+                                        errors="replace")
+                for chunk in iter(lambda: text.read(CHUNK_SIZE), ""):
+                    extractor.feed(chunk)
+            extractor.end_document()
+    return extractor.length, extractor.positions
+
+
+class FullTextIndex(object):
+    """ On-disk inverted index of the contents of the library, with word
+    positions for phrase queries, and BM25 ranking. Ebooks are only
+    indexed again if their contents changed: moved ebooks are recognized
+    by their hash. """
+
+    def __init__(self, index_path):
+        self.index_path = index_path
+        self.db = sqlite3.connect(index_path)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS books (
+                id INTEGER PRIMARY KEY, path TEXT UNIQUE, size INTEGER,
+                mtime REAL, hash TEXT, length INTEGER);
+            CREATE TABLE IF NOT EXISTS terms (
+                id INTEGER PRIMARY KEY, term TEXT UNIQUE);
+            CREATE TABLE IF NOT EXISTS postings (
+                term_id INTEGER, book_id INTEGER, frequency INTEGER,
+                positions BLOB, PRIMARY KEY (term_id, book_id))
+                WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS postings_book
+                ON postings (book_id);
+            """)
+
+    def close(self):
+        self.db.close()
+
+    def _remove(self, book_id):
+        self.db.execute("DELETE FROM postings WHERE book_id = ?", (book_id,))
+        self.db.execute("DELETE FROM books WHERE id = ?", (book_id,))
+
+    def _add(self, path, size, mtime, content_hash, length, positions):
+        cursor = self.db.execute(
+            "INSERT INTO books (path, size, mtime, hash, length) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (path, size, mtime, content_hash, length))
+        book_id = cursor.lastrowid
+        self.db.executemany("INSERT OR IGNORE INTO terms (term) VALUES (?)",
+                            [(el,) for el in positions.keys()])
+        term_ids = {}
+        words = list(positions.keys())
+        # sqlite limits the number of parameters of a query
+        for i in range(0, len(words), 500):
+            batch = words[i:i + 500]
+            term_ids.update(self.db.execute(
+                "SELECT term, id FROM terms WHERE term IN (%s)" %
+                ",".join(["?"] * len(batch)), batch).fetchall())
+        self.db.executemany(
+            "INSERT INTO postings VALUES (?, ?, ?, ?)",
+            [(term_ids[word], book_id, len(word_positions),
+              encode_positions(word_positions))
+             for (word, word_positions) in positions.items()])
+
+    def _changed(self, ebooks):
+        # (path, stat, row) for the ebooks whose files changed
+        known = {row[1]: row for row in self.db.execute(
+            "SELECT id, path, size, mtime, hash FROM books")}
+        changed = []
+        for ebook in ebooks:
+            try:
+                stat = os.stat(ebook.path)
+            except OSError:
+                continue
+            row = known.get(ebook.path, None)
+            if row is not None and row[2] == stat.st_size and \
+                    row[3] == stat.st_mtime:
+                continue
+            changed.append((ebook.path, stat, row))
+        return known, changed
+
+    def update(self, ebooks):
+        """ Indexes new and modified ebooks, and forgets deleted ones.
+        Returns the number of ebooks that were read, and of ebooks that
+        were removed from the index. """
+        start = time.perf_counter()
+        known, changed = self._changed(ebooks)
+        current = set([eb.path for eb in ebooks])
+        # indexed ebooks that are not there anymore, or were moved
+        orphans = {row[4]: row for (path, row) in known.items()
+                   if path not in current}
+        if changed == [] and orphans == {}:
+            return 0, 0
+
+        with ThreadPoolExecutor(max_workers=cpu_count()) as executor:
+            hashes = list(executor.map(lambda x: file_hash(x[0]), changed))
+        to_index = []
+        for ((path, stat, row), content_hash) in zip(changed, hashes):
+            if row is not None and row[4] == content_hash:
+                # touched, but the contents are the same
+                self.db.execute("UPDATE books SET size = ?, mtime = ? "
+                                "WHERE id = ?",
+                                (stat.st_size, stat.st_mtime, row[0]))
+                continue
+            if row is not None:
+                self._remove(row[0])
+            moved = orphans.pop(content_hash, None)
+            if moved is not None:
+                self.db.execute("UPDATE books SET path = ?, size = ?, "
+                                "mtime = ? WHERE id = ?",
+                                (path, stat.st_size, stat.st_mtime,
+                                 moved[0]))
+                continue
+            to_index.append((path, stat, content_hash))
+        for row in orphans.values():
+            self._remove(row[0])
+        removed = len(orphans)
+
+        if to_index != []:
+            print("Indexing the contents of %s ebooks..." % len(to_index))
+        indexed = 0
+        with ThreadPoolExecutor(max_workers=cpu_count()) as executor:
+            future_words = {
+                executor.submit(extract_words, path): (path, stat, h)
+                for (path, stat, h) in to_index
+                }
+            for future in as_completed(future_words):
+                path, stat, content_hash = future_words[future]
+                try:
+                    length, positions = future.result()
+                except Exception as err:
+                    print(" -> Cannot index %s: %s" % (path, err))
+                    continue
+                with tracer.span("fulltext.write"):
+                    self._add(path, stat.st_size, stat.st_mtime,
+                              content_hash, length, positions)
+                indexed += 1
+                print(" %.2f%%" % (100 * indexed / len(to_index)),
+                      end="\r", flush=True)
+                # keeping what was done if interrupted
+                if indexed % 50 == 0:
+                    self.db.commit()
+        self.db.commit()
+        if to_index != []:
+            print("Contents of %s ebooks indexed in %.2fs." %
+                  (indexed, time.perf_counter() - start))
+        return len(changed), removed
+
+    def _postings(self, term):
+        return self.db.execute(
+            "SELECT postings.book_id, postings.frequency, postings.positions "
+            "FROM postings JOIN terms ON terms.id = postings.term_id "
+            "WHERE terms.term = ?", (term,)).fetchall()
+
+    @staticmethod
+    def _is_phrase(book_positions):
+        # the words of the phrase are at consecutive positions
+        first = book_positions[0]
+        others = [set(el) for el in book_positions[1:]]
+        return any([all([(position + i + 1) in positions
+                         for (i, positions) in enumerate(others)])
+                    for position in first])
+
+    def search(self, query):
+        """ Returns {path: BM25 score} for the ebooks containing all the
+        words of the query, or the exact phrase if it is quoted. """
+        with tracer.span("fulltext.search"):
+            is_phrase = len(query) > 1 and query.startswith('"') and \
+                query.endswith('"')
+            words = tokenize(query)
+            if words == []:
+                return {}
+            count, average_length = self.db.execute(
+                "SELECT count(*), avg(length) FROM books").fetchone()
+            if count == 0:
+                return {}
+            average_length = max(1, average_length)
+            lengths = {}
+            postings = {}
+            for word in set(words):
+                postings[word] = {el[0]: el for el in self._postings(word)}
+                if postings[word] == {}:
+                    return {}
+            candidates = set.intersection(*[set(el.keys())
+                                            for el in postings.values()])
+            if is_phrase and len(words) > 1:
+                candidates = set([
+                    book_id for book_id in candidates
+                    if self._is_phrase([decode_positions(
+                        postings[word][book_id][2]) for word in words])])
+            if candidates == set():
+                return {}
+            for (book_id, path, length) in self.db.execute(
+                    "SELECT id, path, length FROM books"):
+                if book_id in candidates:
+                    lengths[book_id] = (path, length)
+
+            scores = {}
+            for word in set(words):
+                frequency = len(postings[word])
+                idf = math.log(1 + (count - frequency + 0.5) /
+                               (frequency + 0.5))
+                for book_id in candidates:
+                    path, length = lengths[book_id]
+                    tf = postings[word][book_id][1]
+                    scores[path] = scores.get(path, 0) + \
+                        idf * tf * (K1 + 1) / \
+                        (tf + K1 * (1 - B + B * length / average_length))
+            return scores
@@ -1,12 +1,20 @@
 from http.server import HTTPServer, SimpleHTTPRequestHandler
+from socketserver import ThreadingMixIn
 import os
+import json
+import mimetypes
 import threading
-from urllib.parse import unquote
+from urllib.parse import unquote, urlsplit, parse_qs
 
 
-class LibrarianServer(HTTPServer):
+class LibrarianServer(ThreadingMixIn, HTTPServer):
+    # one thread per request, so that a slow conversion does not block
+    # the other downloads
+    daemon_threads = True
+
     def __init__(self, server_address, RequestHandlerClass,
-                 allowed, library_dir, collections_json):
+                 allowed, library_dir, collections_json, converter=None,
+                 catalog=None, change_feed=None, covers=None):
         HTTPServer.__init__(self, server_address, RequestHandlerClass)
         self.allowed = allowed
         # to make sure all goes well later when splitting and joining
@@ -15,11 +23,90 @@ class LibrarianServer(HTTPServer):
         self.allowed_relative = [el.split(library_dir)[1] for el in allowed]
         self.library_dir = library_dir
         self.collections_json = collections_json
+        # if set, ebooks are converted when first requested
+        self.converter = converter
+        # OPDS catalog of the served ebooks
+        self.catalog = catalog
+        # changes to the served ebooks since a given generation
+        self.change_feed = change_feed
+        # CoverCache of the thumbnails of the served ebooks
+        self.covers = covers
 
 
 class LibrarianHandler(SimpleHTTPRequestHandler):
 
+    def send_catalog(self, clean_path, query):
+        try:
+            page = int(parse_qs(query).get("page", ["1"])[0])
+        except ValueError:
+            page = 1
+        feed = self.server.catalog.render(clean_path, page)
+        if feed is None:
+            return self.send_error(404, 'Catalog Not Found: %s' % clean_path)
+        body, etag, feed_type = feed
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-type", feed_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_changes(self, query):
+        try:
+            since = int(parse_qs(query).get("since", ["0"])[0])
+        except ValueError:
+            return self.send_error(400, 'Invalid generation')
+        print("Sending changes since generation %s..." % since)
+        body = json.dumps(self.server.change_feed.changes_since(since),
+                          ensure_ascii=False).encode("utf8")
+        self.send_response(200)
+        self.send_header("Content-type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_cover(self, name):
+        if name not in self.server.covers.names:
+            return self.send_error(404, 'Cover Not Found: %s' % name)
+        # thumbnails are named after their contents, and never change
+        etag = '"%s"' % os.path.splitext(name)[0]
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        try:
+            with open(self.server.covers.path(name), "rb") as cover:
+                body = cover.read()
+        except OSError:
+            return self.send_error(404, 'Cover Not Found: %s' % name)
+        self.send_response(200)
+        self.send_header("Content-type",
+                         mimetypes.guess_type(name)[0] or "image/jpeg")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.send_header("Cache-Control",
+                         "public, max-age=31536000, immutable")
+        self.end_headers()
+        self.wfile.write(body)
+
     def do_GET(self):
+        url = urlsplit(self.path)
+        if self.server.catalog is not None and \
+                url.path.strip("/").split("/")[0] == "opds":
+            return self.send_catalog(unquote(url.path[1:]), url.query)
+        if self.server.change_feed is not None and url.path == "/changes":
+            return self.send_changes(url.query)
+        if self.server.covers is not None and \
+                url.path.startswith("/covers/"):
+            return self.send_cover(unquote(url.path[len("/covers/"):]))
+
         clean_path = unquote(self.path[1:])
         if clean_path == "index":
             print("Sending index of filtered ebooks...")
@@ -28,8 +115,16 @@ class LibrarianHandler(SimpleHTTPRequestHandler):
             self.end_headers()
             text = "|".join(self.server.allowed_relative)
             self.wfile.write(text.encode("utf8"))
-        elif clean_path in self.server.allowed_relative or \
-                clean_path == "collections.json":
+        elif clean_path in self.server.allowed_relative:
+            if self.server.converter is not None:
+                try:
+                    self.server.converter.convert(clean_path)
+                except Exception as err:
+                    print("Error converting %s: %s" % (clean_path, err))
+                    return self.send_error(500, 'Conversion failed: %s' %
+                                           clean_path)
+            super(LibrarianHandler, self).do_GET()
+        elif clean_path == "collections.json":
             super(LibrarianHandler, self).do_GET()
         elif clean_path == "LibrarianServer::shutdown":
             # return response and shutdown the server
@@ -7,21 +7,48 @@ import time
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from multiprocessing import cpu_count
 import json
+from collections import defaultdict
 
-from librarianlib.epub import Epub
-from librarianlib.librarian_server import LibrarianServer, LibrarianHandler
+from librarianlib.epub import Epub, check_calibre
+from librarianlib.change_log import ChangeLog, ChangeFeed, STATE_KEY
+from librarianlib.mobi_conversion import MobiConversionQueue
+from librarianlib.metadata_store import MetadataStore
+from librarianlib.blob_store import BlobStore
+from librarianlib.smart_collections import SmartCollections
+from librarianlib.rename_planner import RenamePlan, resume
+from librarianlib.tracing import tracer, traced
+from librarianlib.zip_rewrite import fingerprint
 
 
 class Library(object):
 
     def __init__(self, config, db):
         self.ebooks = []
+        # path -> (filename, entry) for ebooks of the database whose file
+        # cannot be found
+        self.missing = {}
         self.backup_imported_ebooks = True
         self.scrape_root = None
         self.ebook_filename_template = config.get("ebook_filename_template",
                                                   "$a/$a ($y) $t")
         self.config = config
         self.db = db
+        self.rename_journal = "%s_rename_journal" % db
+        self.change_log = ChangeLog()
+        # column-oriented metadata, for very large libraries
+        self.metadata_store = None
+        if config.get("compact_metadata", False):
+            self.metadata_store = MetadataStore()
+        # imported backups and exports are hardlinks to shared blobs
+        self.blob_store = None
+        if config.get("deduplicate", False):
+            self.blob_store = BlobStore(config["blobs_dir"])
+        # saved searches, exported as collections
+        self.smart_collections = SmartCollections(
+            config.get("smart_collections", {}))
+        # field -> (library state, NumericIndex)
+        self.numeric_indexes = {}
+        self.similarity = None
 
     def __enter__(self):
         return self
@@ -37,14 +64,31 @@ class Library(object):
             return False, None
         eb = Epub(everything[filename]["path"], self.config["library_dir"],
                   self.config["author_aliases"], self.ebook_filename_template)
-        return eb.load_from_database_json(everything[filename], filename), eb
+        eb.change_log = self.change_log
+        return eb.load_from_database_json(everything[filename], filename,
+                                          self.metadata_store), eb
 
+    @traced("library.open_db")
     def open_db(self):
         if os.path.exists(self.db):
             start = time.perf_counter()
-            everything = json.load(open(self.db, 'r'))
-
-            with ThreadPoolExecutor(max_workers=cpu_count()) as executor:
+            with tracer.span("open.read"):
+                everything = json.load(open(self.db, 'r'))
+            state = everything.get(STATE_KEY, {})
+            self.change_log = ChangeLog(state)
+            self.smart_collections.load(state.get("smart_collections", None))
+            previous_paths = {}
+            if os.path.exists(self.rename_journal):
+                print("Completing interrupted renames...")
+                renamed = resume(self.rename_journal)
+                for entry in everything.values():
+                    old_path = entry.get("path", None)
+                    if old_path in renamed:
+                        entry["path"] = renamed[old_path]
+                        previous_paths[entry["path"]] = old_path
+
+            with tracer.span("open.load_ebooks"), \
+                    ThreadPoolExecutor(max_workers=cpu_count()) as executor:
                 future_to_ebook = {
                     executor.submit(self._load_ebook,
                                     everything,
@@ -54,8 +98,20 @@ class Library(object):
                     success, ebook = future.result()
                     if success:
                         self.ebooks.append(ebook)
+                    elif ebook is not None and \
+                            not os.path.exists(ebook.path):
+                        filename = future_to_ebook[future]
+                        self.missing[ebook.path] = (filename,
+                                                    everything[filename])
             print("Database opened in %.2fs: loaded %s ebooks." %
                   ((time.perf_counter() - start), len(self.ebooks)))
+            if previous_paths != {}:
+                for eb in self.ebooks:
+                    if eb.path in previous_paths:
+                        self.change_log.record_removal(
+                            eb.get_relative_path(previous_paths[eb.path]))
+                        eb.mark_as_changed()
+                self.save_db()
         else:
             print("No DB, refresh!")
 
@@ -64,18 +120,61 @@ class Library(object):
         for eb in known_ebooks:
             if eb.path == full_path:
                 is_already_in_db = True
-                eb.open_ebook_metadata()
                 return eb
         if not is_already_in_db:
             eb = Epub(full_path, self.config["library_dir"],
                       self.config["author_aliases"],
                       self.ebook_filename_template)
+            eb.change_log = self.change_log
             eb.open_ebook_metadata()
+            eb.fingerprint = eb.current_fingerprint or ""
+            eb.mark_as_new()
             print(" ->  NEW EBOOK: ", eb)
             return eb
         return None
 
-    def refresh_db(self):
+    def _find_moved_ebooks(self, paths, known_ebooks):
+        """ Returns {new path: old path} for the ebooks of the database
+        whose file was moved to one of the new paths, recognized by its
+        fingerprint. """
+        known_paths = set([eb.path for eb in known_ebooks])
+        current = set(paths)
+        new_paths = [el for el in paths if el not in known_paths]
+        gone = defaultdict(list)
+        for eb in known_ebooks:
+            if eb.path not in current and eb.fingerprint != "":
+                gone[eb.fingerprint].append(eb.path)
+        for (path, (filename, entry)) in self.missing.items():
+            if entry.get("fingerprint", "") != "":
+                gone[entry["fingerprint"]].append(path)
+        if new_paths == [] or gone == {}:
+            return {}
+        moved = {}
+        for path in new_paths:
+            candidates = gone.get(fingerprint(path), [])
+            # identical copies cannot be told apart
+            if len(candidates) == 1:
+                moved[path] = candidates.pop()
+        return moved
+
+    def _moved_ebook(self, old_path, new_path, known_ebooks):
+        for eb in known_ebooks:
+            if eb.path == old_path:
+                eb.moved_to(new_path)
+                return eb
+        # missing when the database was opened
+        filename, entry = self.missing.pop(old_path)
+        success, eb = self._load_ebook({filename: dict(entry,
+                                                       path=new_path)},
+                                       filename)
+        if not success:
+            return None
+        self.change_log.record_removal(eb.get_relative_path(old_path))
+        eb.mark_as_changed()
+        return eb
+
+    @traced("library.refresh_db")
+    def refresh_db(self, dry_run=False):
         print("Refreshing library...")
         start = time.perf_counter()
         old_db = list(self.ebooks)  # copy
@@ -83,45 +182,165 @@ class Library(object):
 
         # list all books in library root
         all_ebooks_in_library_dir = []
-        for root, dirs, files in os.walk(self.config["library_dir"]):
-            all_ebooks_in_library_dir.extend([os.path.join(root, el)
-                                              for el in files
-                                              if el.lower().endswith(".epub")])
+        with tracer.span("refresh.list_files"):
+            for root, dirs, files in os.walk(self.config["library_dir"]):
+                all_ebooks_in_library_dir.extend(
+                    [os.path.join(root, el) for el in files
+                     if el.lower().endswith(".epub")])
+
+        # ebooks moved outside of librarian keep their tags and progress
+        with tracer.span("refresh.find_moved"):
+            moved = self._find_moved_ebooks(all_ebooks_in_library_dir,
+                                            old_db)
 
         # refresh list
-        for (i,ebook) in enumerate(sorted(all_ebooks_in_library_dir)):
-            eb = self._return_or_create_new_ebook(ebook, old_db)
-            if eb is not None:
-                print(" %.2f%%" % (100*i/len(all_ebooks_in_library_dir)),
+        with tracer.span("refresh.find_ebooks"):
+            for (i,ebook) in enumerate(sorted(all_ebooks_in_library_dir)):
+                if ebook in moved:
+                    eb = self._moved_ebook(moved[ebook], ebook, old_db)
+                    print(" -> MOVED EBOOK: ", moved[ebook], "->", ebook)
+                else:
+                    eb = self._return_or_create_new_ebook(ebook, old_db)
+                if eb is not None and eb.fingerprint == "":
+                    # databases saved before fingerprints were recorded
+                    eb.fingerprint = eb.current_fingerprint or ""
+                if eb is not None:
+                    print(" %.2f%%" % (100*i/len(all_ebooks_in_library_dir)),
                           end="\r", flush=True)
-                # rename if necessary
-                eb.rename_from_metadata()
-                self.ebooks.append(eb)
+                    self.ebooks.append(eb)
 
         # display missing ebooks
         deleted = [eb for eb in old_db if eb not in self.ebooks]
         for eb in deleted:
             print(" -> DELETED EBOOK: ", eb)
-
-        # remove empty dirs in library root
-        for root, dirs, files in os.walk(self.config["library_dir"],
-                                         topdown=False):
-            for dir in [os.path.join(root, el) for el in dirs if
-                        os.listdir(os.path.join(root, el)) == []]:
-                os.rmdir(dir)
-
+            self.change_log.record_removal(eb.get_relative_path(eb.path))
+            eb.release_metadata()
+
+        # rename if necessary, all at once
+        with tracer.span("refresh.plan_renames"):
+            plan = RenamePlan(self.config["library_dir"], self.ebooks)
+        if plan.moves != [] or plan.has_problems:
+            plan.summary()
+            if not dry_run:
+                plan.execute(self.rename_journal)
+
+        if not dry_run:
+            # remove empty dirs in library root
+            for root, dirs, files in os.walk(self.config["library_dir"],
+                                             topdown=False):
+                for dir in [os.path.join(root, el) for el in dirs if
+                            os.listdir(os.path.join(root, el)) == []]:
+                    os.rmdir(dir)
+            self.update_covers()
         is_incomplete = self.list_incomplete_metadata()
         print("Database refreshed in %.2fs." % (time.perf_counter() - start))
         return is_incomplete
 
+    def _remove_empty_dirs(self, directories):
+        # and their empty parents, up to library_dir
+        for directory in sorted(set(directories), reverse=True):
+            while directory.startswith(self.config["library_dir"] + os.sep) \
+                    and os.path.isdir(directory) and \
+                    os.listdir(directory) == []:
+                os.rmdir(directory)
+                directory = os.path.dirname(directory)
+
+    @traced("library.refresh_paths")
+    def refresh_paths(self, paths):
+        """ Refreshes the database for the paths (files or directories)
+        inside library_dir that have changed, instead of the whole library.
+        Returns True if the library was modified. """
+        start = time.perf_counter()
+        known_paths = set([eb.path for eb in self.ebooks])
+        modified = False
+        emptied = []
+        for path in sorted(paths):
+            prefix = path + os.sep
+            gone = [eb for eb in self.ebooks
+                    if (eb.path == path or eb.path.startswith(prefix)) and
+                    not os.path.exists(eb.path)]
+            for eb in gone:
+                print(" -> DELETED EBOOK: ", eb)
+                self.change_log.record_removal(eb.get_relative_path(eb.path))
+                self.ebooks.remove(eb)
+                eb.release_metadata()
+                emptied.append(os.path.dirname(eb.path))
+                modified = True
+            if path.lower().endswith(".epub") and path not in known_paths \
+                    and os.path.isfile(path):
+                try:
+                    eb = self._return_or_create_new_ebook(path, [])
+                except Exception as err:
+                    # probably still being written, there will be other events
+                    print(" -> Cannot read %s yet: %s" % (path, err))
+                    continue
+                self.ebooks.append(eb)
+                known_paths.add(path)
+                modified = True
+                if not eb.librarian_metadata.is_complete:
+                    print(" -> Incomplete metadata: ", eb.path)
+
+        plan = RenamePlan(self.config["library_dir"], self.ebooks)
+        if plan.moves != [] or plan.has_problems:
+            plan.summary()
+            emptied.extend([os.path.dirname(source)
+                            for (eb, source, target) in plan.moves])
+            plan.execute(self.rename_journal)
+            modified = modified or plan.moves != []
+        self._remove_empty_dirs(emptied)
+        if modified:
+            print("Database updated in %.2fs." %
+                  (time.perf_counter() - start))
+        return modified
+
+    def watch(self, readable=False):
+        # updates the database as files are added to import_dir or changed
+        # in library_dir, until interrupted
+        from librarianlib.watcher import Watcher
+        import_dir = self.config["import_dir"]
+        library_dir = self.config["library_dir"]
+        watcher = Watcher([library_dir, import_dir],
+                          self.config.get("watch_debounce", 2))
+        print("Watching %s and %s." % (library_dir, import_dir))
+        try:
+            for changes in watcher.changes():
+                if changes is None:
+                    print("Too many changes, refreshing everything.")
+                    self.import_new_ebooks()
+                    self.refresh_db()
+                    self.save_db(readable)
+                    continue
+                changed, ready = changes
+                # imported ebooks are moved to library_dir, and will be
+                # refreshed with the next changes. Files still being written
+                # will be ready with a later change.
+                to_import = [el for el in ready
+                             if os.path.dirname(el) == import_dir and
+                             os.path.isfile(el)]
+                if to_import != []:
+                    self.import_new_ebooks(to_import)
+                if self.refresh_paths([el for el in changed
+                                       if el.startswith(library_dir +
+                                                        os.sep)]):
+                    self.save_db(readable)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            watcher.close()
+
+    @traced("library.save_db")
     def save_db(self, readable=False, sync_with_files=False):
         print("Saving dabatase...")
         data = {}
         # adding ebooks in alphabetical order
-        for ebook in sorted(self.ebooks, key=lambda x: x.filename):
-            data[ebook.filename] = ebook.to_database_json()
-            if sync_with_files:
-                ebook.sync_ebook_metadata()
+        if sync_with_files:
+            self.sync_ebooks_metadata(self.ebooks)
+        with tracer.span("save.serialize"):
+            for ebook in sorted(self.ebooks, key=lambda x: x.filename):
+                data[ebook.filename] = ebook.to_database_json()
+            data[STATE_KEY] = self.change_log.to_database_json()
+            data[STATE_KEY]["smart_collections"] = \
+                self.smart_collections.to_database_json()
 
         # copy previous db
         if os.path.exists("%s_backup" % self.db):
@@ -129,7 +348,7 @@ class Library(object):
         shutil.copyfile(self.db, "%s_backup" % self.db)
 
         # dumping in json file
-        with open(self.db, "w") as data_file:
+        with tracer.span("save.write"), open(self.db, "w") as data_file:
             if readable:
                 data_file.write(json.dumps(data, sort_keys=True, indent=2,
                                            separators=(',', ': '),
@@ -137,6 +356,102 @@ class Library(object):
             else:
                 data_file.write(json.dumps(data, ensure_ascii=False))
 
+        # renames are now recorded in the database
+        if os.path.exists(self.rename_journal):
+            os.remove(self.rename_journal)
+
+    def _proposed_metadata_changes(self, ebooks, updates, replace):
+        # (field, old values, new values) -> ebooks
+        proposed = defaultdict(list)
+        for ebook in ebooks:
+            new_values = {}
+            for (key, value) in updates:
+                values = new_values.get(
+                    key, list(ebook.librarian_metadata.get_values(key)))
+                if replace and key not in new_values:
+                    values = [value]
+                elif value not in values:
+                    values = values + [value]
+                new_values[key] = values
+            for (key, values) in new_values.items():
+                old_values = list(ebook.librarian_metadata.get_values(key))
+                if values != old_values:
+                    proposed[(key, tuple(old_values),
+                              tuple(values))].append(ebook)
+        return proposed
+
+    def bulk_update_metadata(self, ebooks, update_list, replace=False,
+                             assume_yes=False):
+        updates = []
+        for part in update_list:
+            try:
+                key, value = part.split(":", 1)
+                updates.append((key, value.title()))
+            except ValueError:
+                print("Error writing metadata", part, ": expected field:value")
+        proposed = self._proposed_metadata_changes(ebooks, updates, replace)
+        if proposed == {}:
+            print("No change detected.")
+            return False
+
+        to_update = set()
+        print("Updating epub metadata:")
+        for (key, old_values, new_values) in sorted(proposed.keys()):
+            changed = proposed[(key, old_values, new_values)]
+            to_update.update(changed)
+            print(" -> %s: %s -> %s (%s ebooks)" % (key, list(old_values),
+                                                   list(new_values),
+                                                   len(changed)))
+            for ebook in sorted(changed, key=lambda x: x.filename)[:5]:
+                print("      ", ebook)
+            if len(changed) > 5:
+                print("       ... and %s more." % (len(changed) - 5))
+
+        if not assume_yes:
+            answer = input("Update %s ebooks? y/n " % len(to_update)).lower()
+            if answer != 'y':
+                print("Discarding changes, nothing will be saved.")
+                return False
+
+        for ebook in to_update:
+            ebook.librarian_metadata.begin()
+        for (key, old_values, new_values), changed in proposed.items():
+            for ebook in changed:
+                ebook.librarian_metadata.set_values(key, list(new_values))
+        for ebook in to_update:
+            ebook.librarian_metadata.commit()
+            ebook.mark_as_changed()
+        print("Updated %s ebooks." % len(to_update))
+        return True
+
+    @traced("library.sync_ebooks_metadata")
+    def sync_ebooks_metadata(self, ebooks):
+        # writing metadata back to the epub files, in parallel
+        print("Writing metadata to ebook files...")
+        start = time.perf_counter()
+        updated = 0
+        with ThreadPoolExecutor(max_workers=cpu_count()) as executor:
+            future_changes = {
+                executor.submit(eb.sync_ebook_metadata): eb for eb in ebooks
+                }
+            for future in as_completed(future_changes):
+                ebook = future_changes[future]
+                try:
+                    changes = future.result()
+                except Exception as err:
+                    print(" -> Error writing metadata to %s: %s" %
+                          (ebook.path, err))
+                    continue
+                if changes != []:
+                    updated += 1
+                    print(" -> ", ebook)
+                    for change in changes:
+                        print("    %s: %s -> %s" % (change.field,
+                                                    change.old, change.new))
+        print("Metadata written to %s ebooks in %.2fs." %
+              (updated, time.perf_counter() - start))
+
+    @traced("library.scrape_dir_for_ebooks")
     def scrape_dir_for_ebooks(self):
         scrape_root = self.config.get("scrape_root", None)
         if scrape_root is None:
@@ -171,6 +486,7 @@ class Library(object):
             print(" -> Scraping ", os.path.basename(ebook))
             shutil.copyfile(ebook, os.path.join(self.config["import_dir"],
                                                 os.path.basename(ebook)))
+            tracer.count("bytes_copied", os.path.getsize(ebook))
 
         print("Scraped ebooks in %.2fs." % (time.perf_counter() - start))
         return True
@@ -178,21 +494,114 @@ class Library(object):
     def _convert_to_epub_before_importing(self, mobi):
         epub_name = mobi.replace(".mobi", ".epub")
         if not os.path.exists(epub_name):
+            check_calibre()
             print("   + Converting to .epub: ", mobi)
-            return subprocess.call(['ebook-convert',
-                                    mobi,
-                                    epub_name,
-                                    "--output-profile", "kindle_pw"],
-                                    stdout=subprocess.DEVNULL)
+            tracer.count("conversions")
+            with tracer.span("library.convert_to_epub"):
+                return subprocess.call(['ebook-convert',
+                                        mobi,
+                                        epub_name,
+                                        "--output-profile", "kindle_pw"],
+                                       stdout=subprocess.DEVNULL)
         else:
             return 0
 
-    def import_new_ebooks(self):
+    def _hash(self, path):
+        with tracer.span("library.hash"):
+            data = open(path, 'rb').read()
+            tracer.count("bytes_hashed", len(data))
+            return hashlib.sha1(data).hexdigest()
+
+    def _import_ebook(self, ebook, already_imported):
+        """ Imports an ebook of import_dir, unless it is a duplicate or its
+        metadata is incomplete. Returns True if it was imported. """
+        ebook_candidate_full_path = os.path.join(self.config["import_dir"],
+                                                 ebook)
+
+        # check for duplicate hash
+        new_hash = None
+        same_fingerprint = already_imported.get(
+            fingerprint(ebook_candidate_full_path), [])
+        if same_fingerprint != []:
+            new_hash = self._hash(ebook_candidate_full_path)
+            if new_hash in [self._hash(el) for el in same_fingerprint]:
+                print(" -> skipping already imported: ", ebook)
+                return False
+
+        # check for complete metadata
+        temp_ebook = Epub(ebook_candidate_full_path,
+                          self.config["library_dir"],
+                          self.config["author_aliases"],
+                          self.ebook_filename_template)
+        temp_ebook.open_ebook_metadata()
+        if not temp_ebook.librarian_metadata.is_complete:
+            print(" -> skipping ebook with incomplete metadata: ", ebook)
+            return False
+
+        # check if book not already in library
+        already_in_db = False
+        for eb in self.ebooks:
+            same_authors = (eb.librarian_metadata.get_values("author") ==
+                            temp_ebook.librarian_metadata.get_values("author"))
+            same_title = (eb.librarian_metadata.get_values("title") ==
+                          temp_ebook.librarian_metadata.get_values("title"))
+            if same_authors and same_title:
+                already_in_db = True
+                break
+        if already_in_db:
+            print(" -> library already contains an entry for: ",
+                  temp_ebook.librarian_metadata.get_values("author")[0],
+                  " - ", temp_ebook.librarian_metadata.get_values("title")[0],
+                  ": ", ebook)
+            return False
+
+        if self.config.get("interactive", True):
+            print("About to import: %s" % str(temp_ebook))
+            answer = input("Confirm? \ny/n? ")
+            if answer.lower() == "n":
+                print(" -> skipping ebook ", ebook)
+                return False
+
+        # if all checks are ok, importing
+        print(" ->", ebook)
+        if self.blob_store is not None:
+            if new_hash is None:
+                new_hash = self._hash(ebook_candidate_full_path)
+            self.blob_store.store(ebook_candidate_full_path, new_hash)
+        # backup
+        if self.config["backup_imported_ebooks"]:
+            # backup original mobi version if it exists
+            mobi_full_path = ebook_candidate_full_path.replace(".epub",
+                                                               ".mobi")
+            if os.path.exists(mobi_full_path):
+                shutil.move(mobi_full_path,
+                            os.path.join(self.config["imported_dir"],
+                                         ebook.replace(".epub", ".mobi")))
+            backup = os.path.join(self.config["imported_dir"], ebook)
+            if self.blob_store is not None:
+                self.blob_store.copy(ebook_candidate_full_path, new_hash,
+                                     backup)
+            else:
+                shutil.copyfile(ebook_candidate_full_path, backup)
+        # import
+        shutil.move(ebook_candidate_full_path,
+                    os.path.join(self.config["library_dir"], ebook))
+        return True
+
+    @traced("library.import_new_ebooks")
+    def import_new_ebooks(self, candidates=None):
+        # only the candidates (full paths) are imported, if specified
+        if candidates is not None:
+            candidates = set(candidates)
         # multithreaded conversion to epub before import, if necessary
         cpt = 1
         all_mobis = [os.path.join(self.config["import_dir"], el)
                      for el in os.listdir(self.config["import_dir"])
                      if el.endswith(".mobi")]
+        if candidates is not None:
+            all_mobis = [el for el in all_mobis if el in candidates]
+            candidates.update([el.replace(".mobi", ".epub")
+                               for el in all_mobis])
         with ThreadPoolExecutor(max_workers=cpu_count()) as executor:
             future_epubs = {
                 executor.submit(self._convert_to_epub_before_importing,
@@ -208,6 +617,10 @@ class Library(object):
 
         all_ebooks = [el for el in os.listdir(self.config["import_dir"])
                       if el.endswith(".epub")]
+        if candidates is not None:
+            all_ebooks = [el for el in all_ebooks
+                          if os.path.join(self.config["import_dir"], el)
+                          in candidates]
         if len(all_ebooks) == 0:
             print("Nothing new to import.")
             return False
@@ -219,78 +632,22 @@ class Library(object):
                                        in os.listdir(
                                            self.config["imported_dir"])
                                        if el.endswith(".epub")]
-        already_imported_hashes = []
+        # identical ebooks have the same fingerprint: only ebooks with
+        # the same fingerprint need to be hashed to find duplicates
+        already_imported = defaultdict(list)
         for eb in all_already_imported_ebooks:
-            already_imported_hashes.append(
-                hashlib.sha1(open(os.path.join(self.config["imported_dir"],
-                                               eb),
-                                  'rb').read()).hexdigest())
+            path = os.path.join(self.config["imported_dir"], eb)
+            already_imported[fingerprint(path)].append(path)
 
         start = time.perf_counter()
         imported_count = 0
         for ebook in all_ebooks:
-            ebook_candidate_full_path = os.path.join(self.config["import_dir"],
-                                                     ebook)
-
-            # check for duplicate hash
-            new_hash = hashlib.sha1(open(ebook_candidate_full_path,
-                                         'rb').read()).hexdigest()
-            if new_hash in already_imported_hashes:
-                print(" -> skipping already imported: ", ebook)
-                continue
-
-            # check for complete metadata
-            temp_ebook = Epub(ebook_candidate_full_path,
-                              self.config["library_dir"],
-                              self.config["author_aliases"],
-                              self.ebook_filename_template)
-            temp_ebook.open_ebook_metadata()
-            if not temp_ebook.librarian_metadata.is_complete:
-                print(" -> skipping ebook with incomplete metadata: ", ebook)
-                continue
-
-            # check if book not already in library
-            already_in_db = False
-            for eb in self.ebooks:
-                same_authors = (eb.librarian_metadata.get_values("author") ==
-                                temp_ebook.librarian_metadata.get_values("author"))
-                same_title = (eb.librarian_metadata.get_values("title") ==
-                              temp_ebook.librarian_metadata.get_values("title"))
-                if same_authors and same_title:
-                    already_in_db = True
-                    break
-            if already_in_db:
-                print(" -> library already contains an entry for: ",
-                      temp_ebook.librarian_metadata.get_values("author")[0],
-                      " - ", temp_ebook.librarian_metadata.get_values("title")[0],
-                      ": ", ebook)
-                continue
-
-            if self.config.get("interactive", True):
-                print("About to import: %s" % str(temp_ebook))
-                answer = input("Confirm? \ny/n? ")
-                if answer.lower() == "n":
-                    print(" -> skipping ebook ", ebook)
-                    continue
-
-            # if all checks are ok, importing
-            print(" ->", ebook)
-            # backup
-            if self.config["backup_imported_ebooks"]:
-                # backup original mobi version if it exists
-                mobi_full_path = ebook_candidate_full_path.replace(".epub",
-                                                                   ".mobi")
-                if os.path.exists(mobi_full_path):
-                    shutil.move(mobi_full_path,
-                                os.path.join(self.config["imported_dir"],
-                                             ebook.replace(".epub", ".mobi")))
-                shutil.copyfile(ebook_candidate_full_path,
-                                os.path.join(self.config["imported_dir"],
-                                             ebook))
-            # import
-            shutil.move(ebook_candidate_full_path,
-                        os.path.join(self.config["library_dir"], ebook))
-            imported_count += 1
+            try:
+                if self._import_ebook(ebook, already_imported):
+                    imported_count += 1
+            except Exception as err:
+                # unreadable, or not completely written yet
+                print(" -> Cannot import %s: %s" % (ebook, err))
         print("Imported ebooks in %.2fs." % (time.perf_counter() - start))
 
         if imported_count != 0:
@@ -298,9 +655,25 @@ class Library(object):
         else:
             return False
 
+    def update_smart_collections(self):
+        """ Searches the ebooks that changed since the last update again,
+        for every smart collection. """
+        self.smart_collections.update(self.ebooks, self.change_log,
+                                      self.search_text, self.numeric_index)
+
+    def collections_entry(self, ebook):
+        entry = [ebook.read.name]
+        collections = ebook.tags + [el for el in
+                                    self.smart_collections.names(ebook)
+                                    if el not in ebook.tags]
+        if collections != []:
+            entry.append(collections)
+        return entry
+
     def update_kindle_collections(self, outfile, filtered=[]):
         # generates the json file that is used
         # by the kual script in librariansync/
+        self.update_smart_collections()
         if filtered == []:
             ebooks_to_sync = self.ebooks
         else:
@@ -310,15 +683,14 @@ class Library(object):
             relative_path = os.path.join(
                 self.config["kindle_documents_subdir"],
                 eb.exported_filename)
-            tags_json[relative_path] = [eb.read.name]
-            if eb.tags != []:
-                tags_json[relative_path].append(eb.tags)
+            tags_json[relative_path] = self.collections_entry(eb)
 
         f = codecs.open(outfile, "w", "utf8")
         f.write(json.dumps(tags_json, sort_keys=True, indent=2,
                            separators=(',', ': '), ensure_ascii=False))
         f.close()
 
+    @traced("library.sync_with_kindle")
     def sync_with_kindle(self, filtered=[], kindle_sync=True,
                          destination_dir=None):
         if filtered == []:
@@ -352,10 +724,11 @@ class Library(object):
         # list all mobi/epub files in KINDLE_DOCUMENTS/destination_dir
         print(" -> Listing existing ebooks.")
         all_ebooks = []
-        for root, dirs, files in os.walk(output_dir):
-            all_ebooks.extend([os.path.join(root, file)
-                               for file in files
-                               if os.path.splitext(file)[1] == file_type])
+        with tracer.span("sync.list_files"):
+            for root, dirs, files in os.walk(output_dir):
+                all_ebooks.extend([os.path.join(root, file)
+                                   for file in files
+                                   if os.path.splitext(file)[1] == file_type])
 
         # sync books / convert to mobi
         print(" -> Syncing library.")
@@ -368,20 +741,23 @@ class Library(object):
             # directories.
             threads = 1
 
-        with ThreadPoolExecutor(max_workers=threads) as executor:
+        with tracer.span("sync.ebooks"), \
+                ThreadPoolExecutor(max_workers=threads) as executor:
             sorted_ebooks = sorted(ebooks_to_sync, key=lambda x: x.filename)
             if kindle_sync:
                 all_sync = {
                     executor.submit(eb.sync_with_kindle,
                                     self.config["kindle_documents"],
-                                    self.config["mobi_dir"]): eb for eb
+                                    self.config["mobi_dir"],
+                                    self.blob_store): eb for eb
                     in sorted_ebooks
                     }
             else:
                 all_sync = {
                     executor.submit(eb.sync_with_kindle,
                                     destination_dir,
-                                    None): eb for eb in sorted_ebooks
+                                    None, self.blob_store): eb
+                    for eb in sorted_ebooks
                     }
             for future in as_completed(all_sync):
                 ebook = all_sync[future]
@@ -399,16 +775,17 @@ class Library(object):
 
         # delete mobis on kindle that are not in library anymore
         print(" -> Removing obsolete ebooks.")
-        for eb in all_ebooks:
-            print("    + ", eb)
-            os.remove(eb)
-
-        # remove empty dirs in KINDLE_DOCUMENTS
-        for root, dirs, files in os.walk(output_dir, topdown=False):
-            for dir in [os.path.join(root, el)
-                        for el in dirs
-                        if os.listdir(os.path.join(root, el)) == []]:
-                os.rmdir(dir)
+        with tracer.span("sync.remove_obsolete"):
+            for eb in all_ebooks:
+                print("    + ", eb)
+                os.remove(eb)
+
+            # remove empty dirs in KINDLE_DOCUMENTS
+            for root, dirs, files in os.walk(output_dir, topdown=False):
+                for dir in [os.path.join(root, el)
+                            for el in dirs
+                            if os.listdir(os.path.join(root, el)) == []]:
+                    os.rmdir(dir)
 
         # sync collections.json
         if kindle_sync:
@@ -421,6 +798,146 @@ class Library(object):
 
         print("Library synced in %.2fs." % (time.perf_counter() - start))
 
+    @traced("library.deduplicate")
+    def deduplicate(self):
+        """ Replaces identical files of the library, the imported backups
+        and the mobi folder by hardlinks to the blob store. """
+        start = time.perf_counter()
+        store = BlobStore(self.config["blobs_dir"])
+        paths = [eb.path for eb in self.ebooks]
+        for directory in [self.config["imported_dir"],
+                          self.config["mobi_dir"]]:
+            for root, dirs, files in os.walk(directory):
+                paths.extend([os.path.join(root, el) for el in files])
+        print("Deduplicating %s files..." % len(paths))
+        with ThreadPoolExecutor(max_workers=cpu_count()) as executor:
+            saved = list(executor.map(store.store, paths))
+        for (path, result) in zip(paths, saved):
+            if result is None:
+                print(" -> Cannot link %s" % path)
+        print("%.1fMB saved in %.2fs." %
+              (sum([el for el in saved if el is not None]) / 1024 / 1024,
+               time.perf_counter() - start))
+        self.show_storage(store)
+
+    def show_storage(self, store):
+        stored, saved = store.usage()
+        print("Blob store: %.1fMB, saving %.1fMB of copies." %
+              (stored / 1024 / 1024, saved / 1024 / 1024))
+
+    @traced("library.collect_garbage")
+    def collect_garbage(self):
+        store = BlobStore(self.config["blobs_dir"])
+        removed, reclaimed = store.gc()
+        print("Removed %s unused blobs, %.1fMB reclaimed." %
+              (removed, reclaimed / 1024 / 1024))
+        self.show_storage(store)
+
+    @traced("library.check_integrity")
+    def check_integrity(self, rate=None):
+        """ Verifies the zip archives and hashes of all ebooks, reading at
+        most rate bytes per second. Returns True if problems were found. """
+        from librarianlib.fsck import IntegrityCheck
+        check = IntegrityCheck(self.config["fsck_state"], rate)
+        try:
+            problems = check.run(self.ebooks, self.missing)
+        finally:
+            check.close()
+        if problems == {}:
+            print("No problem found.")
+            return False
+        print("Problems found:")
+        for (path, (problem, details)) in sorted(problems.items()):
+            if details:
+                print(" -> %s: %s (%s)" % (problem.upper(), path, details))
+            else:
+                print(" -> %s: %s" % (problem.upper(), path))
+        return True
+
+    @traced("library.update_text_index")
+    def update_text_index(self):
+        # html.parser is only needed here
+        from librarianlib.fulltext import FullTextIndex
+        index = FullTextIndex(self.config["fulltext_index"])
+        try:
+            read, removed = index.update(self.ebooks)
+            if removed != 0:
+                print("Removed %s deleted ebooks from the full-text index." %
+                      removed)
+            if read == 0 and removed == 0:
+                print("Full-text index is up to date.")
+        finally:
+            index.close()
+
+    @traced("library.update_covers")
+    def update_covers(self):
+        """ Returns the thumbnail cache, after extracting the covers of
+        the ebooks that changed. """
+        from librarianlib.covers import CoverCache
+        covers = CoverCache(self.config["covers_dir"])
+        covers.update(self.ebooks)
+        return covers
+
+    def numeric_index(self, field):
+        """ Sorted values of a numeric field, for range queries, kept
+        until the library changes. """
+        from librarianlib.ebook_search import NumericIndex
+        key = (self.change_log.generation, len(self.ebooks))
+        cached = self.numeric_indexes.get(field, None)
+        if cached is None or cached[0] != key:
+            with tracer.span("search.numeric_index"):
+                cached = (key, NumericIndex(self.ebooks, field))
+            self.numeric_indexes[field] = cached
+        return cached[1]
+
+    def similar_ebooks(self, ebooks, count=10):
+        """ Returns [(ebook, similarity)] for the count ebooks most
+        similar to ebooks, best first. The similarity model is cached until
+        the library changes. """
+        from librarianlib.similarity import SimilarityModel
+        start = time.perf_counter()
+        key = "%s/%s" % (self.change_log.generation, len(self.ebooks))
+        if self.similarity is None or self.similarity.key != key:
+            self.similarity = SimilarityModel.load(
+                self.config["similarity_cache"], key)
+            if self.similarity is None:
+                print("Building the similarity model...")
+                self.similarity = SimilarityModel.build(key, self.ebooks)
+                self.similarity.save(self.config["similarity_cache"])
+        by_path = {eb.path: eb for eb in self.ebooks}
+        similar = [(by_path[path], score) for (path, score)
+                   in self.similarity.most_similar([eb.path for eb in ebooks],
+                                                   count)]
+        print("Similar ebooks found in %.2fs." % (time.perf_counter() - start))
+        return similar
+
+    def log_slow_query(self, search):
+        """ Appends searches slower than slow_query_threshold (in
+        milliseconds) to the slow query log. """
+        threshold = self.config.get("slow_query_threshold", None)
+        seconds = search.duration + search.prepare_time
+        if threshold is None or 1000 * seconds < threshold:
+            return
+        entry = {"time": time.strftime("%Y-%m-%d %H:%M:%S"),
+                 "query": search.description,
+                 "ms": round(1000 * search.duration, 1),
+                 "index_ms": round(1000 * search.prepare_time, 1),
+                 "ebooks": len(search.everything),
+                 "results": search.results}
+        with open(self.config["slow_query_log"], "a") as log:
+            log.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+    def search_text(self, query):
+        """ Returns {path: score} for the ebooks whose contents match the
+        query, after indexing the ebooks that changed. """
+        from librarianlib.fulltext import FullTextIndex
+        index = FullTextIndex(self.config["fulltext_index"])
+        try:
+            index.update(self.ebooks)
+            return index.search(query)
+        finally:
+            index.close()
+
     def list_incomplete_metadata(self):
         found_incomplete = False
         incomplete_list = ""
@@ -434,21 +951,38 @@ class Library(object):
         return found_incomplete
 
     def serve(self, filtered=[], kindle_sync=True):
+        # http.server and xml.sax are only needed here, and slow to import
+        from librarianlib.librarian_server import LibrarianServer, \
+            LibrarianHandler
+        from librarianlib.opds import OpdsCatalog
+
         if filtered == []:
             ebooks_to_serve = self.ebooks
         else:
             ebooks_to_serve = filtered
 
+        converter = None
         if not kindle_sync:
             allowed = [el.path for el in ebooks_to_serve]
             local_root = self.config["library_dir"]
+            served_path = lambda x: os.path.relpath(x.path, local_root)
+            removed_field = "filename"
         else:
-            for eb in ebooks_to_serve:
-                eb.export_to_mobi(self.config["mobi_dir"])
+            # mobis are converted when first requested, or in the background
+            converter = MobiConversionQueue(ebooks_to_serve,
+                                            self.config["mobi_dir"])
             allowed = [os.path.join(self.config["mobi_dir"],
                                     el.exported_filename)
                        for el in ebooks_to_serve]
             local_root = self.config["mobi_dir"]
+            served_path = lambda x: x.exported_filename
+            removed_field = "exported_filename"
+        covers = self.update_covers()
+        self.update_smart_collections()
+        catalog = OpdsCatalog(ebooks_to_serve, served_path, covers)
+        change_feed = ChangeFeed(self.change_log, ebooks_to_serve,
+                                 served_path, removed_field,
+                                 self.collections_entry)
 
         # create partial collections
         self.update_kindle_collections(self.config["collections"], filtered)
@@ -457,8 +991,16 @@ class Library(object):
         server = LibrarianServer((self.config["server"]["IP"],
                                   self.config["server"]["port"]),
                                  LibrarianHandler, allowed,
-                                 local_root, self.config["collections"])
-        server.serve_forever()
+                                 local_root, self.config["collections"],
+                                 converter, catalog, change_feed, covers)
+        if converter is not None:
+            converter.start_prefetching()
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            if converter is not None:
+                converter.shutdown()
 
         # removing collections json
         os.remove(self.config["collections"])
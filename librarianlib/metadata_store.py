@@ -0,0 +1,152 @@
+import threading
+
+from librarianlib.epub_metadata import EbookMetadata, METADATA_ALIASES, \
+    SHARED_FIELDS
+
+
+class MetadataStore(object):
+    """ Column-oriented storage for the metadata of a whole library: one
+    list per field, indexed by row (one row per ebook). A cell holds the
+    value itself when there is only one (the usual case), a tuple
+    otherwise, or None if the ebook does not have this field. Values of
+    shared fields are only kept once. Rows of ebooks that left the library
+    are released, and reused. """
+    __slots__ = ("columns", "rows", "shared", "lock", "free")
+
+    def __init__(self):
+        self.columns = {}
+        self.rows = 0
+        self.shared = {}
+        self.lock = threading.Lock()
+        # released rows, all cells None
+        self.free = []
+
+    def add_row(self):
+        with self.lock:
+            if self.free != []:
+                return self.free.pop()
+            row = self.rows
+            self.rows += 1
+            for column in self.columns.values():
+                column.append(None)
+        return row
+
+    def _column(self, field):
+        column = self.columns.get(field, None)
+        if column is None:
+            with self.lock:
+                column = self.columns.setdefault(field,
+                                                 [None] * self.rows)
+        return column
+
+    def get(self, row, field):
+        column = self.columns.get(field, None)
+        if column is None:
+            return None
+        cell = column[row]
+        if cell is None:
+            return None
+        if isinstance(cell, str):
+            return [cell]
+        return list(cell)
+
+    def set(self, row, field, values):
+        if values is None:
+            cell = None
+        elif len(values) == 1 and isinstance(values[0], str):
+            cell = values[0]
+        else:
+            cell = tuple(values)
+        if cell is not None and field in SHARED_FIELDS:
+            cell = self.shared.setdefault(cell, cell)
+        self._column(field)[row] = cell
+
+    def fields(self, row):
+        return sorted([field for (field, column) in self.columns.items()
+                       if column[row] is not None])
+
+    def row_dict(self, row):
+        values = {}
+        for (field, column) in self.columns.items():
+            cell = column[row]
+            if cell is None:
+                continue
+            if isinstance(cell, str):
+                values[field] = [cell]
+            else:
+                values[field] = list(cell)
+        return values
+
+    def clear(self, row):
+        for column in self.columns.values():
+            column[row] = None
+
+    def release(self, row):
+        with self.lock:
+            self.clear(row)
+            self.free.append(row)
+
+
+class StoredMetadata(EbookMetadata):
+    """ Same interface as FakeOpfFile, for metadata kept in a
+    MetadataStore. """
+    __slots__ = ("store", "row")
+
+    def __init__(self, store, entries, author_aliases):
+        super().__init__(author_aliases)
+        self.store = store
+        self.row = store.add_row()
+        for (key, values) in entries.items():
+            store.set(self.row, key, values)
+
+    @property
+    def keys(self):
+        return self.store.fields(self.row)
+
+    @property
+    def metadata_dict(self):
+        return self.store.row_dict(self.row)
+
+    def get_values(self, name):
+        name = METADATA_ALIASES.get(name, name)
+        values = self.store.get(self.row, name)
+        if values is None:
+            return []
+        return values
+
+    def release(self):
+        # the row is given to the next ebook, this must not be used anymore
+        self.store.release(self.row)
+        self.row = None
+
+    def _save_state(self):
+        return self.metadata_dict
+
+    def _restore_state(self, state):
+        self.store.clear(self.row)
+        for (key, values) in state.items():
+            self.store.set(self.row, key, values)
+
+    def _update_aliases(self, name):
+        for alias in METADATA_ALIASES.keys():
+            if METADATA_ALIASES[alias] == name and \
+                    self.store.get(self.row, alias) is not None:
+                self.store.set(self.row, alias,
+                               self.store.get(self.row, name))
+
+    def set_value(self, name, value, replace=False):
+        name = METADATA_ALIASES.get(name, name)
+        old_values = list(self.get_values(name))
+        if replace:
+            self.store.set(self.row, name, [value])
+        elif value not in old_values:
+            self.store.set(self.row, name, old_values + [value])
+        self._update_aliases(name)
+        return self._record_change(name, old_values)
+
+    def set_values(self, name, values):
+        name = METADATA_ALIASES.get(name, name)
+        old_values = list(self.get_values(name))
+        self.store.set(self.row, name, list(values))
+        self._update_aliases(name)
+        return self._record_change(name, old_values)
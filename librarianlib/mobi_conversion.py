@@ -0,0 +1,72 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import cpu_count
+
+from librarianlib.epub import ReadStatus
+
+# ebooks being read are the most likely to be requested first
+PREFETCH_PRIORITY = {
+    ReadStatus.reading: 0,
+    ReadStatus.unread: 1,
+    ReadStatus.read: 2,
+}
+
+
+class MobiConversionQueue(object):
+    """ Converts ebooks to mobi on demand while serving them.
+    Concurrent requests for the same ebook wait for a single conversion,
+    and a background prefetcher converts the remaining ebooks one at a time
+    so that on-demand requests always find a free worker. """
+
+    def __init__(self, ebooks, mobi_dir, max_workers=None):
+        self.mobi_dir = mobi_dir
+        self.ebooks = {eb.exported_filename: eb for eb in ebooks}
+        self.lock = threading.Lock()
+        self.conversions = {}
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers or cpu_count())
+        self.stop_prefetching = threading.Event()
+        self.prefetcher = None
+
+    def _convert(self, ebook):
+        ebook.export_to_mobi(self.mobi_dir)
+        return os.path.join(self.mobi_dir, ebook.exported_filename)
+
+    def request(self, exported_filename):
+        # returns a future, shared by all callers asking for the same ebook
+        with self.lock:
+            future = self.conversions.get(exported_filename, None)
+            if future is None or (future.done() and
+                                  future.exception() is not None):
+                ebook = self.ebooks[exported_filename]
+                future = self.executor.submit(self._convert, ebook)
+                self.conversions[exported_filename] = future
+        return future
+
+    def convert(self, exported_filename):
+        # blocks until the mobi is available
+        return self.request(exported_filename).result()
+
+    def _prefetch(self):
+        to_convert = sorted(self.ebooks.values(),
+                            key=lambda x: (PREFETCH_PRIORITY[x.read],
+                                           x.filename))
+        for ebook in to_convert:
+            if self.stop_prefetching.is_set():
+                break
+            try:
+                self.convert(ebook.exported_filename)
+            except Exception as err:
+                if self.stop_prefetching.is_set():
+                    break
+                print("Error converting %s: %s" % (ebook.filename, err))
+
+    def start_prefetching(self):
+        self.prefetcher = threading.Thread(target=self._prefetch)
+        self.prefetcher.daemon = True
+        self.prefetcher.start()
+
+    def shutdown(self):
+        self.stop_prefetching.set()
+        self.executor.shutdown(wait=True, cancel_futures=True)
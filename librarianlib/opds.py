@@ -0,0 +1,249 @@
+import os
+import time
+import hashlib
+import mimetypes
+import threading
+from collections import OrderedDict, defaultdict
+from urllib.parse import quote
+from xml.sax.saxutils import escape, quoteattr
+
+NAVIGATION = "application/atom+xml;profile=opds-catalog;kind=navigation"
+ACQUISITION = "application/atom+xml;profile=opds-catalog;kind=acquisition"
+ACQUISITION_REL = "http://opds-spec.org/acquisition"
+IMAGE_REL = "http://opds-spec.org/image"
+THUMBNAIL_REL = "http://opds-spec.org/image/thumbnail"
+
+MIMETYPES = {
+    "epub": "application/epub+zip",
+    "mobi": "application/x-mobipocket-ebook",
+}
+
+FACETS = OrderedDict([
+    ("author", "Authors"),
+    ("tag", "Tags"),
+    ("series", "Series"),
+    ("progress", "Progress"),
+])
+
+FEED_HEADER = """<?xml version="1.0" encoding="utf-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom" \
+xmlns:dc="http://purl.org/dc/terms/" \
+xmlns:opds="http://opds-spec.org/2010/catalog" \
+xmlns:opensearch="http://a9.com/-/spec/opensearch/1.1/">
+  <id>%s</id>
+  <title>%s</title>
+  <updated>%s</updated>
+  <author><name>librarian</name></author>
+"""
+
+
+def timestamp(seconds):
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(seconds))
+
+
+def link(rel, href, link_type):
+    return "  <link rel=%s href=%s type=%s/>\n" % (quoteattr(rel),
+                                                   quoteattr(href),
+                                                   quoteattr(link_type))
+
+
+def series_index_key(ebook):
+    try:
+        return float(ebook.librarian_metadata.get_values("series_index")[0])
+    except (IndexError, ValueError):
+        return 0
+
+
+class OpdsCatalog(object):
+    """ Paginated OPDS catalog of served ebooks, browsable by author, tag,
+    series, progress, or most recently modified.
+    Rendered pages are kept in a LRU cache along with their ETag. """
+
+    def __init__(self, ebooks, served_path, covers=None, page_size=50,
+                 cache_size=256):
+        self.ebooks = sorted(ebooks, key=lambda x: x.filename)
+        # returns the path (relative to the server root) of an ebook
+        self.served_path = served_path
+        # CoverCache, if covers are served
+        self.covers = covers
+        self.page_size = page_size
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.updated = timestamp(time.time())
+        self._facets = None
+        self._recent = None
+
+    def _facet_values(self, ebook, facet):
+        if facet == "tag":
+            return ebook.tags or ["untagged"]
+        elif facet == "progress":
+            return [ebook.read.name]
+        else:
+            return ebook.librarian_metadata.get_values(facet)
+
+    @property
+    def facets(self):
+        if self._facets is None:
+            facets = {}
+            for facet in FACETS.keys():
+                facets[facet] = defaultdict(list)
+                for ebook in self.ebooks:
+                    for value in set(self._facet_values(ebook, facet)):
+                        facets[facet][value].append(ebook)
+            for ebooks in facets["series"].values():
+                ebooks.sort(key=series_index_key)
+            self._facets = facets
+        return self._facets
+
+    @property
+    def recent(self):
+        if self._recent is None:
+            self._recent = sorted(self.ebooks,
+                                  key=lambda x: os.path.getmtime(x.path),
+                                  reverse=True)
+        return self._recent
+
+    def render(self, path, page=1):
+        """ Returns (body, etag, feed type) for the OPDS path, or None if
+        the path is unknown. """
+        key = (path, page)
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+        rendered = self._render(path, page)
+        if rendered is None:
+            return None
+        body = rendered[0].encode("utf8")
+        result = (body, '"%s"' % hashlib.sha1(body).hexdigest(), rendered[1])
+        with self.lock:
+            self.cache[key] = result
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return result
+
+    def _render(self, path, page):
+        parts = path.strip("/").split("/", 2)
+        if parts[0] != "opds":
+            return None
+        if len(parts) == 1:
+            return self._root_feed(), NAVIGATION
+        if parts[1] == "recent" and len(parts) == 2:
+            return self._acquisition_feed(path, "Recently modified",
+                                          self.recent, page), ACQUISITION
+        if parts[1] not in FACETS.keys():
+            return None
+        facet = self.facets[parts[1]]
+        if len(parts) == 2:
+            return self._facet_feed(path, parts[1], facet, page), NAVIGATION
+        if parts[2] not in facet.keys():
+            return None
+        return self._acquisition_feed(path, parts[2], facet[parts[2]],
+                                      page), ACQUISITION
+
+    def _page(self, items, page):
+        last_page = max(1, (len(items) + self.page_size - 1) //
+                        self.page_size)
+        page = min(max(1, page), last_page)
+        start = (page - 1) * self.page_size
+        return items[start:start + self.page_size], page, last_page
+
+    def _feed_start(self, path, title, feed_type, page, last_page, total):
+        href = "/" + quote(path)
+        feed = FEED_HEADER % (escape("urn:librarian:%s" % path),
+                              escape(title), self.updated)
+        feed += link("self", "%s?page=%s" % (href, page), feed_type)
+        feed += link("start", "/opds", NAVIGATION)
+        feed += link("first", "%s?page=1" % href, feed_type)
+        feed += link("last", "%s?page=%s" % (href, last_page), feed_type)
+        if page > 1:
+            feed += link("previous", "%s?page=%s" % (href, page - 1),
+                         feed_type)
+        if page < last_page:
+            feed += link("next", "%s?page=%s" % (href, page + 1), feed_type)
+        feed += "  <opensearch:totalResults>%s</opensearch:totalResults>\n" \
+            % total
+        feed += "  <opensearch:itemsPerPage>%s</opensearch:itemsPerPage>\n" \
+            % self.page_size
+        return feed
+
+    def _navigation_entry(self, title, href, content):
+        return """  <entry>
+    <title>%s</title>
+    <id>%s</id>
+    <updated>%s</updated>
+    <content type="text">%s</content>
+  %s  </entry>
+""" % (escape(title), escape("urn:librarian:%s" % href), self.updated,
+            escape(content), link("subsection", href, NAVIGATION))
+
+    def _root_feed(self):
+        feed = FEED_HEADER % ("urn:librarian:opds", "Librarian",
+                              self.updated)
+        feed += link("self", "/opds", NAVIGATION)
+        feed += link("start", "/opds", NAVIGATION)
+        for facet, title in FACETS.items():
+            feed += self._navigation_entry(
+                title, "/opds/%s" % facet,
+                "%s %s" % (len(self.facets[facet]), title.lower()))
+        feed += self._navigation_entry("Recently modified", "/opds/recent",
+                                       "%s ebooks" % len(self.ebooks))
+        return feed + "</feed>\n"
+
+    def _facet_feed(self, path, facet, values, page):
+        all_values = sorted(values.keys())
+        selection, page, last_page = self._page(all_values, page)
+        feed = self._feed_start(path, FACETS[facet], NAVIGATION, page,
+                                last_page, len(all_values))
+        for value in selection:
+            feed += self._navigation_entry(
+                value, "/opds/%s/%s" % (facet, quote(value, safe="")),
+                "%s ebooks" % len(values[value]))
+        return feed + "</feed>\n"
+
+    def _acquisition_feed(self, path, title, ebooks, page):
+        selection, page, last_page = self._page(ebooks, page)
+        feed = self._feed_start(path, title, ACQUISITION, page, last_page,
+                                len(ebooks))
+        for ebook in selection:
+            feed += self._ebook_entry(ebook)
+        return feed + "</feed>\n"
+
+    def _ebook_entry(self, ebook):
+        metadata = ebook.librarian_metadata
+        served = self.served_path(ebook)
+        extension = os.path.splitext(served)[1][1:].lower()
+        entry = "  <entry>\n"
+        entry += "    <title>%s</title>\n" % escape(
+            metadata.get_values("title")[0])
+        entry += "    <id>urn:librarian:book:%s</id>\n" % \
+            hashlib.sha1(served.encode("utf8")).hexdigest()
+        entry += "    <updated>%s</updated>\n" % timestamp(
+            os.path.getmtime(ebook.path))
+        for author in metadata.get_values("author"):
+            entry += "    <author><name>%s</name></author>\n" % escape(author)
+        for year in metadata.get_values("year")[:1]:
+            entry += "    <dc:issued>%s</dc:issued>\n" % escape(year)
+        for tag in ebook.tags:
+            entry += "    <category term=%s label=%s/>\n" % (quoteattr(tag),
+                                                            quoteattr(tag))
+        series = metadata.get_values("series")
+        if series != []:
+            entry += "    <category term=%s label=%s/>\n" % (
+                quoteattr("series:%s" % series[0]), quoteattr(series[0]))
+        for description in metadata.get_values("description")[:1]:
+            if description is not None:
+                entry += "    <summary>%s</summary>\n" % escape(description)
+        cover = None
+        if self.covers is not None:
+            cover = self.covers.cover(ebook.path)
+        if cover is not None:
+            cover_type = mimetypes.guess_type(cover)[0] or "image/jpeg"
+            entry += "  " + link(IMAGE_REL, "/covers/" + cover, cover_type)
+            entry += "  " + link(THUMBNAIL_REL, "/covers/" + cover,
+                                 cover_type)
+        entry += "  " + link(ACQUISITION_REL, "/" + quote(served),
+                             MIMETYPES.get(extension,
+                                           "application/octet-stream"))
+        return entry + "  </entry>\n"
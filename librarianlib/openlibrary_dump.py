@@ -0,0 +1,203 @@
+import os
+import re
+import gzip
+import json
+import time
+import sqlite3
+import unicodedata
+
+from .openlibrary_search import SearchResult
+
+
+def normalize(text):
+    # lowercase, without accents or punctuation
+    text = unicodedata.normalize("NFKD", text)
+    text = "".join([c for c in text if not unicodedata.combining(c)])
+    return " ".join(re.findall(r"\w+", text.lower()))
+
+
+def normalize_author(name):
+    # "Last, First" and "First Last" give the same key
+    return " ".join(sorted(normalize(name).split()))
+
+
+def match_key(author, title):
+    return "%s|%s" % (normalize_author(author), normalize(title))
+
+
+def read_dump(path):
+    """ Yields the json records of an OpenLibrary dump, either in the
+    official tab-separated format (json in the last column) or as json
+    lines, optionally gzipped. """
+    if path.endswith(".gz"):
+        dump = gzip.open(path, "rt", encoding="utf8")
+    else:
+        dump = open(path, "r", encoding="utf8")
+    with dump:
+        for line in dump:
+            line = line.strip()
+            if line == "":
+                continue
+            if not line.startswith("{"):
+                line = line.split("\t")[-1]
+            try:
+                yield json.loads(line)
+            except ValueError:
+                continue
+
+
+def batches(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch != []:
+        yield batch
+
+
+def _authors(dump_path):
+    for record in read_dump(dump_path):
+        if "key" in record and "name" in record:
+            yield (record["key"], record["name"])
+
+
+def _description(record):
+    description = record.get("description", "")
+    if isinstance(description, dict):
+        description = description.get("value", "")
+    if not isinstance(description, str):
+        return ""
+    return description
+
+
+def _year(record):
+    year = re.search(r"\d{4}", record.get("first_publish_date", ""))
+    if year is None:
+        return None
+    return year.group(0)
+
+
+def _works(dump_path):
+    for record in read_dump(dump_path):
+        if "key" not in record or "title" not in record:
+            continue
+        authors = [el.get("author", {}).get("key", None)
+                   for el in record.get("authors", [])
+                   if isinstance(el, dict) and
+                   isinstance(el.get("author", None), dict)]
+        yield (record["key"], record["title"], _year(record),
+               _description(record), [el for el in authors if el])
+
+
+class OpenLibraryDump(object):
+    """ Local index of an OpenLibrary dump, keyed by normalized
+    author + title, to find metadata without any network access. """
+
+    def __init__(self, index_path):
+        self.index_path = index_path
+
+    @property
+    def exists(self):
+        return os.path.exists(self.index_path)
+
+    def build(self, authors_dump, works_dump, batch_size=10000):
+        start = time.perf_counter()
+        temp_index = self.index_path + ".tmp"
+        if os.path.exists(temp_index):
+            os.remove(temp_index)
+        db = sqlite3.connect(temp_index)
+        db.create_function("match_key", 2, match_key)
+        db.executescript("""
+            PRAGMA journal_mode = OFF;
+            PRAGMA synchronous = OFF;
+            CREATE TABLE authors (key TEXT PRIMARY KEY, name TEXT);
+            CREATE TABLE works (id INTEGER PRIMARY KEY, key TEXT,
+                                title TEXT, year TEXT, description TEXT,
+                                authors TEXT);
+            CREATE TABLE work_authors (work_id INTEGER, author_key TEXT);
+            CREATE TABLE entries (match_key TEXT, work_id INTEGER);
+            """)
+
+        print("Reading authors from %s..." % authors_dump)
+        for batch in batches(_authors(authors_dump), batch_size):
+            db.executemany("INSERT OR REPLACE INTO authors VALUES (?, ?)",
+                           batch)
+
+        print("Reading works from %s..." % works_dump)
+        work_id = 0
+        for batch in batches(_works(works_dump), batch_size):
+            works = []
+            work_authors = []
+            for (key, title, year, description, authors) in batch:
+                work_id += 1
+                works.append((work_id, key, title, year, description))
+                work_authors.extend([(work_id, el) for el in authors])
+            db.executemany("INSERT INTO works (id, key, title, year, "
+                           "description) VALUES (?, ?, ?, ?, ?)", works)
+            db.executemany("INSERT INTO work_authors VALUES (?, ?)",
+                           work_authors)
+
+        print("Indexing %s works..." % work_id)
+        db.executescript("""
+            CREATE INDEX work_authors_id ON work_authors (work_id);
+            UPDATE works SET authors = (
+                SELECT json_group_array(authors.name)
+                FROM work_authors JOIN authors
+                ON authors.key = work_authors.author_key
+                WHERE work_authors.work_id = works.id);
+            INSERT INTO entries
+                SELECT match_key(authors.name, works.title), works.id
+                FROM work_authors
+                JOIN works ON works.id = work_authors.work_id
+                JOIN authors ON authors.key = work_authors.author_key;
+            DROP TABLE work_authors;
+            DROP TABLE authors;
+            DELETE FROM works WHERE id NOT IN (SELECT work_id FROM entries);
+            CREATE INDEX entries_key ON entries (match_key);
+            """)
+        db.commit()
+        db.execute("VACUUM")
+        db.close()
+        os.replace(temp_index, self.index_path)
+        print("OpenLibrary index built in %.2fs." %
+              (time.perf_counter() - start))
+
+    def _best_hit(self, db, ebook):
+        metadata = ebook.librarian_metadata
+        title = metadata.get_values("title")[0]
+        rows = []
+        for author in metadata.get_values("author"):
+            rows.extend(db.execute(
+                "SELECT works.title, works.year, works.description, "
+                "works.authors FROM entries JOIN works "
+                "ON works.id = entries.work_id WHERE entries.match_key = ?",
+                (match_key(author, title),)).fetchall())
+        if rows == []:
+            return None
+        # the earliest work is the most likely original
+        title, year, description, authors = min(
+            rows, key=lambda x: (x[1] is None, x[1] or "", x[2] == ""))
+        hit = {"author_name": json.loads(authors),
+               "title": title}
+        if year is not None:
+            hit["first_publish_year"] = year
+        return SearchResult(hit, description)
+
+    def match(self, ebooks):
+        """ Returns a list of (ebook, SearchResult) for all ebooks found in
+        the index. """
+        start = time.perf_counter()
+        found = []
+        db = sqlite3.connect(self.index_path)
+        try:
+            for ebook in ebooks:
+                result = self._best_hit(db, ebook)
+                if result is not None:
+                    found.append((ebook, result))
+        finally:
+            db.close()
+        print("Matched %s/%s ebooks in %.2fs." %
+              (len(found), len(ebooks), time.perf_counter() - start))
+        return found
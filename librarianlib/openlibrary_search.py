@@ -1,4 +1,11 @@
-import requests
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
 from .epub import unread, reading, read
 
 
@@ -19,10 +26,10 @@ class SearchResult(object):
 
     def _diff(self, field, ebook):
         modified = "%s:\n    %s -> %s"
-        values = ebook.metadata.get_values(field)
+        values = ebook.librarian_metadata.get_values(field)
         if values == []:
             values = ["(not found)"]
-        if ",".join(values) != getattr(self, field):
+        if ",".join(values) != str(getattr(self, field)):
             print(modified % (reading(field.title()), unread(",".join(values)),
                               read(str(getattr(self, field)))))
             return True
@@ -39,22 +46,130 @@ class SearchResult(object):
         pass  # TODO
 
 
+class ResponseCache(object):
+    """ On-disk cache of json responses, one file per url. """
+
+    def __init__(self, cache_dir, ttl):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    def _filename(self, url):
+        return os.path.join(self.cache_dir,
+                            hashlib.sha1(url.encode("utf8")).hexdigest() +
+                            ".json")
+
+    def get(self, url):
+        filename = self._filename(url)
+        try:
+            if time.time() - os.path.getmtime(filename) > self.ttl:
+                return None
+            with open(filename, "r") as cached:
+                return json.load(cached)
+        except (OSError, ValueError):
+            return None
+
+    def set(self, url, response):
+        filename = self._filename(url)
+        temp_filename = "%s.%s" % (filename, threading.get_ident())
+        with open(temp_filename, "w") as cached:
+            json.dump(response, cached, ensure_ascii=False)
+        os.replace(temp_filename, filename)
+
+
 class OpenLibrarySearch(object):
 
-    def __init__(self):
-        self.search_url = "http://openlibrary.org/search.json?%s"
-        self.works_url = "https://openlibrary.org/works/%s.json"
+    def __init__(self, base_url="https://openlibrary.org", cache_dir=None,
+                 ttl=30*24*3600, requests_per_second=2):
+        # requests is slow to import, and only needed for online searches
+        import requests
+        base_url = base_url.rstrip("/")
+        self.search_url = base_url + "/search.json"
+        self.works_url = base_url + "/works/%s.json"
+        self.session = requests.Session()
+        self.cache = None
+        if cache_dir is not None:
+            self.cache = ResponseCache(cache_dir, ttl)
+        # rate limit, shared by all threads
+        self.min_interval = 1 / requests_per_second
+        self.next_request = 0
+        self.rate_lock = threading.Lock()
+        self.descriptions = {}
+        # so that a work is only fetched once, even by concurrent lookups
+        self.description_locks = defaultdict(threading.Lock)
+
+    def _wait_for_turn(self):
+        with self.rate_lock:
+            now = time.monotonic()
+            wait = self.next_request - now
+            self.next_request = max(now, self.next_request) + \
+                self.min_interval
+        if wait > 0:
+            time.sleep(wait)
+
+    def _get_json(self, url, params=None):
+        import requests
+        full_url = requests.Request("GET", url, params=params).prepare().url
+        if self.cache is not None:
+            cached = self.cache.get(full_url)
+            if cached is not None:
+                return cached
+        self._wait_for_turn()
+        response = self.session.get(full_url, timeout=30)
+        response.raise_for_status()
+        response_json = response.json()
+        if self.cache is not None:
+            self.cache.set(full_url, response_json)
+        return response_json
+
+    def get_hits(self, ebook):
+        metadata = ebook.librarian_metadata
+        params = {
+            "author": metadata.get_values("author")[0].replace("-", " "),
+            "title": metadata.get_values("title")[0].replace("-", " "),
+            }
+        hits = self._get_json(self.search_url, params).get("docs", None)
+        if hits is None:
+            return []
+        return hits
+
+    def get_description(self, hit):
+        # works keys are returned either as "/works/OL...W" or "OL...W"
+        key = hit["key"].split("/")[-1]
+        with self.rate_lock:
+            description_lock = self.description_locks[key]
+        with description_lock:
+            if key in self.descriptions:
+                return self.descriptions[key]
+            about_json = self._get_json(self.works_url % key)
+            description = about_json.get("description", None)
+            description_str = ""
+            if isinstance(description, dict):
+                description_str = description.get("value",
+                                                  "no description found.")
+            elif description is not None:
+                description_str = description
+            self.descriptions[key] = description_str
+            return description_str
+
+    def _prefetch_ebook(self, ebook, top_hits):
+        try:
+            for hit in self.get_hits(ebook)[:top_hits]:
+                self.get_description(hit)
+        except Exception as err:
+            print("Error querying OpenLibrary for %s: %s" % (ebook, err))
+
+    def prefetch(self, ebooks, top_hits=3, max_workers=4):
+        # query OpenLibrary for all ebooks at once, within the rate limit
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for ebook in ebooks:
+                executor.submit(self._prefetch_ebook, ebook, top_hits)
 
     def display_hit(self, hits, i):
         assert i < len(hits)
         hit = hits[i]
-        about = requests.get(self.works_url % hit["key"])
-        about_json = about.json()
-        description = about_json.get("description", None)
-        description_str = ""
-        if description is not None:
-            description_str = description.get("value", "no description found.")
-        sr = SearchResult(hit, description_str)
+        sr = SearchResult(hit, self.get_description(hit))
         print(sr)
         rep = input("(A)ccept, (N)ext, (P)revious? ").lower()
         if rep == "a":
@@ -67,12 +182,8 @@ class OpenLibrarySearch(object):
             print("what?")
 
     def search(self, ebook):
-        query = "author=%s&title=%s" % (ebook.metadata.get_values("author")[0],
-                                        ebook.metadata.get_values("title")[0])
-        t = requests.get(self.search_url %
-                         query.replace(" ", "+").replace("-", "+"))
-        hits = t.json().get("docs", None)
-        if hits is not None and hits != []:
+        hits = self.get_hits(ebook)
+        if hits != []:
             chosen_hit = self.display_hit(hits, 0)
             return chosen_hit
         else:
@@ -0,0 +1,299 @@
+import re
+
+# fields that can be searched with ranges: year:1990..2000, series_index:>3
+NUMERIC_FIELDS = ["year", "series_index"]
+
+TOKEN = re.compile(r"""\s*(?:(?P<open>-?\()|(?P<close>\))|
+                   (?P<term>-?(?:[^\s():"/]+:)?
+                   (?:"[^"]*"|/(?:\\.|[^/\\])*/|[^\s()]+)))""", re.VERBOSE)
+FIELD = re.compile(r'^([^\s():"/]+):(.*)$', re.DOTALL)
+# a bound is anything but <>= and the ".." separator: 1.5..2.5
+BOUND = r"(?:(?!\.\.)[^<>=])*"
+RANGE = re.compile(r"^(?:(?P<low>%s)\.\.(?P<high>%s)|"
+                   r"(?P<operator>[<>]=?)(?P<bound>[^<>=]+))$" %
+                   (BOUND, BOUND))
+KEYWORDS = ["AND", "OR", "NOT"]
+
+
+class QueryError(ValueError):
+    pass
+
+
+class Term(object):
+    """ Substring (or exact) match, as with --filter. """
+
+    def __init__(self, field, value):
+        self.field = field
+        self.value = value
+
+    def __repr__(self):
+        return "Term(%s, %r)" % (self.field, self.value)
+
+
+class Text(object):
+    """ Full-text search of the contents of the ebooks. """
+
+    def __init__(self, value):
+        self.value = value
+
+    def __repr__(self):
+        return "Text(%r)" % self.value
+
+
+class Range(object):
+    """ Numeric range, either bound can be None. """
+
+    def __init__(self, field, low, high, low_inclusive=True,
+                 high_inclusive=True):
+        self.field = field
+        self.low = low
+        self.high = high
+        self.low_inclusive = low_inclusive
+        self.high_inclusive = high_inclusive
+
+    def __repr__(self):
+        return "Range(%s, %s%s, %s%s)" % (
+            self.field, "[" if self.low_inclusive else "(", self.low,
+            self.high, "]" if self.high_inclusive else ")")
+
+
+class Regex(object):
+    """ Case-insensitive regular expression, searched in the values of a
+    field, or everywhere. """
+
+    def __init__(self, field, pattern):
+        self.field = field
+        self.pattern = pattern
+        try:
+            self.regex = re.compile(pattern, re.IGNORECASE)
+        except re.error as err:
+            raise QueryError("Invalid regular expression /%s/: %s" %
+                             (pattern, err))
+
+    def __repr__(self):
+        return "Regex(%s, /%s/)" % (self.field, self.pattern)
+
+
+class Paths(object):
+    """ Ebooks already known to match, by path, found with method (an
+    index...) for the source condition in the given number of seconds. """
+
+    def __init__(self, paths, source=None, method=None, seconds=0):
+        self.paths = paths
+        self.source = source
+        self.method = method
+        self.seconds = seconds
+
+    def __repr__(self):
+        return "Paths(%s)" % len(self.paths)
+
+
+class Not(object):
+
+    def __init__(self, child):
+        self.child = child
+
+    def __repr__(self):
+        return "Not(%r)" % self.child
+
+
+class And(object):
+
+    def __init__(self, children):
+        self.children = children
+
+    def __repr__(self):
+        return "And(%s)" % ", ".join([repr(el) for el in self.children])
+
+
+class Or(object):
+
+    def __init__(self, children):
+        self.children = children
+
+    def __repr__(self):
+        return "Or(%s)" % ", ".join([repr(el) for el in self.children])
+
+
+def describe(node):
+    """ Query string for a node. """
+    if isinstance(node, Term):
+        value = node.value
+        if re.search(r'[\s()]', value):
+            value = '"%s"' % value
+        if node.field is None:
+            return value
+        return "%s:%s" % (node.field, value)
+    if isinstance(node, Text):
+        return "text:%s" % node.value
+    if isinstance(node, Range):
+        bounds = ["" if el is None else "%g" % el
+                  for el in (node.low, node.high)]
+        if node.low is not None and not node.low_inclusive:
+            return "%s:>%s" % (node.field, bounds[0])
+        if node.high is not None and not node.high_inclusive:
+            return "%s:<%s" % (node.field, bounds[1])
+        return "%s:%s..%s" % (node.field, bounds[0], bounds[1])
+    if isinstance(node, Regex):
+        if node.field is None:
+            return "/%s/" % node.pattern
+        return "%s:/%s/" % (node.field, node.pattern)
+    if isinstance(node, Paths):
+        if node.source is None:
+            return "(%s ebooks)" % len(node.paths)
+        return describe(node.source)
+    if isinstance(node, Not):
+        return "NOT %s" % describe(node.child)
+    operator = " AND " if isinstance(node, And) else " OR "
+    return "(%s)" % operator.join([describe(el) for el in node.children])
+
+
+def to_number(value):
+    # leading number of a value: "1990-05-01" -> 1990.0
+    number = re.match(r"^\s*(-?\d+(?:\.\d+)?)", value)
+    if number is None:
+        return None
+    return float(number.group(1))
+
+
+def unquote(value):
+    if len(value) > 1 and value.startswith('"') and value.endswith('"'):
+        return value[1:-1]
+    return value
+
+
+def parse_range(field, value):
+    match = RANGE.match(value)
+    if match is None:
+        return None
+    if match.group("operator") is not None:
+        bound = to_number(match.group("bound"))
+        if bound is None:
+            return None
+        operator = match.group("operator")
+        if operator.startswith(">"):
+            return Range(field, bound, None, low_inclusive=(operator == ">="))
+        return Range(field, None, bound, high_inclusive=(operator == "<="))
+    low, high = match.group("low"), match.group("high")
+    bounds = [None if el == "" else to_number(el) for el in (low, high)]
+    if (low != "" and bounds[0] is None) or \
+            (high != "" and bounds[1] is None):
+        return None
+    return Range(field, bounds[0], bounds[1])
+
+
+def parse_term(term):
+    """ Node for a single term: [field:]value, value being a word, a
+    "quoted string", a /regular expression/, or a range for numeric
+    fields. """
+    field = None
+    value = term
+    fields = FIELD.match(term)
+    if fields is not None:
+        field, value = fields.groups()
+    if field == "text":
+        return Text(value)
+    if len(value) > 1 and value.startswith("/") and value.endswith("/"):
+        return Regex(field, value[1:-1])
+    if field in NUMERIC_FIELDS:
+        numeric_range = parse_range(field, value)
+        if numeric_range is not None:
+            return numeric_range
+    return Term(field, unquote(value))
+
+
+def tokenize(query):
+    tokens = []
+    position = 0
+    query = query.strip()
+    while position < len(query):
+        match = TOKEN.match(query, position)
+        if match is None or match.end() == position:
+            raise QueryError("Cannot parse the query after: %s" %
+                             query[:position])
+        position = match.end()
+        if match.group("open") is not None:
+            if match.group("open") == "-(":
+                tokens.append("-")
+            tokens.append("(")
+        elif match.group("close") is not None:
+            tokens.append(")")
+        else:
+            tokens.append(match.group("term"))
+    return tokens
+
+
+class QueryParser(object):
+    """ Parses queries such as
+        (tag:sf OR tag:fantasy) year:1990..2000 NOT author:/^a/
+    into an expression tree. Terms next to each other must all match, AND
+    and OR are uppercase, OR binds less tightly than AND, and NOT or -
+    negates the next term or group. """
+
+    def __init__(self, query):
+        self.tokens = tokenize(query)
+        self.position = 0
+
+    def _peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return None
+
+    def _next(self):
+        token = self._peek()
+        self.position += 1
+        return token
+
+    def parse(self):
+        if self.tokens == []:
+            raise QueryError("Empty query.")
+        node = self._or()
+        if self._peek() is not None:
+            raise QueryError("Unexpected %s in query." % self._peek())
+        return node
+
+    def _or(self):
+        children = [self._and()]
+        while self._peek() == "OR":
+            self._next()
+            children.append(self._and())
+        if len(children) == 1:
+            return children[0]
+        return Or(children)
+
+    def _and(self):
+        children = [self._not()]
+        while self._peek() not in [None, ")", "OR"]:
+            if self._peek() == "AND":
+                self._next()
+            children.append(self._not())
+        if len(children) == 1:
+            return children[0]
+        return And(children)
+
+    def _not(self):
+        token = self._peek()
+        if token in ["NOT", "-"]:
+            self._next()
+            return Not(self._not())
+        if token is not None and len(token) > 1 and token.startswith("-"):
+            self.tokens[self.position] = token[1:]
+            return Not(self._not())
+        return self._primary()
+
+    def _primary(self):
+        token = self._next()
+        if token is None:
+            raise QueryError("Unexpected end of query.")
+        if token == "(":
+            node = self._or()
+            if self._next() != ")":
+                raise QueryError("Missing ) in query.")
+            return node
+        if token == ")" or token in KEYWORDS:
+            raise QueryError("Unexpected %s in query." % token)
+        return parse_term(token)
+
+
+def parse_query(query):
+    return QueryParser(query).parse()
@@ -0,0 +1,150 @@
+import os
+import json
+from collections import defaultdict
+
+from .tracing import tracer, traced
+
+# suffix of the temporary name of ebooks moved in two steps
+TEMP_SUFFIX = ".librarian_rename"
+
+
+def _write_journal(journal_path, journal):
+    temp_path = journal_path + ".tmp"
+    with open(temp_path, "w") as journal_file:
+        json.dump(journal, journal_file, ensure_ascii=False)
+        journal_file.flush()
+        os.fsync(journal_file.fileno())
+    os.replace(temp_path, journal_path)
+
+
+def _move(source, target):
+    # os.rename, since ebooks never leave the library filesystem
+    os.rename(source, target)
+
+
+class RenamePlan(object):
+    """ Renames ebooks according to the filename template, all at once.
+    Target paths are computed from the stored metadata, ebooks that would
+    end up with the same filename (or overwrite an unknown file) are left
+    alone, and moves are written to a journal first so that an interrupted
+    rename can be completed with resume(). """
+
+    def __init__(self, library_dir, ebooks):
+        self.library_dir = library_dir
+        # (ebook, source, target)
+        self.moves = []
+        # target: [ebooks]
+        self.collisions = {}
+        # (ebook, target) where target is a file unknown to the library
+        self.conflicts = []
+        self._plan(ebooks)
+
+    def _plan(self, ebooks):
+        targets = defaultdict(list)
+        for ebook in ebooks:
+            if ebook.librarian_metadata.is_complete and \
+                    self.library_dir in ebook.path:
+                target = os.path.join(self.library_dir, ebook.filename)
+            else:
+                # stays where it is
+                target = ebook.path
+            targets[target].append(ebook)
+
+        moves = []
+        for target in sorted(targets.keys()):
+            candidates = targets[target]
+            if len(candidates) > 1:
+                self.collisions[target] = candidates
+            elif target != candidates[0].path:
+                moves.append((candidates[0], candidates[0].path, target))
+
+        # a target can only be taken if it is free, or freed by another move
+        while True:
+            moving = set([source for (ebook, source, target) in moves])
+            blocked = [el for el in moves
+                       if os.path.exists(el[2]) and el[2] not in moving]
+            if blocked == []:
+                break
+            for (ebook, source, target) in blocked:
+                self.conflicts.append((ebook, target))
+                moves.remove((ebook, source, target))
+        self.moves = moves
+
+    def _relative(self, path):
+        return os.path.relpath(path, self.library_dir)
+
+    def summary(self):
+        for (ebook, source, target) in self.moves:
+            print(" -> Renaming %s\n         to %s" %
+                  (self._relative(source), self._relative(target)))
+        for target in sorted(self.collisions.keys()):
+            print(" -> NOT RENAMED, these ebooks would all be renamed to %s:"
+                  % self._relative(target))
+            for ebook in self.collisions[target]:
+                print("      ", self._relative(ebook.path))
+        for (ebook, target) in self.conflicts:
+            print(" -> NOT RENAMED, %s already exists: %s" %
+                  (self._relative(target), self._relative(ebook.path)))
+        print("%s ebooks to rename, %s collisions, %s conflicts." %
+              (len(self.moves), len(self.collisions), len(self.conflicts)))
+
+    @property
+    def has_problems(self):
+        return self.collisions != {} or self.conflicts != []
+
+    @traced("rename_plan.execute")
+    def execute(self, journal_path):
+        if self.moves == []:
+            return
+        tracer.count("renames", len(self.moves))
+        sources = set([source for (ebook, source, target) in self.moves])
+        journal = {"phase": 1, "moves": []}
+        for (ebook, source, target) in self.moves:
+            temp = None
+            if target in sources:
+                # target is only freed by another move: move in two steps
+                temp = source + TEMP_SUFFIX
+            journal["moves"].append([source, temp, target])
+        _write_journal(journal_path, journal)
+
+        # creating directories once
+        directories = set([os.path.dirname(target)
+                           for (ebook, source, target) in self.moves])
+        for directory in sorted(directories):
+            if not os.path.exists(directory):
+                print("Creating directory", self._relative(directory))
+                os.makedirs(directory, exist_ok=True)
+
+        _complete(journal_path, journal)
+        for (ebook, source, target) in self.moves:
+            ebook.moved_to(target)
+        print("Renamed %s ebooks." % len(self.moves))
+
+
+def _complete(journal_path, journal):
+    if journal["phase"] == 1:
+        for (source, temp, target) in journal["moves"]:
+            destination = target
+            if temp is not None:
+                destination = temp
+            # already moved if interrupted before
+            if os.path.exists(source) and not os.path.exists(destination):
+                _move(source, destination)
+        journal["phase"] = 2
+        _write_journal(journal_path, journal)
+    for (source, temp, target) in journal["moves"]:
+        if temp is not None and os.path.exists(temp):
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            _move(temp, target)
+
+
+def resume(journal_path):
+    """ Completes the renames of an interrupted RenamePlan.execute, and
+    returns a dict of old path: new path. """
+    with open(journal_path, "r") as journal_file:
+        journal = json.load(journal_file)
+    for (source, temp, target) in journal["moves"]:
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+    _complete(journal_path, journal)
+    return dict([(source, target)
+                 for (source, temp, target) in journal["moves"]])
@@ -0,0 +1,181 @@
+import os
+import re
+import math
+import heapq
+import pickle
+from array import array
+from collections import Counter, defaultdict
+
+from .fulltext import normalize
+from .tracing import tracer
+
+# optional, scores are computed in pure python without it
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# cached models are built again when the features change
+VERSION = 1
+WORD = re.compile(r"[^\W\d_]{3,}")
+# how much sharing a feature of each kind counts
+FIELD_WEIGHTS = {"author": 3.0, "series": 3.0, "tag": 2.0, "subject": 2.0,
+                 "word": 1.0}
+
+
+def ebook_features(ebook):
+    """ {feature: count} for an ebook, from its authors, tags, series,
+    subjects and the words of its description. """
+    metadata = ebook.librarian_metadata
+    found = Counter()
+    for (field, values) in [("author", metadata.get_values("author")),
+                            ("tag", ebook.tags),
+                            ("series", metadata.get_values("series")),
+                            ("subject", metadata.get_values("subject"))]:
+        for value in values:
+            if value:
+                found["%s:%s" % (field, normalize(value))] += 1
+    for description in metadata.get_values("description"):
+        for word in WORD.findall(normalize(description or "")):
+            found["word:" + word] += 1
+    return found
+
+
+class SimilarityModel(object):
+    """ TF-IDF vectors of the ebooks of the library, normalized so that
+    the dot product of two of them is their cosine similarity, and kept as
+    a sparse matrix: row i is weights[indptr[i]:indptr[i + 1]], for the
+    features indices[indptr[i]:indptr[i + 1]]. Features only one ebook
+    has are left out. The model is valid as long as key is. """
+
+    def __init__(self, key, paths, feature_count, indptr, indices, weights):
+        self.key = key
+        self.paths = paths
+        self.rows = {path: row for (row, path) in enumerate(paths)}
+        self.feature_count = feature_count
+        self.indptr = indptr
+        self.indices = indices
+        self.weights = weights
+        # built when first needed
+        self.arrays = None
+        self.postings = None
+
+    @classmethod
+    def build(cls, key, ebooks):
+        with tracer.span("similarity.build"):
+            counts = [ebook_features(eb) for eb in ebooks]
+            frequency = Counter()
+            for found in counts:
+                frequency.update(found.keys())
+            columns = {}
+            for (feature, ebooks_with_it) in frequency.items():
+                if ebooks_with_it > 1:
+                    columns[feature] = len(columns)
+            total = len(ebooks)
+            indptr = array("q", [0])
+            indices = array("q")
+            weights = array("d")
+            for found in counts:
+                row = []
+                for (feature, count) in found.items():
+                    column = columns.get(feature, None)
+                    if column is None:
+                        continue
+                    idf = math.log(total / frequency[feature])
+                    weight = FIELD_WEIGHTS[feature.split(":", 1)[0]] * \
+                        (1 + math.log(count)) * idf
+                    if weight > 0:
+                        row.append((column, weight))
+                norm = math.sqrt(sum([el[1] ** 2 for el in row]))
+                for (column, weight) in row:
+                    indices.append(column)
+                    weights.append(weight / norm)
+                indptr.append(len(indices))
+        return cls(key, [eb.path for eb in ebooks], len(columns), indptr,
+                   indices, weights)
+
+    @classmethod
+    def load(cls, cache_path, key):
+        """ Cached model, or None if it is missing or out of date. """
+        if not os.path.exists(cache_path):
+            return None
+        with open(cache_path, "rb") as cache:
+            state = pickle.load(cache)
+        if state["version"] != VERSION or state["key"] != key:
+            return None
+        return cls(key, state["paths"], state["feature_count"],
+                   state["indptr"], state["indices"], state["weights"])
+
+    def save(self, cache_path):
+        temp = cache_path + ".tmp"
+        with open(temp, "wb") as cache:
+            pickle.dump({"version": VERSION, "key": self.key,
+                         "paths": self.paths,
+                         "feature_count": self.feature_count,
+                         "indptr": self.indptr, "indices": self.indices,
+                         "weights": self.weights}, cache,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp, cache_path)
+
+    def _query_vector(self, rows):
+        # sum of the vectors of the ebooks: their centroid, scaled
+        vector = defaultdict(float)
+        for row in rows:
+            for i in range(self.indptr[row], self.indptr[row + 1]):
+                vector[self.indices[i]] += self.weights[i]
+        return vector
+
+    def _numpy_scores(self, vector, excluded, count):
+        if self.arrays is None:
+            indptr = numpy.frombuffer(self.indptr, dtype=numpy.int64)
+            self.arrays = (
+                numpy.frombuffer(self.indices, dtype=numpy.int64),
+                numpy.frombuffer(self.weights, dtype=numpy.float64),
+                # row of every stored weight
+                numpy.repeat(numpy.arange(len(self.paths)),
+                             numpy.diff(indptr)))
+        indices, weights, row_ids = self.arrays
+        query = numpy.zeros(self.feature_count)
+        query[list(vector.keys())] = list(vector.values())
+        # all the dot products at once
+        scores = numpy.bincount(row_ids, weights=weights * query[indices],
+                                minlength=len(self.paths))
+        scores[list(excluded)] = 0
+        if count < len(scores):
+            best = numpy.argpartition(-scores, count)[:count]
+        else:
+            best = numpy.arange(len(scores))
+        return [(int(row), float(scores[row])) for row in best]
+
+    def _python_scores(self, vector, excluded, count):
+        if self.postings is None:
+            # feature -> [(row, weight)]
+            postings = defaultdict(list)
+            for row in range(len(self.paths)):
+                for i in range(self.indptr[row], self.indptr[row + 1]):
+                    postings[self.indices[i]].append((row, self.weights[i]))
+            self.postings = postings
+        scores = defaultdict(float)
+        for (column, query_weight) in vector.items():
+            for (row, weight) in self.postings.get(column, []):
+                scores[row] += query_weight * weight
+        return heapq.nlargest(count, [el for el in scores.items()
+                                      if el[0] not in excluded],
+                              key=lambda x: x[1])
+
+    def most_similar(self, paths, count=10):
+        """ Returns [(path, cosine similarity)] for the count ebooks most
+        similar to those of paths, taken together, best first. """
+        rows = set([self.rows[el] for el in paths if el in self.rows])
+        vector = self._query_vector(rows)
+        norm = math.sqrt(sum([el ** 2 for el in vector.values()]))
+        if norm == 0:
+            return []
+        with tracer.span("similarity.score"):
+            if numpy is not None:
+                scores = self._numpy_scores(vector, rows, count)
+            else:
+                scores = self._python_scores(vector, rows, count)
+        return [(self.paths[row], score / norm)
+                for (row, score) in sorted(scores, key=lambda x: -x[1])
+                if score > 0]
@@ -0,0 +1,120 @@
+from collections import defaultdict
+
+from librarianlib.ebook_search import Search, EvaluateMatch
+from librarianlib.query_parser import parse_query
+from librarianlib.tracing import tracer
+
+
+def normalize_definition(definition):
+    # a list of search terms is the same as {"filter": terms}, and a
+    # string the same as {"query": query}
+    if isinstance(definition, list):
+        definition = {"filter": definition}
+    elif isinstance(definition, str):
+        definition = {"query": definition}
+    keys = set(["filter", "list", "query"])
+    if not isinstance(definition, dict) or \
+            len(set(definition.keys()) & keys) != 1 or \
+            not set(definition.keys()) <= keys | set(["exclude"]):
+        raise ValueError("Invalid smart collection: %s" % definition)
+    if "query" in definition.keys():
+        parse_query(definition["query"])
+    return {key: (str(values) if key == "query"
+                  else [str(el) for el in values])
+            for (key, values) in definition.items()}
+
+
+class SmartCollections(object):
+    """ Saved searches, exported as collections. Their members are kept
+    in the database along with the library generation they are up to date
+    with: only the ebooks that changed since are searched again. """
+
+    def __init__(self, definitions):
+        self.definitions = {name: normalize_definition(definition)
+                            for (name, definition) in definitions.items()}
+        # name -> {"query", "as_of", "members"}
+        self.collections = {name: {"query": None, "as_of": None,
+                                   "members": set()}
+                            for name in self.definitions.keys()}
+        # path -> names of the smart collections of the ebook
+        self.by_path = {}
+
+    def load(self, state):
+        for (name, saved) in (state or {}).items():
+            if name not in self.collections.keys():
+                continue
+            self.collections[name] = {"query": saved["query"],
+                                      "as_of": saved["as_of"],
+                                      "members": set(saved["members"])}
+        self._index()
+
+    def to_database_json(self):
+        return {name: {"query": collection["query"],
+                       "as_of": collection["as_of"],
+                       "members": sorted(collection["members"])}
+                for (name, collection) in self.collections.items()}
+
+    def _index(self):
+        by_path = defaultdict(list)
+        for name in sorted(self.collections.keys()):
+            for path in self.collections[name]["members"]:
+                by_path[path].append(name)
+        self.by_path = by_path
+
+    def _search(self, definition, ebooks, text_search, numeric_index):
+        s = Search(ebooks, is_exact=False, text_search=text_search,
+                   numeric_index=numeric_index)
+        if "exclude" in definition.keys():
+            s.excludes(definition["exclude"])
+        if "query" in definition.keys():
+            s.query(definition["query"])
+            return s.run_search(EvaluateMatch.AND)
+        if "filter" in definition.keys():
+            s.filters(definition["filter"])
+            return s.run_search(EvaluateMatch.AND)
+        s.filters(definition["list"])
+        return s.run_search(EvaluateMatch.OR)
+
+    def update(self, ebooks, change_log, text_search=None,
+               numeric_index=None):
+        """ Brings the members of all smart collections up to date. """
+        if self.collections == {}:
+            return
+        with tracer.span("smart_collections.update"):
+            by_path = {eb.path: eb for eb in ebooks}
+            for (name, collection) in sorted(self.collections.items()):
+                definition = self.definitions[name]
+                members = collection["members"]
+                # removed or renamed ebooks
+                members.intersection_update(by_path.keys())
+                redefined = collection["query"] != definition
+                if redefined:
+                    to_search = ebooks
+                else:
+                    to_search = [eb for eb in ebooks
+                                 if eb.generation > collection["as_of"]]
+                if to_search != []:
+                    found = set([eb.path for eb in self._search(
+                        definition, to_search, text_search, numeric_index)])
+                    for eb in to_search:
+                        if (eb.path in found) == (eb.path in members):
+                            continue
+                        if eb.path in found:
+                            members.add(eb.path)
+                        else:
+                            members.discard(eb.path)
+                        # their collections changed, even though they
+                        # did not
+                        if redefined:
+                            eb.mark_as_changed()
+                    tracer.count("smart_collection_searches", len(to_search))
+                collection["query"] = definition
+                collection["as_of"] = change_log.generation
+            self._index()
+
+    def names(self, ebook):
+        return self.by_path.get(ebook.path, [])
+
+    def members(self, name, ebooks):
+        members = self.collections[name]["members"]
+        return [eb for eb in ebooks if eb.path in members]
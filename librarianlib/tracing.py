@@ -0,0 +1,112 @@
+import os
+import json
+import time
+import threading
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from functools import wraps
+
+NO_SPAN = nullcontext()
+
+
+class Tracer(object):
+    """ Records spans (timed sections of code, per thread) and counters
+    (zip opens, bytes hashed...) while enabled, for --profile.
+    Disabled, spans and counters cost a single test. """
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.events = []
+        self.counters = defaultdict(int)
+        self.origin = time.perf_counter()
+
+    def start(self):
+        self.reset()
+        self.enabled = True
+
+    def stop(self):
+        self.enabled = False
+
+    def _now(self):
+        # chrome traces are in microseconds
+        return (time.perf_counter() - self.origin) * 1e6
+
+    @contextmanager
+    def _span(self, name, args):
+        start = self._now()
+        try:
+            yield
+        finally:
+            event = {"name": name, "ph": "X", "ts": start,
+                     "dur": self._now() - start, "pid": os.getpid(),
+                     "tid": threading.get_ident()}
+            if args != {}:
+                event["args"] = args
+            with self.lock:
+                self.events.append(event)
+
+    def span(self, name, **args):
+        if not self.enabled:
+            return NO_SPAN
+        return self._span(name, args)
+
+    def count(self, name, value=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] += value
+            self.events.append({"name": name, "ph": "C", "ts": self._now(),
+                                "pid": os.getpid(),
+                                "args": {name: self.counters[name]}})
+
+    def summary(self):
+        # total time, calls and longest call for each span name
+        spans = {}
+        for event in self.events:
+            if event["ph"] != "X":
+                continue
+            span = spans.setdefault(event["name"],
+                                    {"calls": 0, "total_ms": 0,
+                                     "max_ms": 0})
+            span["calls"] += 1
+            span["total_ms"] += event["dur"] / 1000
+            span["max_ms"] = max(span["max_ms"], event["dur"] / 1000)
+        return {"spans": spans, "counters": dict(self.counters)}
+
+    def write(self, filename):
+        # chrome://tracing and https://ui.perfetto.dev can open this
+        with self.lock:
+            trace = {"traceEvents": list(self.events),
+                     "displayTimeUnit": "ms",
+                     "otherData": self.summary()}
+        with open(filename, "w") as trace_file:
+            json.dump(trace, trace_file)
+
+    def show(self):
+        summary = self.summary()
+        print("Profile:")
+        for (name, span) in sorted(summary["spans"].items(),
+                                   key=lambda x: -x[1]["total_ms"]):
+            print(" -> %-28s %6d calls %10.1fms (max %.1fms)" %
+                  (name, span["calls"], span["total_ms"], span["max_ms"]))
+        for (name, value) in sorted(summary["counters"].items()):
+            print(" -> %-28s %10d" % (name, value))
+
+
+# shared by the whole library
+tracer = Tracer()
+
+
+def traced(name):
+    """ Decorator recording each call of the function as a span. """
+    def decorator(f):
+        @wraps(f)
+        def new_f(*args, **kwargs):
+            with tracer.span(name):
+                return f(*args, **kwargs)
+        return new_f
+    return decorator
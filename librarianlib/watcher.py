@@ -0,0 +1,150 @@
+import os
+import sys
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+
+# see inotify(7)
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+WATCHED_EVENTS = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | \
+    IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+# files are complete once written and closed, or moved in
+READY_EVENTS = IN_CLOSE_WRITE | IN_MOVED_TO
+EVENT = struct.Struct("iIII")
+
+
+class Watcher(object):
+    """ Watches directory trees with inotify, and yields the sets of paths
+    that changed, and of files that are ready (completely written, or moved
+    in), once no event has been received for debounce seconds.
+    None is yielded instead if events were lost, and everything must be
+    checked again. """
+
+    def __init__(self, roots, debounce=2, max_delay=30):
+        if not sys.platform.startswith("linux"):
+            raise Exception("Watching directories requires inotify (Linux).")
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"),
+                                use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.debounce = debounce
+        # changes are reported at least every max_delay seconds
+        self.max_delay = max_delay
+        # watch descriptor: directory
+        self.directories = {}
+        self.changed = set()
+        self.ready = set()
+        self.overflow = False
+        for root in roots:
+            self._watch_tree(root)
+
+    def close(self):
+        os.close(self.fd)
+
+    def _add_watch(self, directory):
+        wd = self.libc.inotify_add_watch(self.fd,
+                                         os.fsencode(directory),
+                                         WATCHED_EVENTS | IN_ONLYDIR)
+        if wd < 0:
+            err = ctypes.get_errno()
+            # already gone, or not a directory anymore
+            if err in [errno.ENOENT, errno.ENOTDIR]:
+                return
+            raise OSError(err, "inotify_add_watch failed", directory)
+        self.directories[wd] = directory
+
+    def _watch_tree(self, root, report_files=False):
+        for (directory, dirs, files) in os.walk(root):
+            self._add_watch(directory)
+            if report_files:
+                # moved in with their directory, without events of their own
+                paths = [os.path.join(directory, el) for el in files]
+                self.changed.update(paths)
+                self.ready.update(paths)
+
+    def _unwatch_tree(self, root):
+        # the watches follow the directories, wherever they are moved: they
+        # are added again, with their new paths, if moved to a watched tree
+        prefix = root + os.sep
+        for (wd, directory) in list(self.directories.items()):
+            if directory == root or directory.startswith(prefix):
+                self.libc.inotify_rm_watch(self.fd, wd)
+                del self.directories[wd]
+
+    def _read_events(self):
+        data = os.read(self.fd, 64 * 1024)
+        position = 0
+        while position < len(data):
+            wd, mask, cookie, length = EVENT.unpack_from(data, position)
+            position += EVENT.size
+            name = data[position:position + length].rstrip(b"\0")
+            position += length
+            if mask & IN_Q_OVERFLOW:
+                self.overflow = True
+                continue
+            if mask & IN_IGNORED:
+                self.directories.pop(wd, None)
+                continue
+            directory = self.directories.get(wd, None)
+            if directory is None:
+                continue
+            if name == b"":
+                # the watched directory itself was moved or deleted
+                self.changed.add(directory)
+                continue
+            path = os.path.join(directory, os.fsdecode(name))
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self._watch_tree(path, report_files=True)
+                elif mask & IN_MOVED_FROM:
+                    # its files are gone from here
+                    self._unwatch_tree(path)
+                    self.changed.add(path)
+            else:
+                self.changed.add(path)
+                if mask & READY_EVENTS:
+                    self.ready.add(path)
+                else:
+                    # being written, moved away or deleted
+                    self.ready.discard(path)
+
+    def changes(self):
+        while True:
+            select.select([self.fd], [], [])
+            first_event = time.monotonic()
+            while True:
+                self._read_events()
+                waited = time.monotonic() - first_event
+                timeout = min(self.debounce, self.max_delay - waited)
+                if timeout <= 0:
+                    break
+                ready, _, _ = select.select([self.fd], [], [], timeout)
+                if ready == []:
+                    break
+            if self.overflow:
+                self.overflow = False
+                self.changed = set()
+                self.ready = set()
+                yield None
+            else:
+                changed, ready = self.changed, self.ready
+                self.changed = set()
+                self.ready = set()
+                yield changed, ready
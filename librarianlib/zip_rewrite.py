@@ -0,0 +1,267 @@
+import os
+import hashlib
+import struct
+import tempfile
+import time
+import zipfile
+import zlib
+
+from .tracing import tracer
+
+# see the zip APPNOTE, 4.3.7 and 4.3.12
+LOCAL_HEADER = struct.Struct("<4s2B4HL2L2H")
+LOCAL_HEADER_SIGNATURE = b"PK\003\004"
+CENTRAL_HEADER = struct.Struct("<4s4B4HL2L5H2L")
+CENTRAL_HEADER_SIGNATURE = b"PK\001\002"
+END_RECORD = struct.Struct("<4s4H2LH")
+END_RECORD_SIGNATURE = b"PK\005\006"
+
+UTF8_FLAG = 0x800
+DATA_DESCRIPTOR_FLAG = 0x08
+ENCRYPTED_FLAG = 0x01
+ZIP64_LIMIT = 0xFFFFFFFF
+COPY_BUFFER = 1024 * 1024
+# enough for the central directory of most epubs
+TAIL_SIZE = 256 * 1024
+
+
+class ZipEntry(object):
+    """ What is needed to write an entry in the central directory. """
+
+    def __init__(self, info, offset, crc, compress_size, file_size,
+                 compress_type, flag_bits):
+        self.info = info
+        self.offset = offset
+        self.crc = crc
+        self.compress_size = compress_size
+        self.file_size = file_size
+        self.compress_type = compress_type
+        self.flag_bits = flag_bits
+
+
+def _encoded_name(info, flag_bits):
+    if flag_bits & UTF8_FLAG:
+        return info.filename.encode("utf8")
+    return info.filename.encode("cp437")
+
+
+def _dos_time(info):
+    date_time = info.date_time
+    dos_date = (date_time[0] - 1980) << 9 | date_time[1] << 5 | date_time[2]
+    dos_time = date_time[3] << 11 | date_time[4] << 5 | date_time[5] // 2
+    return dos_date, dos_time
+
+
+def _write_local_header(output, entry, name, extra):
+    dos_date, dos_time = _dos_time(entry.info)
+    output.write(LOCAL_HEADER.pack(LOCAL_HEADER_SIGNATURE,
+                                   entry.info.extract_version, 0,
+                                   entry.flag_bits, entry.compress_type,
+                                   dos_time, dos_date, entry.crc,
+                                   entry.compress_size, entry.file_size,
+                                   len(name), len(extra)))
+    output.write(name)
+    output.write(extra)
+
+
+def _copy_raw_entry(source, output, info):
+    # sizes and crc are taken from the central directory, so that data
+    # descriptors are not needed anymore
+    flag_bits = info.flag_bits & ~DATA_DESCRIPTOR_FLAG
+    source.seek(info.header_offset)
+    header = LOCAL_HEADER.unpack(source.read(LOCAL_HEADER.size))
+    if header[0] != LOCAL_HEADER_SIGNATURE:
+        raise zipfile.BadZipFile("Bad local header for %s" % info.filename)
+    source.seek(header[10], os.SEEK_CUR)
+    extra = source.read(header[11])
+
+    entry = ZipEntry(info, output.tell(), info.CRC, info.compress_size,
+                     info.file_size, info.compress_type, flag_bits)
+    _write_local_header(output, entry, _encoded_name(info, flag_bits), extra)
+    remaining = info.compress_size
+    while remaining > 0:
+        chunk = source.read(min(COPY_BUFFER, remaining))
+        if not chunk:
+            raise zipfile.BadZipFile("Truncated entry %s" % info.filename)
+        output.write(chunk)
+        remaining -= len(chunk)
+    return entry
+
+
+def _write_new_entry(output, info, data, compress_type):
+    flag_bits = info.flag_bits & ~DATA_DESCRIPTOR_FLAG
+    if compress_type == zipfile.ZIP_DEFLATED:
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
+                                      zlib.DEFLATED, -15)
+        compressed = compressor.compress(data) + compressor.flush()
+    else:
+        compressed = data
+    entry = ZipEntry(info, output.tell(), zlib.crc32(data), len(compressed),
+                     len(data), compress_type, flag_bits)
+    _write_local_header(output, entry, _encoded_name(info, flag_bits), b"")
+    output.write(compressed)
+    return entry
+
+
+def _write_central_directory(output, entries):
+    start = output.tell()
+    for entry in entries:
+        info = entry.info
+        name = _encoded_name(info, entry.flag_bits)
+        dos_date, dos_time = _dos_time(info)
+        output.write(CENTRAL_HEADER.pack(CENTRAL_HEADER_SIGNATURE,
+                                         info.create_version,
+                                         info.create_system,
+                                         info.extract_version, 0,
+                                         entry.flag_bits,
+                                         entry.compress_type,
+                                         dos_time, dos_date, entry.crc,
+                                         entry.compress_size,
+                                         entry.file_size, len(name),
+                                         len(info.extra), len(info.comment),
+                                         0, info.internal_attr,
+                                         info.external_attr, entry.offset))
+        output.write(name)
+        output.write(info.extra)
+        output.write(info.comment)
+    size = output.tell() - start
+    output.write(END_RECORD.pack(END_RECORD_SIGNATURE, 0, 0, len(entries),
+                                 len(entries), size, start, 0))
+
+
+def fingerprint(path):
+    """ Hash of the central directory (names, sizes, CRCs and offsets of
+    all entries) and size of a zip archive, usually read with a single
+    seek to the end of the file. Identical archives have the same
+    fingerprint, and an archive that was rewritten almost always gets a
+    new one. Returns None if the archive cannot be read this way. """
+    with tracer.span("zip.fingerprint"), open(path, "rb") as archive:
+        tracer.count("zip_fingerprints")
+        size = archive.seek(0, os.SEEK_END)
+        tail_start = max(0, size - TAIL_SIZE)
+        archive.seek(tail_start)
+        tail = archive.read()
+        end = tail.rfind(END_RECORD_SIGNATURE)
+        if end == -1 or len(tail) - end < END_RECORD.size:
+            return None
+        record = END_RECORD.unpack_from(tail, end)
+        directory_size, directory_offset = record[5], record[6]
+        if directory_offset == ZIP64_LIMIT or directory_size > end + \
+                tail_start:
+            return None
+        # the central directory is right before the end record
+        if directory_size <= end:
+            directory = tail[end - directory_size:end]
+        else:
+            archive.seek(tail_start + end - directory_size)
+            directory = archive.read(directory_size)
+    if directory_size != 0 and \
+            not directory.startswith(CENTRAL_HEADER_SIGNATURE):
+        return None
+    sha1 = hashlib.sha1(directory)
+    sha1.update(str(size).encode("ascii"))
+    return sha1.hexdigest()
+
+
+def _needs_fallback(infos, archive_size):
+    if archive_size >= ZIP64_LIMIT or len(infos) >= 0xFFFF:
+        return True
+    for info in infos:
+        if info.flag_bits & ENCRYPTED_FLAG or \
+                info.file_size >= ZIP64_LIMIT or \
+                info.compress_size >= ZIP64_LIMIT:
+            return True
+    return False
+
+
+def _new_info(filename):
+    info = zipfile.ZipInfo(filename, time.localtime()[:6])
+    info.create_system = 3
+    info.external_attr = 0o644 << 16
+    if not filename.isascii():
+        info.flag_bits |= UTF8_FLAG
+    return info
+
+
+def _rewrite_with_zipfile(source_path, output, replacements, removals):
+    # slow path: everything is decompressed and recompressed
+    with zipfile.ZipFile(source_path, "r") as source, \
+            zipfile.ZipFile(output, "w") as destination:
+        infos = [el for el in source.infolist()
+                 if el.filename not in removals]
+        if "mimetype" in replacements and \
+                "mimetype" not in [el.filename for el in infos]:
+            infos.append(_new_info("mimetype"))
+        # mimetype first, and stored
+        infos.sort(key=lambda x: x.filename != "mimetype")
+        for info in infos:
+            compress_type = info.compress_type
+            if info.filename == "mimetype":
+                compress_type = zipfile.ZIP_STORED
+            if info.filename in replacements:
+                data = replacements.pop(info.filename)
+            else:
+                data = source.read(info.filename)
+            destination.writestr(info, data, compress_type)
+        for filename in sorted(replacements.keys()):
+            destination.writestr(_new_info(filename), replacements[filename],
+                                 zipfile.ZIP_DEFLATED)
+
+
+def rewrite_zip(path, replacements=None, removals=()):
+    """ Rewrites a zip archive, replacing or adding the entries in the
+    replacements dict (filename: bytes) and removing those in removals.
+    Untouched entries are copied without being decompressed, the mimetype
+    entry is kept first and uncompressed (as epubs require), and the
+    archive is replaced atomically. """
+    replacements = dict(replacements or {})
+    removals = set(removals)
+    directory = os.path.dirname(os.path.abspath(path))
+    handle, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(handle, "wb") as output:
+            with zipfile.ZipFile(path, "r") as archive:
+                tracer.count("zip_opens")
+                infos = [el for el in archive.infolist()
+                         if el.filename not in removals]
+                fallback = _needs_fallback(infos, os.path.getsize(path))
+                # a compressed mimetype must be stored instead
+                for info in infos:
+                    if info.filename == "mimetype" and \
+                            info.filename not in replacements and \
+                            info.compress_type != zipfile.ZIP_STORED:
+                        replacements["mimetype"] = archive.read(info)
+            if fallback:
+                _rewrite_with_zipfile(path, output, replacements, removals)
+            else:
+                # mimetype first
+                infos.sort(key=lambda x: x.filename != "mimetype")
+                entries = []
+                with open(path, "rb") as source:
+                    for info in infos:
+                        if info.filename in replacements:
+                            compress_type = zipfile.ZIP_DEFLATED
+                            if info.filename == "mimetype":
+                                compress_type = zipfile.ZIP_STORED
+                            entries.append(_write_new_entry(
+                                output, info,
+                                replacements.pop(info.filename),
+                                compress_type))
+                        else:
+                            entries.append(_copy_raw_entry(source, output,
+                                                           info))
+                    for filename in sorted(replacements.keys()):
+                        entries.append(_write_new_entry(
+                            output, _new_info(filename),
+                            replacements[filename], zipfile.ZIP_DEFLATED))
+                _write_central_directory(output, entries)
+            tracer.count("zip_rewrites")
+            tracer.count("bytes_written", output.tell())
+            output.flush()
+            os.fsync(output.fileno())
+        os.chmod(temp_path, os.stat(path).st_mode & 0o7777)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise